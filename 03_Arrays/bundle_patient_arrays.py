@@ -0,0 +1,43 @@
+import multiprocessing
+import os
+
+from Models.array_bundle import get_bundle_paths, write_bundle_from_npy
+from Models.region_index import get_region_indices
+from save_files import CONTROL1, NEW_DIR
+from cohort_manifest import get_patient_folders, run_incremental
+
+# Name of this step in the cohort manifest
+STAGE = "bundle"
+
+
+def process_folder(folder):
+    folder_path = os.path.join(NEW_DIR, folder)
+    folder_name = folder.split('_')[0]
+    array_dir = os.path.join(folder_path, "array")
+
+    # Run after the image, brain and tumor exporters, so every array of the patient ends up in the bundle
+    if os.path.isdir(array_dir) and folder.startswith(CONTROL1):
+        print(f"Processing folder: {folder}")
+        try:
+            get_region_indices(array_dir, folder_name)  # saved as .npy, so bundled with the arrays
+        except FileNotFoundError as e:
+            print(f"No region indices for {folder}: {e}")
+        write_bundle_from_npy(array_dir, folder_name)
+
+
+def get_inputs(folder):
+    array_dir = os.path.join(NEW_DIR, folder, "array")
+    if not os.path.isdir(array_dir):
+        return []
+    return [os.path.join(array_dir, name) for name in sorted(os.listdir(array_dir)) if name.endswith((".npy", ".npz"))]
+
+
+def get_outputs(folder):
+    return list(get_bundle_paths(os.path.join(NEW_DIR, folder, "array"), folder.split('_')[0]))
+
+
+# MAIN PIPELINE
+if __name__ == "__main__":
+    # Only the patients with new or changed arrays or a missing bundle
+    run_incremental(STAGE, NEW_DIR, get_patient_folders(NEW_DIR, CONTROL1), process_folder, get_inputs, get_outputs,
+                    processes=multiprocessing.cpu_count())
@@ -3,9 +3,14 @@ import numpy as np
 import multiprocessing
 import os
 
+from Models.masks import save_mask
+from cohort_manifest import get_patient_folders, run_incremental
+
 CONTROL1 = "UCSF-PDGM-"
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 CONTROL_BRAINSEG = "brain_segmentation"
+# Name of this step in the cohort manifest
+STAGE = "brainseg_array"
 
 def get_array_tumor_seg(folder_name, subfolder_dir, array_dir, nii_file):
     if nii_file.startswith(folder_name) and CONTROL_BRAINSEG in nii_file:
@@ -14,9 +19,13 @@ def get_array_tumor_seg(folder_name, subfolder_dir, array_dir, nii_file):
 
         # Arrays
         img = nib.load(os.path.join(subfolder_dir, nii_file))
-        img_array = img.get_fdata()
-        img_array_path = os.path.join(array_dir, f"{nii_file_name}_array.npy")
-        np.save(img_array_path, img_array)
+        img_array = np.asanyarray(img.dataobj)
+        try:
+            # Bit-packed, 1 bit per voxel instead of a float64 volume
+            save_mask(os.path.join(array_dir, f"{nii_file_name}_array.npz"), img_array)
+        except ValueError as e:
+            print(f"Not a binary mask ({e}), saving {nii_file} as .npy")
+            np.save(os.path.join(array_dir, f"{nii_file_name}_array.npy"), img.get_fdata())
         print(f"Brain segmentation array successfully save for {subfolder_dir} to {array_dir}")
 def process_folder(folder):
     folder_path = os.path.join(NEW_DIR, folder)
@@ -36,8 +45,21 @@ def process_folder(folder):
             if nii_file.startswith(folder_name) and CONTROL_BRAINSEG in nii_file:
                 get_array_tumor_seg(folder_name, seg_dir, array_dir, nii_file)
                 break
-# MAIN PIPELINE
-folders = os.listdir(NEW_DIR)
+def get_inputs(folder):
+    folder_name = folder.split('_')[0]
+    return [os.path.join(NEW_DIR, folder, "seg", f"{folder_name}_{CONTROL_BRAINSEG}.nii.gz")]
+
 
-with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-    pool.map(process_folder, folders)
\ No newline at end of file
+def get_outputs(folder):
+    folder_name = folder.split('_')[0]
+    array_dir = os.path.join(NEW_DIR, folder, "array")
+    array_name = f"{folder_name}_{CONTROL_BRAINSEG}_array"
+    # Mask or, for a non binary segmentation, .npy fallback (only the existing one is recorded)
+    return [os.path.join(array_dir, f"{array_name}.npz"), os.path.join(array_dir, f"{array_name}.npy")]
+
+
+# MAIN PIPELINE
+if __name__ == "__main__":
+    # Only the patients whose brain segmentation changed or whose arrays are missing
+    run_incremental(STAGE, NEW_DIR, get_patient_folders(NEW_DIR, CONTROL1), process_folder, get_inputs, get_outputs,
+                    processes=multiprocessing.cpu_count())
\ No newline at end of file
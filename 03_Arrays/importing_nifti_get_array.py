@@ -3,6 +3,10 @@ import numpy as np
 
 import os
 from save_files import CONTROL1, NEW_DIR
+from cohort_manifest import get_patient_folders, run_incremental
+
+# Name of this step in the cohort manifest
+STAGE = "nifti_array"
 
 
 def rescale_to_16bit(array, epsilon=1e-6):
@@ -30,8 +34,7 @@ def get_arrays_for_patient(folder_name, subfolder_dir, array_dir, nii_file):
         np.save(rescaled_array_path, rescaled_array)
     print(f"Arrays saved successfully for {subfolder_dir} to {array_dir}")
 
-# MAIN PIPELINE
-for folder in os.listdir(NEW_DIR):
+def process_folder(folder):
     folder_path = os.path.join(NEW_DIR, folder)
     folder_name = folder.split('_')[0]
 
@@ -55,3 +58,29 @@ for folder in os.listdir(NEW_DIR):
             get_arrays_for_patient(folder_name,anat_dir, array_dir, nii_file)
 
 
+def get_nifti_files(folder):
+    """(directory, file name) of the native and N4 images exported for a subject folder."""
+    folder_path = os.path.join(NEW_DIR, folder)
+    folder_name = folder.split('_')[0]
+    nifti_files = []
+    for subfolder_dir in (os.path.join(folder_path, "reg"), os.path.join(folder_path, "anat")):
+        if os.path.isdir(subfolder_dir):
+            nifti_files.extend((subfolder_dir, nii_file) for nii_file in sorted(os.listdir(subfolder_dir))
+                               if nii_file.startswith(folder_name) and nii_file.endswith(".nii.gz")
+                               and not nii_file.endswith("_dn.nii.gz"))
+    return nifti_files
+
+
+def get_inputs(folder):
+    return [os.path.join(subfolder_dir, nii_file) for subfolder_dir, nii_file in get_nifti_files(folder)]
+
+
+def get_outputs(folder):
+    array_dir = os.path.join(NEW_DIR, folder, "array")
+    return [os.path.join(array_dir, f"{nii_file.split('.')[0]}_rescaled.npy") for _, nii_file in get_nifti_files(folder)]
+
+
+# MAIN PIPELINE
+if __name__ == "__main__":
+    # Only the patients with new or changed images (a new N4 variant included) or missing arrays
+    run_incremental(STAGE, NEW_DIR, get_patient_folders(NEW_DIR, CONTROL1), process_folder, get_inputs, get_outputs)
@@ -4,8 +4,13 @@ import nibabel as nib
 import numpy as np
 
 import os
+
+from cohort_manifest import get_patient_folders, run_incremental
+
 CONTROL1 = "UCSF-PDGM-"
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
+# Name of this step in the cohort manifest
+STAGE = "biasfield_array"
 
 
 def rescale_to_16bit(array, epsilon=1e-6):
@@ -58,8 +63,28 @@ def process_folder(folder):
         for nii_file in os.listdir(anat_dir):
             get_arrays_for_patient(folder_name, anat_dir, array_dir, nii_file)"""
 
-# MAIN PIPELINE
-folders = os.listdir(NEW_DIR)
+def get_biasfield_files(folder):
+    """Biasfields of the reg directory of a subject folder, the files exported by process_folder."""
+    reg_dir = os.path.join(NEW_DIR, folder, "reg")
+    folder_name = folder.split('_')[0]
+    if not os.path.isdir(reg_dir):
+        return []
+    return [nii_file for nii_file in sorted(os.listdir(reg_dir))
+            if nii_file.startswith(f'biasfield_{folder_name}') and nii_file.endswith(".nii.gz")
+            and not nii_file.endswith("_dn.nii.gz")]
+
 
-with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-    pool.map(process_folder, folders)
+def get_inputs(folder):
+    return [os.path.join(NEW_DIR, folder, "reg", nii_file) for nii_file in get_biasfield_files(folder)]
+
+
+def get_outputs(folder):
+    array_dir = os.path.join(NEW_DIR, folder, "array")
+    return [os.path.join(array_dir, f"{nii_file.split('.')[0]}_not_rescaled.npy") for nii_file in get_biasfield_files(folder)]
+
+
+# MAIN PIPELINE
+if __name__ == "__main__":
+    # Only the patients with new or changed biasfields (a new N4 variant included) or missing arrays
+    run_incremental(STAGE, NEW_DIR, get_patient_folders(NEW_DIR, CONTROL1), process_folder, get_inputs, get_outputs,
+                    processes=multiprocessing.cpu_count())
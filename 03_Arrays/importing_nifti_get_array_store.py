@@ -0,0 +1,67 @@
+import multiprocessing
+import os
+
+import h5py
+
+from Models.array_store import get_store_path, write_rescaled_nifti
+from save_files import CONTROL1, NEW_DIR
+from cohort_manifest import get_patient_folders, run_incremental
+
+# Name of this step in the cohort manifest
+STAGE = "array_store"
+
+
+def get_arrays_for_patient(folder_name, subfolder_dir, store, nii_file):
+    # Native and N4 images plus their biasfields, like the .npy exporters
+    if not (nii_file.startswith(folder_name) or nii_file.startswith(f"biasfield_{folder_name}")):
+        return
+    if nii_file.endswith("_dn.nii.gz"):  # Exclude _dn.nii.gz files
+        print(f"Skipping file: {nii_file} (ends with _dn.nii.gz)")
+        return
+    nii_file_name = nii_file.split('.')[0]
+    print(f"Processing file: {nii_file}")
+    write_rescaled_nifti(store, f"{nii_file_name}_rescaled", os.path.join(subfolder_dir, nii_file))
+
+
+def process_folder(folder):
+    folder_path = os.path.join(NEW_DIR, folder)
+    folder_name = folder.split('_')[0]
+
+    # Check if it's a subject folder
+    if os.path.isdir(folder_path) and folder.startswith(CONTROL1):
+        print(f"Processing folder: {folder}")
+
+        anat_dir = os.path.join(folder_path, "anat")
+        reg_dir = os.path.join(folder_path, "reg")
+        array_dir = os.path.join(folder_path, "array")
+        os.makedirs(array_dir, exist_ok=True)
+
+        # One chunked, compressed store per patient, one dataset per modality and variant
+        with h5py.File(get_store_path(array_dir, folder_name), "a") as store:
+            for subfolder_dir in (anat_dir, reg_dir):
+                if not os.path.isdir(subfolder_dir):
+                    continue
+                for nii_file in os.listdir(subfolder_dir):
+                    get_arrays_for_patient(folder_name, subfolder_dir, store, nii_file)
+        print(f"Array store saved successfully for {folder_path}")
+
+
+def get_inputs(folder):
+    folder_path = os.path.join(NEW_DIR, folder)
+    inputs = []
+    for subfolder_dir in (os.path.join(folder_path, "anat"), os.path.join(folder_path, "reg")):
+        if os.path.isdir(subfolder_dir):
+            inputs.extend(os.path.join(subfolder_dir, nii_file) for nii_file in sorted(os.listdir(subfolder_dir))
+                          if nii_file.endswith(".nii.gz") and not nii_file.endswith("_dn.nii.gz"))
+    return inputs
+
+
+def get_outputs(folder):
+    return [get_store_path(os.path.join(NEW_DIR, folder, "array"), folder.split('_')[0])]
+
+
+# MAIN PIPELINE
+if __name__ == "__main__":
+    # Only the patients with new or changed images (a new N4 variant included) or a missing store
+    run_incremental(STAGE, NEW_DIR, get_patient_folders(NEW_DIR, CONTROL1), process_folder, get_inputs, get_outputs,
+                    processes=multiprocessing.cpu_count())
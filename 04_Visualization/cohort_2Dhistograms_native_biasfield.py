@@ -0,0 +1,134 @@
+import os
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+
+from Models.array_bundle import get_array_fingerprint, load_patient_array
+from Models.histograms import CohortJointHistograms
+from Models.patient import N4_VARIANTS, VARIANT_SUFFIXES
+from Models.region_index import gather, get_region_indices
+
+NEW_DIR = "/mnt/external/reorg_patients_UCSF"
+INPUT_MRI = "T1", "T1c", "T2", "FLAIR"
+# Plotted region -> region index, the healthy brain (no tumor) as "brain" like the per-patient scatter plots
+JOINT_REGIONS = {"brain": "healthy", "tumor": "tumor"}
+JOINT_HISTOGRAMS_NAME = "joint_histograms_native_biasfield.npz"
+
+
+def get_patient_array_names(patient_dir_name):
+    """Masks, native and biasfield arrays the joint histograms of a patient are read from."""
+    names = [f'{patient_dir_name}_brain_segmentation_array', f'{patient_dir_name}_tumor_binary_array']
+    for mri_type in INPUT_MRI:
+        names.append(f'{patient_dir_name}_{mri_type}_rescaled')
+        names.extend(f'biasfield_{patient_dir_name}_{mri_type}{VARIANT_SUFFIXES[variant]}_rescaled'
+                     for variant in N4_VARIANTS)
+    return names
+
+
+def get_patient_sources(array_dir_path, patient_dir_name):
+    """{array name: get_array_fingerprint} of the arrays of a patient, to tell when they were exported again."""
+    return {name: get_array_fingerprint(array_dir_path, patient_dir_name, name)
+            for name in get_patient_array_names(patient_dir_name)}
+
+
+def add_patient_joint_histograms(histograms, array_dir_path, patient_dir_name):
+    """Add the native vs biasfield pairs of the healthy brain and tumor voxels of one patient, for every MRI type
+    and N4 variant. Like the per-patient scatter plots, only the voxels with a non-zero native intensity count.
+    """
+    regions = get_region_indices(array_dir_path, patient_dir_name)
+    for mri_type in INPUT_MRI:
+        native_name = f'{patient_dir_name}_{mri_type}_rescaled'
+        native_image_array = load_patient_array(array_dir_path, patient_dir_name, native_name)
+        region_indices = {}
+        native_values = {}
+        for region, region_index in JOINT_REGIONS.items():
+            values = gather(native_image_array, regions[region_index])
+            region_indices[region] = regions[region_index][values > 0]
+            native_values[region] = values[values > 0]
+        for variant in N4_VARIANTS:
+            bias_name = f'biasfield_{patient_dir_name}_{mri_type}{VARIANT_SUFFIXES[variant]}_rescaled'
+            bias_array = load_patient_array(array_dir_path, patient_dir_name, bias_name)
+            for region in JOINT_REGIONS:
+                histograms.add((mri_type, variant, region), native_values[region], gather(bias_array, region_indices[region]))
+
+
+def compute_cohort_joint_histograms(new_dir_path, save_path=None, histograms=None):
+    """Stream every patient of the cohort into one set of joint histograms, saved to ``save_path``.
+
+    Starting from ``histograms`` (e.g. loaded from an earlier run), only the patients it does
+    not hold yet are added. The totals only keep one patient's counts as a whole, so when
+    the arrays of a patient they hold were exported again (or the patient is gone), they are
+    recomputed from scratch. Each patient is accumulated on its own and merged only once all
+    its arrays were read, so a patient with a missing array adds no counts at all.
+    """
+    patient_dirs = {}
+    for patient_dir_name_nifti in sorted(os.listdir(new_dir_path)):
+        array_dir_path = os.path.join(new_dir_path, patient_dir_name_nifti, 'array')
+        if os.path.isdir(array_dir_path):
+            patient_dirs[patient_dir_name_nifti.split("_")[0]] = array_dir_path
+    sources = {patient_dir_name: get_patient_sources(array_dir_path, patient_dir_name)
+               for patient_dir_name, array_dir_path in patient_dirs.items()}
+
+    changed = histograms is not None and any(histograms.sources.get(patient_dir_name) != sources.get(patient_dir_name)
+                                             for patient_dir_name in histograms.patients)
+    if changed:
+        print("Arrays of the saved patients changed, recomputing the cohort joint histograms")
+    if histograms is None or changed:
+        histograms = CohortJointHistograms()
+    added = 0
+    for patient_dir_name, array_dir_path in patient_dirs.items():
+        if patient_dir_name in histograms.patients:
+            continue
+        patient_histograms = CohortJointHistograms(bins=histograms.bins)
+        patient_histograms.sources[patient_dir_name] = sources[patient_dir_name]
+        try:
+            add_patient_joint_histograms(patient_histograms, array_dir_path, patient_dir_name)
+        except FileNotFoundError as e:
+            print(f"Skipping {patient_dir_name}: {e}")
+            continue
+        patient_histograms.patients.append(patient_dir_name)
+        histograms.merge(patient_histograms)
+        added += 1
+        print(f"Processed patient: {patient_dir_name}")
+    if save_path is not None and (added or changed or not os.path.exists(save_path)):
+        histograms.save(save_path)
+    return histograms
+
+
+def plot_cohort_joint_histograms(histograms, mri_type, region="brain"):
+    corrections = ["n4bb", "n4hh", "n4bh", "n4hb"]
+    edges = histograms.edges
+
+    fig, axes = plt.subplots(2, 2, figsize=(12, 10))
+    axes = axes.flatten()
+
+    for idx, correction in enumerate(corrections):
+        key = (mri_type, correction, region)
+        ax = axes[idx]
+        density = histograms.density(key)
+        mesh = ax.pcolormesh(edges, edges, density.T, cmap='inferno', norm=LogNorm(vmin=density[density > 0].min(initial=1)))
+        com_x, com_y = histograms.com(key)
+        ax.scatter([com_x], [com_y], color='cyan', marker='x', label="CoM")
+
+        cbar = plt.colorbar(mesh, ax=ax)
+        cbar.set_label('Density')
+        ax.set_xlabel('Native MRI intensities', color='black')
+        ax.set_ylabel('Biasfield intensities', color='black')
+        ax.set_title(f'{mri_type} - {correction} ({region}, {len(histograms.patients)} patients)', color='black')
+        ax.set_facecolor('black')
+        ax.legend()
+
+    plt.tight_layout()
+    plt.show()
+
+
+# MAIN
+if __name__ == '__main__':
+    save_path = os.path.join(NEW_DIR, JOINT_HISTOGRAMS_NAME)
+    # Totals of the last run, completed with the patients added to the cohort since
+    histograms = CohortJointHistograms.load(save_path) if os.path.exists(save_path) else None
+    histograms = compute_cohort_joint_histograms(NEW_DIR, save_path, histograms)
+
+    for mri_type in INPUT_MRI:
+        for region in JOINT_REGIONS:
+            plot_cohort_joint_histograms(histograms, mri_type, region)
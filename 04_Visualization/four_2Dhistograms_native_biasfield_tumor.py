@@ -2,6 +2,8 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 
+from Models.array_bundle import load_patient_array
+
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 INPUT_MRI = "T1", "T1c", "T2", "FLAIR"
 
@@ -74,16 +76,13 @@ def compute_all_scatterplots_mri_type(new_dir_path, patient_dir_name_nifti, mri_
         return
     patient_dir_name = patient_dir_name_nifti.split("_")[0]
     # Native image
-    native_image_array_path = os.path.join(array_dir_path, f'{patient_dir_name}_{mri_type}_rescaled.npy')
-    native_image_array = np.load(native_image_array_path).astype(np.float32)
+    native_image_array = load_patient_array(array_dir_path, patient_dir_name, f'{patient_dir_name}_{mri_type}_rescaled')
 
     # Brain segmentation
-    brain_seg_array_path = os.path.join(array_dir_path, f'{patient_dir_name}_brain_segmentation_array.npy')
-    brain_seg_array = np.load(brain_seg_array_path).astype(np.float32)
+    brain_seg_array = load_patient_array(array_dir_path, patient_dir_name, f'{patient_dir_name}_brain_segmentation_array').astype(np.float32)
 
     # Tumor segmentation
-    tumor_bin_array_path = os.path.join(array_dir_path, f'{patient_dir_name}_tumor_binary_array.npy')
-    tumor_bin_array = np.load(tumor_bin_array_path).astype(np.float32)
+    tumor_bin_array = load_patient_array(array_dir_path, patient_dir_name, f'{patient_dir_name}_tumor_binary_array').astype(np.float32)
 
     # Biasfield images
     bias_n4_brain_name = f'biasfield_{patient_dir_name}_{mri_type}_N4_brain_rescaled'
@@ -91,16 +90,11 @@ def compute_all_scatterplots_mri_type(new_dir_path, patient_dir_name_nifti, mri_
     bias_n4_brain_healthy_name = f'biasfield_{patient_dir_name}_{mri_type}_N4_brain_healthy_mask_rescaled'
     bias_n4_healthy_brain_name = f'biasfield_{patient_dir_name}_{mri_type}_N4_healthy_mask_brain_rescaled'
 
-    # Paths of the arrays
-    bias_n4_brain_path = os.path.join(array_dir_path, f'{bias_n4_brain_name}.npy')
-    bias_n4_healthy_path = os.path.join(array_dir_path, f'{bias_n4_healthy_name}.npy')
-    bias_n4_brain_healthy_path = os.path.join(array_dir_path, f'{bias_n4_brain_healthy_name}.npy')
-    bias_n4_healthy_brain_path = os.path.join(array_dir_path, f'{bias_n4_healthy_brain_name}.npy')
-
-    bias_n4_brain_array = np.load(bias_n4_brain_path).astype(np.float32)
-    bias_n4_healthy_array = np.load(bias_n4_healthy_path).astype(np.float32)
-    bias_n4_brain_healthy_array = np.load(bias_n4_brain_healthy_path).astype(np.float32)
-    bias_n4_healthy_brain_array = np.load(bias_n4_healthy_brain_path).astype(np.float32)
+    # Kept as uint16 memmaps, no float copies
+    bias_n4_brain_array = load_patient_array(array_dir_path, patient_dir_name, bias_n4_brain_name)
+    bias_n4_healthy_array = load_patient_array(array_dir_path, patient_dir_name, bias_n4_healthy_name)
+    bias_n4_brain_healthy_array = load_patient_array(array_dir_path, patient_dir_name, bias_n4_brain_healthy_name)
+    bias_n4_healthy_brain_array = load_patient_array(array_dir_path, patient_dir_name, bias_n4_healthy_brain_name)
 
     bias_n4_brain_nameplot = f'Patient {patient_number}: N4 w Brain on Brain'
     bias_n4_healthy_nameplot = f'Patient {patient_number}: N4 w Healthy Brain on Healthy Brain'
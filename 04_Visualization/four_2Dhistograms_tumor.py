@@ -3,6 +3,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from scipy.spatial import cKDTree
 
+from Models.array_bundle import load_patient_array
+
 
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 INPUT_MRI = "T1", "T1c", "T2", "FLAIR"
@@ -94,12 +96,10 @@ def compute_all_scatterplots_mri_type(new_dir_path, patient_dir_name_nifti, mri_
     native_image_array = np.load(native_image_array_path).astype(np.float32)
 
     # Brain segmentation
-    brain_seg_array_path = os.path.join(array_dir_path, f'{patient_dir_name}_brain_segmentation_array.npy')
-    brain_seg_array = np.load(brain_seg_array_path).astype(np.float32)
+    brain_seg_array = load_patient_array(array_dir_path, patient_dir_name, f'{patient_dir_name}_brain_segmentation_array').astype(np.float32)
 
     # Tumor mask
-    tumor_binary_array_path = os.path.join(array_dir_path, f'{patient_dir_name}_tumor_binary_array.npy')
-    tumor_binary_array = np.load(tumor_binary_array_path).astype(np.float32)
+    tumor_binary_array = load_patient_array(array_dir_path, patient_dir_name, f'{patient_dir_name}_tumor_binary_array').astype(np.float32)
 
     # Biasfield images
     bias_n4_brain_name = f'biasfield_{patient_dir_name}_{mri_type}_N4_brain_rescaled'
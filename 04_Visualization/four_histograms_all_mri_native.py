@@ -2,6 +2,10 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 
+from Models.array_bundle import load_patient_array
+from Models.histograms import bin_edges, volume_histograms
+from Models.masks import mask_indices
+
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 
 
@@ -44,21 +48,16 @@ def calculate_patient_histograms_native_tumor(patient_number, patient_folder_nam
         mri_t2_name_plot = f"Patient {patient_number}: T2"
         mri_flair_name_plot = f"Patient {patient_number}: FLAIR"
 
-        array_t1_tumor = array_t1 * array_tumor_binary
-        array_t1c_tumor = array_t1c * array_tumor_binary
-        array_t2_tumor = array_t2 * array_tumor_binary
-        array_flair_tumor = array_flair * array_tumor_binary
-
+        # One bincount pass per volume, the tumor histograms binning only the tumor voxels
+        tumor_index = mask_indices(array_tumor_binary)
+        bins = bin_edges(bins_number)
+        bins_mri_t1 = bins_mri_t1c = bins_mri_t2 = bins_mri_flair = bins
+        bins_tumor_t1 = bins_tumor_t1c = bins_tumor_t2 = bins_tumor_flair = bins
 
-        hist_mri_t1, bins_mri_t1 = np.histogram(array_t1, bins=bins_number, range=(0, 65536))
-        hist_mri_t1c, bins_mri_t1c = np.histogram(array_t1c, bins=bins_number, range=(0, 65536))
-        hist_mri_t2, bins_mri_t2 = np.histogram(array_t2, bins=bins_number, range=(0, 65536))
-        hist_mri_flair, bins_mri_flair = np.histogram(array_flair, bins=bins_number, range=(0, 65536))
-
-        hist_tumor_t1, bins_tumor_t1 = np.histogram(array_t1_tumor, bins=bins_number, range=(0, 65536))
-        hist_tumor_t1c, bins_tumor_t1c = np.histogram(array_t1c_tumor, bins=bins_number, range=(0, 65536))
-        hist_tumor_t2, bins_tumor_t2 = np.histogram(array_t2_tumor, bins=bins_number, range=(0, 65536))
-        hist_tumor_flair, bins_tumor_flair = np.histogram(array_flair_tumor, bins=bins_number, range=(0, 65536))
+        hist_mri_t1, hist_tumor_t1 = volume_histograms(array_t1, tumor_index, bins_number)
+        hist_mri_t1c, hist_tumor_t1c = volume_histograms(array_t1c, tumor_index, bins_number)
+        hist_mri_t2, hist_tumor_t2 = volume_histograms(array_t2, tumor_index, bins_number)
+        hist_mri_flair, hist_tumor_flair = volume_histograms(array_flair, tumor_index, bins_number)
 
         fig, axs = plt.subplots(2, 2, figsize=(12, 10))
         plot_ax_mri_type(hist_mri_t1, bins_mri_t1, hist_tumor_t1, bins_tumor_t1, mri_t1_name_plot, ax = axs[0,0])
@@ -76,24 +75,18 @@ def load_array_from_dir_patient(new_dir_path, patient_dir_name_nifti, patient_nu
         return
     patient_dir_name = patient_dir_name_nifti.split("_")[0]
 
-    tumor_binary_array_path = os.path.join(array_dir_path, f'{patient_dir_name}_tumor_binary_array.npy')
-    tumor_binary_array = np.load(tumor_binary_array_path).astype(np.float32)
+    tumor_binary_array = load_patient_array(array_dir_path, patient_dir_name, f'{patient_dir_name}_tumor_binary_array')
 
     mri_t1_name = f"{patient_dir_name}_T1_rescaled"
     mri_t1c_name = f"{patient_dir_name}_T1c_rescaled"
     mri_t2_name = f"{patient_dir_name}_T2_rescaled"
     mri_flair_name = f"{patient_dir_name}_FLAIR_rescaled"
 
-    # Paths of the arrays
-    mri_t1_path = os.path.join(array_dir_path, f'{mri_t1_name}.npy')
-    mri_t1c_path = os.path.join(array_dir_path, f'{mri_t1c_name}.npy')
-    mri_t2_path = os.path.join(array_dir_path, f'{mri_t2_name}.npy')
-    mri_flair_path = os.path.join(array_dir_path, f'{mri_flair_name}.npy')
-
-    mri_t1_array = np.load(mri_t1_path).astype(np.float32)
-    mri_t1c_array = np.load(mri_t1c_path).astype(np.float32)
-    mri_t2_array = np.load(mri_t2_path).astype(np.float32)
-    mri_flair_array = np.load(mri_flair_path).astype(np.float32)
+    # Kept as uint16 memmaps, the histograms bin the integer values directly
+    mri_t1_array = load_patient_array(array_dir_path, patient_dir_name, mri_t1_name)
+    mri_t1c_array = load_patient_array(array_dir_path, patient_dir_name, mri_t1c_name)
+    mri_t2_array = load_patient_array(array_dir_path, patient_dir_name, mri_t2_name)
+    mri_flair_array = load_patient_array(array_dir_path, patient_dir_name, mri_flair_name)
 
     return mri_t1_array, mri_t1c_array, mri_t2_array, mri_flair_array, tumor_binary_array
 
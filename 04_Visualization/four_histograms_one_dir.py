@@ -3,6 +3,10 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 
+from Models.array_bundle import load_patient_array
+from Models.histograms import bin_edges, volume_histograms
+from Models.masks import mask_indices
+
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 INPUT_MRI = "T1", "T1c", "T2", "FLAIR"
 
@@ -36,11 +40,13 @@ def get_patients_number():
             print("Invalid input. Please enter a number.")
 
 def calculate_tumor_histogram(mri_n4_fname: str, array_mri_n4: np.array, array_tumor_binary: np.array, bins_number=655,
-                              display=False, save=False, ax=None):
-    array_tumor_n4 = np.multiply(array_mri_n4,array_tumor_binary)
+                              display=False, save=False, ax=None, tumor_index=None):
+    if tumor_index is None:
+        tumor_index = mask_indices(array_tumor_binary)
 
-    hist_mri_n4, bins_mri_n4 = np.histogram(array_mri_n4, bins=bins_number, range=(0, 65536))
-    hist_tumor_n4, bins_tumor_n4 = np.histogram(array_tumor_n4, bins=bins_number, range=(0, 65536))
+    # Histograms of the volume and of the volume * tumor mask, in one bincount pass
+    hist_mri_n4, hist_tumor_n4 = volume_histograms(array_mri_n4, tumor_index, bins_number)
+    bins_mri_n4 = bins_tumor_n4 = bin_edges(bins_number)
     print('Checking >1 voxels')
     area_tumor = np.sum(array_tumor_binary[array_tumor_binary > 1])  # Sum only non-zero voxels
     print('>1 voxels:' , area_tumor)
@@ -74,24 +80,19 @@ def calculate_all_histograms_mri_type(new_dir_path, patient_dir_name_nifti, mri_
         return
     patient_dir_name = patient_dir_name_nifti.split("_")[0]
 
-    tumor_binary_array_path = os.path.join(array_dir_path, f'{patient_dir_name}_tumor_binary_array.npy')
-    tumor_binary_array = np.load(tumor_binary_array_path).astype(np.float32)
+    tumor_binary_array = load_patient_array(array_dir_path, patient_dir_name, f'{patient_dir_name}_tumor_binary_array')
+    tumor_index = mask_indices(tumor_binary_array)
 
     mri_n4_brain_name = f'{patient_dir_name}_{mri_type}_N4_brain_rescaled'
     mri_n4_healthy_name = f'{patient_dir_name}_{mri_type}_N4_healthy_mask_rescaled'
     mri_n4_brain_healthy_name = f'{patient_dir_name}_{mri_type}_N4_brain_healthy_mask_rescaled'
     mri_n4_healthy_brain_name = f'{patient_dir_name}_{mri_type}_N4_healthy_mask_brain_rescaled'
 
-    # Paths of the arrays
-    mri_n4_brain_path = os.path.join(array_dir_path, f'{mri_n4_brain_name}.npy')
-    mri_n4_healthy_path = os.path.join(array_dir_path, f'{mri_n4_healthy_name}.npy')
-    mri_n4_brain_healthy_path = os.path.join(array_dir_path, f'{mri_n4_brain_healthy_name}.npy')
-    mri_n4_healthy_brain_path = os.path.join(array_dir_path, f'{mri_n4_healthy_brain_name}.npy')
-
-    mri_n4_brain_array = np.load(mri_n4_brain_path).astype(np.float32)
-    mri_n4_healthy_array = np.load(mri_n4_healthy_path).astype(np.float32)
-    mri_n4_brain_healthy_array = np.load(mri_n4_brain_healthy_path).astype(np.float32)
-    mri_n4_healthy_brain_array = np.load(mri_n4_healthy_brain_path).astype(np.float32)
+    # Kept as uint16 memmaps, the histograms bin the integer values directly
+    mri_n4_brain_array = load_patient_array(array_dir_path, patient_dir_name, mri_n4_brain_name)
+    mri_n4_healthy_array = load_patient_array(array_dir_path, patient_dir_name, mri_n4_healthy_name)
+    mri_n4_brain_healthy_array = load_patient_array(array_dir_path, patient_dir_name, mri_n4_brain_healthy_name)
+    mri_n4_healthy_brain_array = load_patient_array(array_dir_path, patient_dir_name, mri_n4_healthy_brain_name)
 
     mri_n4_brain_nameplot = f'Patient {patient_number}: N4 w Brain on Brain'
     mri_n4_healthy_nameplot = f'Patient {patient_number}: N4 w Healthy Brain on Healthy Brain'
@@ -99,10 +100,10 @@ def calculate_all_histograms_mri_type(new_dir_path, patient_dir_name_nifti, mri_
     mri_n4_healthy_brain_nameplot = f'Patient {patient_number}: N4 w Healthy Brain on Brain'
 
     fig, axs = plt.subplots(2, 2, figsize=(12,10))
-    calculate_tumor_histogram(mri_n4_brain_nameplot,mri_n4_brain_array,tumor_binary_array, display=display, save=save, ax = axs[0,0])
-    calculate_tumor_histogram(mri_n4_healthy_nameplot,mri_n4_healthy_array,tumor_binary_array, display=display, save=save, ax = axs[0,1])
-    calculate_tumor_histogram(mri_n4_brain_healthy_nameplot,mri_n4_brain_healthy_array,tumor_binary_array, display=display, save=save, ax = axs[1,0])
-    calculate_tumor_histogram(mri_n4_healthy_brain_nameplot,mri_n4_healthy_brain_array,tumor_binary_array, display=display, save=save, ax = axs[1,1])
+    calculate_tumor_histogram(mri_n4_brain_nameplot,mri_n4_brain_array,tumor_binary_array, display=display, save=save, tumor_index=tumor_index, ax = axs[0,0])
+    calculate_tumor_histogram(mri_n4_healthy_nameplot,mri_n4_healthy_array,tumor_binary_array, display=display, save=save, tumor_index=tumor_index, ax = axs[0,1])
+    calculate_tumor_histogram(mri_n4_brain_healthy_nameplot,mri_n4_brain_healthy_array,tumor_binary_array, display=display, save=save, tumor_index=tumor_index, ax = axs[1,0])
+    calculate_tumor_histogram(mri_n4_healthy_brain_nameplot,mri_n4_healthy_brain_array,tumor_binary_array, display=display, save=save, tumor_index=tumor_index, ax = axs[1,1])
 
 def continue_main_for_new_patient(NEW_DIR, folder_name, mri_type, patient_number, display=True, save=False):
     user_ans = user_continue_ans('YN')
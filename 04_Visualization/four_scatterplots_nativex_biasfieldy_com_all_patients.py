@@ -2,6 +2,9 @@ import numpy as np
 import os
 import matplotlib.pyplot as plt
 
+from Models.array_bundle import load_patient_array
+from Models.region_index import compute_region_indices, gather, get_region_indices
+
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 CONTROL1 = "UCSF-PDGM-"
 MRI_TYPE = ["T1", "T1c", "T2", "FLAIR"]
@@ -22,12 +25,11 @@ def get_user_answer(INPUT_MRI):
     return valid_answers[user_ans]  # Return the correctly formatted value (T1/T1c/T2/FLAIR)
 
 # For each corrected image compute COM brain and COM tumor
-def compute_center_of_mass_regions(array_mri: np.ndarray, array_biasfield: np.ndarray, brain_seg_array: np.ndarray, tumor_mask_array: np.ndarray, bins: int = 100):
+def compute_center_of_mass_regions(array_mri: np.ndarray, array_biasfield: np.ndarray, brain_seg_array: np.ndarray = None, tumor_mask_array: np.ndarray = None, bins: int = 100, regions: dict = None):
 
-    # Masks
-    valid_mask = array_mri > 0
-    tumor_mask = (tumor_mask_array > 0) & valid_mask
-    brain_only_mask = (brain_seg_array > 0) & (~tumor_mask) & valid_mask
+    # Voxel indices of the brain-only and tumor regions, precomputed once per patient (Models.region_index)
+    if regions is None:
+        regions = compute_region_indices(brain_seg_array, tumor_mask_array)
 
     def compute_center_of_mass(x, y, bins=100):
         if len(x) == 0 or len(y) == 0:
@@ -44,10 +46,12 @@ def compute_center_of_mass_regions(array_mri: np.ndarray, array_biasfield: np.nd
         return (com_x, com_y)
 
     # Extract values for each region
-    x_brain = array_mri[brain_only_mask]
-    y_brain = array_biasfield[brain_only_mask]
-    x_tumor = array_mri[tumor_mask]
-    y_tumor = array_biasfield[tumor_mask]
+    x_brain = gather(array_mri, regions["healthy"])
+    y_brain = gather(array_biasfield, regions["healthy"])[x_brain > 0]
+    x_brain = x_brain[x_brain > 0]
+    x_tumor = gather(array_mri, regions["tumor"])
+    y_tumor = gather(array_biasfield, regions["tumor"])[x_tumor > 0]
+    x_tumor = x_tumor[x_tumor > 0]
 
     # Compute CoM for brain-only and tumor-only
     com_brain = compute_center_of_mass(x_brain, y_brain, bins=bins)
@@ -63,17 +67,11 @@ def compute_all_com_mri_type(new_dir_path, patient_dir_name_nifti, mri_type:str,
         print(f"Directory {patient_dir_path} does not exist")
         return
     patient_dir_name = patient_dir_name_nifti.split("_")[0]
-    # Native image
-    native_image_array_path = os.path.join(array_dir_path, f'{patient_dir_name}_{mri_type}_rescaled.npy')
-    native_image_array = np.load(native_image_array_path).astype(np.float32)
-
-    # Brain segmentation
-    brain_seg_array_path = os.path.join(array_dir_path, f'{patient_dir_name}_brain_segmentation_array.npy')
-    brain_seg_array = np.load(brain_seg_array_path).astype(np.float32)
+    # Native image, memory mapped: only the region voxels are read
+    native_image_array = load_patient_array(array_dir_path, patient_dir_name, f'{patient_dir_name}_{mri_type}_rescaled')
 
-    # Tumor mask
-    tumor_binary_array_path = os.path.join(array_dir_path, f'{patient_dir_name}_tumor_binary_array.npy')
-    tumor_binary_array = np.load(tumor_binary_array_path).astype(np.float32)
+    # Brain-only and tumor voxel indices, instead of the brain segmentation and tumor mask
+    regions = get_region_indices(array_dir_path, patient_dir_name)
 
     # Biasfield images
     bias_n4_brain_name = f'biasfield_{patient_dir_name}_{mri_type}_N4_brain_rescaled'
@@ -81,16 +79,10 @@ def compute_all_com_mri_type(new_dir_path, patient_dir_name_nifti, mri_type:str,
     bias_n4_brain_healthy_name = f'biasfield_{patient_dir_name}_{mri_type}_N4_brain_healthy_mask_rescaled'
     bias_n4_healthy_brain_name = f'biasfield_{patient_dir_name}_{mri_type}_N4_healthy_mask_brain_rescaled'
 
-    # Paths of the arrays
-    bias_n4_brain_path = os.path.join(array_dir_path, f'{bias_n4_brain_name}.npy')
-    bias_n4_healthy_path = os.path.join(array_dir_path, f'{bias_n4_healthy_name}.npy')
-    bias_n4_brain_healthy_path = os.path.join(array_dir_path, f'{bias_n4_brain_healthy_name}.npy')
-    bias_n4_healthy_brain_path = os.path.join(array_dir_path, f'{bias_n4_healthy_brain_name}.npy')
-
-    bias_n4_brain_array = np.load(bias_n4_brain_path).astype(np.float32)
-    bias_n4_healthy_array = np.load(bias_n4_healthy_path).astype(np.float32)
-    bias_n4_brain_healthy_array = np.load(bias_n4_brain_healthy_path).astype(np.float32)
-    bias_n4_healthy_brain_array = np.load(bias_n4_healthy_brain_path).astype(np.float32)
+    bias_n4_brain_array = load_patient_array(array_dir_path, patient_dir_name, bias_n4_brain_name)
+    bias_n4_healthy_array = load_patient_array(array_dir_path, patient_dir_name, bias_n4_healthy_name)
+    bias_n4_brain_healthy_array = load_patient_array(array_dir_path, patient_dir_name, bias_n4_brain_healthy_name)
+    bias_n4_healthy_brain_array = load_patient_array(array_dir_path, patient_dir_name, bias_n4_healthy_brain_name)
 
     bias_n4_brain_nameplot = f'Patient_{patient_number}_N4BB'
     bias_n4_healthy_nameplot = f'Patient_{patient_number}_N4HH'
@@ -99,20 +91,16 @@ def compute_all_com_mri_type(new_dir_path, patient_dir_name_nifti, mri_type:str,
 
     com_brain_bb, com_tumor_bb = compute_center_of_mass_regions(native_image_array,
                                                                 bias_n4_brain_array,
-                                                                brain_seg_array,
-                                                                tumor_binary_array)
+                                                                regions=regions)
     com_brain_hh, com_tumor_hh = compute_center_of_mass_regions(native_image_array,
                                                                 bias_n4_healthy_array,
-                                                                brain_seg_array,
-                                                                tumor_binary_array)
+                                                                regions=regions)
     com_brain_bh, com_tumor_bh = compute_center_of_mass_regions(native_image_array,
                                                                 bias_n4_brain_healthy_array,
-                                                                brain_seg_array,
-                                                                tumor_binary_array)
+                                                                regions=regions)
     com_brain_hb, com_tumor_hb = compute_center_of_mass_regions(native_image_array,
                                                                 bias_n4_healthy_brain_array,
-                                                                brain_seg_array,
-                                                                tumor_binary_array)
+                                                                regions=regions)
     com_bb = {bias_n4_brain_nameplot: (com_brain_bb, com_tumor_bb),}
     com_hh = {bias_n4_healthy_nameplot: (com_brain_hh, com_tumor_hh)}
     com_bh = {bias_n4_brain_healthy_nameplot: (com_brain_bh, com_tumor_bh)}
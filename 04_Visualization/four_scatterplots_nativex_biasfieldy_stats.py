@@ -6,10 +6,17 @@ import scikit_posthocs as sp
 import pandas as pd
 import concurrent.futures
 
+from Models.array_bundle import load_patient_array
+from Models.cohort_results import CohortResults, make_rows
+from Models.metrics_cache import get_metrics_db_path, get_or_compute_metrics
+from Models.region_index import compute_region_indices, gather, get_region_indices
+
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 CONTROL1 = "UCSF-PDGM-"
 MRI_TYPE = ["T1", "T1c", "T2", "FLAIR"]
 BIASFIELD = ["N4BB", "N4HH", "N4BH", "N4HB"]
+# Names of the brain and tumor CoM coordinates in the metrics cache
+COM_METRICS = ("com_brain_x", "com_brain_y", "com_tumor_x", "com_tumor_y")
 
 # ---------------------- User Input ----------------------
 def get_user_answer(INPUT_MRI):
@@ -21,10 +28,10 @@ def get_user_answer(INPUT_MRI):
     return valid_answers[user_ans]
 
 # ---------------------- CoM Calculation ----------------------
-def compute_center_of_mass_regions(array_mri, array_biasfield, brain_seg_array, tumor_mask_array, bins=100):
-    valid_mask = array_mri > 0
-    tumor_mask = (tumor_mask_array > 0) & valid_mask
-    brain_only_mask = (brain_seg_array > 0) & (~tumor_mask) & valid_mask
+def compute_center_of_mass_regions(array_mri, array_biasfield, brain_seg_array=None, tumor_mask_array=None, bins=100, regions=None):
+    # Voxel indices of the brain-only and tumor regions, precomputed once per patient (Models.region_index)
+    if regions is None:
+        regions = compute_region_indices(brain_seg_array, tumor_mask_array)
 
     def compute_center_of_mass(x, y, bins=100):
         if len(x) == 0 or len(y) == 0:
@@ -40,10 +47,12 @@ def compute_center_of_mass_regions(array_mri, array_biasfield, brain_seg_array,
         com_y = (Y * hist).sum() / total
         return (com_x, com_y)
 
-    x_brain = array_mri[brain_only_mask]
-    y_brain = array_biasfield[brain_only_mask]
-    x_tumor = array_mri[tumor_mask]
-    y_tumor = array_biasfield[tumor_mask]
+    x_brain = gather(array_mri, regions["healthy"])
+    y_brain = gather(array_biasfield, regions["healthy"])[x_brain > 0]
+    x_brain = x_brain[x_brain > 0]
+    x_tumor = gather(array_mri, regions["tumor"])
+    y_tumor = gather(array_biasfield, regions["tumor"])[x_tumor > 0]
+    x_tumor = x_tumor[x_tumor > 0]
 
     com_brain = compute_center_of_mass(x_brain, y_brain, bins=bins)
     com_tumor = compute_center_of_mass(x_tumor, y_tumor, bins=bins)
@@ -57,26 +66,36 @@ def compute_all_com_mri_type(new_dir_path, patient_dir_name_nifti, mri_type, pat
         return
 
     patient_dir_name = patient_dir_name_nifti.split("_")[0]
-
-    # Load native MRI
-    native_image_array = np.load(os.path.join(array_dir_path, f'{patient_dir_name}_{mri_type}_rescaled.npy')).astype(np.float32)
-    brain_seg_array = np.load(os.path.join(array_dir_path, f'{patient_dir_name}_brain_segmentation_array.npy')).astype(np.float32)
-    tumor_binary_array = np.load(os.path.join(array_dir_path, f'{patient_dir_name}_tumor_binary_array.npy')).astype(np.float32)
-
-    # Load all 4 biasfield arrays
+    native_name = f'{patient_dir_name}_{mri_type}_rescaled'
     biasfield_names = {
-        'N4BB': f'biasfield_{patient_dir_name}_{mri_type}_N4_brain_rescaled.npy',
-        'N4HH': f'biasfield_{patient_dir_name}_{mri_type}_N4_healthy_mask_rescaled.npy',
-        'N4BH': f'biasfield_{patient_dir_name}_{mri_type}_N4_brain_healthy_mask_rescaled.npy',
-        'N4HB': f'biasfield_{patient_dir_name}_{mri_type}_N4_healthy_mask_brain_rescaled.npy'
+        'N4BB': f'biasfield_{patient_dir_name}_{mri_type}_N4_brain_rescaled',
+        'N4HH': f'biasfield_{patient_dir_name}_{mri_type}_N4_healthy_mask_rescaled',
+        'N4BH': f'biasfield_{patient_dir_name}_{mri_type}_N4_brain_healthy_mask_rescaled',
+        'N4HB': f'biasfield_{patient_dir_name}_{mri_type}_N4_healthy_mask_brain_rescaled'
     }
-
+    sources = [native_name, *biasfield_names.values(),
+               f'{patient_dir_name}_brain_segmentation_array', f'{patient_dir_name}_tumor_binary_array']
+
+    def compute_coms():
+        # Load native MRI
+        native_image_array = load_patient_array(array_dir_path, patient_dir_name, native_name)
+        regions = get_region_indices(array_dir_path, patient_dir_name)
+
+        # Load all 4 biasfield arrays
+        metrics = {}
+        for key, name in biasfield_names.items():
+            bias_array = load_patient_array(array_dir_path, patient_dir_name, name)
+            com_brain, com_tumor = compute_center_of_mass_regions(native_image_array, bias_array, regions=regions)
+            metrics.update({(key, metric): float(value) for metric, value in zip(COM_METRICS, (*com_brain, *com_tumor))})
+        return metrics
+
+    # Only recomputed when one of the source arrays changed
+    metrics = get_or_compute_metrics(get_metrics_db_path(new_dir_path), array_dir_path, patient_dir_name, mri_type,
+                                     COM_METRICS, sources, compute_coms)
     all_com_patient = {}
-    for key, filename in biasfield_names.items():
-        path = os.path.join(array_dir_path, filename)
-        bias_array = np.load(path).astype(np.float32)
-        com_brain, com_tumor = compute_center_of_mass_regions(native_image_array, bias_array, brain_seg_array, tumor_binary_array)
-        all_com_patient[f'Patient_{patient_number}_{key}'] = (com_brain, com_tumor)
+    for key in biasfield_names:
+        com_brain_x, com_brain_y, com_tumor_x, com_tumor_y = (metrics[(key, metric)] for metric in COM_METRICS)
+        all_com_patient[key] = ((com_brain_x, com_brain_y), (com_tumor_x, com_tumor_y))
 
     return all_com_patient
 
@@ -87,11 +106,18 @@ def process_patient(folder, new_dir, mri_type):
         print(f"Array directory missing for patient {patient_number}")
         return patient_number, None
     try:
-        result = compute_all_com_mri_type(new_dir, folder, mri_type, patient_number)
-        return patient_number, result
+        all_com_patient = compute_all_com_mri_type(new_dir, folder, mri_type, patient_number)
     except Exception as e:
         print(f"Error processing patient {patient_number}: {e}")
         return patient_number, None
+    if all_com_patient is None:
+        return patient_number, None
+    # One row per correction, region and axis of the cohort results table
+    rows = make_rows((patient_number, mri_type, correction, region, metric, value)
+                     for correction, coms in all_com_patient.items()
+                     for region, com in zip(("brain", "tumor"), coms)
+                     for metric, value in zip(("com_x", "com_y"), com))
+    return patient_number, rows
 
 def compute_coms_all_patients(NEW_DIR, mri_type):
     patient_folders = [
@@ -99,61 +125,33 @@ def compute_coms_all_patients(NEW_DIR, mri_type):
         if os.path.isdir(os.path.join(NEW_DIR, folder)) and folder.startswith(CONTROL1)
     ]
 
-    all_com_bb, all_com_hh, all_com_bh, all_com_hb = {}, {}, {}, {}
+    results = CohortResults()
 
     with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = [executor.submit(process_patient, folder) for folder in patient_folders]
+        futures = [executor.submit(process_patient, folder, NEW_DIR, mri_type) for folder in patient_folders]
         for future in concurrent.futures.as_completed(futures):
-            patient_number, all_com_patient = future.result()
-            if all_com_patient is None:
-                continue
-            for correction in all_com_patient:
-                if 'N4BB' in correction:
-                    all_com_bb[patient_number] = all_com_patient[correction]
-                elif 'N4HH' in correction:
-                    all_com_hh[patient_number] = all_com_patient[correction]
-                elif 'N4BH' in correction:
-                    all_com_bh[patient_number] = all_com_patient[correction]
-                elif 'N4HB' in correction:
-                    all_com_hb[patient_number] = all_com_patient[correction]
-
-    return all_com_bb, all_com_hh, all_com_bh, all_com_hb
-
-# ---------------------- Extract x/y ----------------------
-def extract_x_y_all_groups(all_com_bb, all_com_hh, all_com_bh, all_com_hb):
-    def extract_xy(com_dict):
-        x_brain, y_brain, x_tumor, y_tumor = [], [], [], []
-        for patient_id, (com_brain, com_tumor) in com_dict.items():
-            if not (np.isnan(com_brain[0]) or np.isnan(com_brain[1])):
-                x_brain.append(com_brain[0])
-                y_brain.append(com_brain[1])
-            if not (np.isnan(com_tumor[0]) or np.isnan(com_tumor[1])):
-                x_tumor.append(com_tumor[0])
-                y_tumor.append(com_tumor[1])
-        return (np.array(x_brain), np.array(y_brain)), (np.array(x_tumor), np.array(y_tumor))
-
-    (x_brain_bb, y_brain_bb), (x_tumor_bb, y_tumor_bb) = extract_xy(all_com_bb)
-    (x_brain_hh, y_brain_hh), (x_tumor_hh, y_tumor_hh) = extract_xy(all_com_hh)
-    (x_brain_bh, y_brain_bh), (x_tumor_bh, y_tumor_bh) = extract_xy(all_com_bh)
-    (x_brain_hb, y_brain_hb), (x_tumor_hb, y_tumor_hb) = extract_xy(all_com_hb)
-
-    results = {
-        "brain": {
-            "N4BB": (x_brain_bb, y_brain_bb),
-            "N4HH": (x_brain_hh, y_brain_hh),
-            "N4BH": (x_brain_bh, y_brain_bh),
-            "N4HB": (x_brain_hb, y_brain_hb),
-        },
-        "tumor": {
-            "N4BB": (x_tumor_bb, y_tumor_bb),
-            "N4HH": (x_tumor_hh, y_tumor_hh),
-            "N4BH": (x_tumor_bh, y_tumor_bh),
-            "N4HB": (x_tumor_hb, y_tumor_hb),
-        },
-    }
+            patient_number, rows = future.result()
+            if rows is not None:
+                results.extend(rows)
 
     return results
 
+# ---------------------- Extract x/y ----------------------
+def get_com_xy(results, correction, region):
+    """x and y CoM columns of one correction and region, in the same patient order."""
+    return (results.values(variant=correction, region=region, metric="com_x"),
+            results.values(variant=correction, region=region, metric="com_y"))
+
+def extract_x_y_all_groups(results):
+    com_data = {}
+    for region in ("brain", "tumor"):
+        com_data[region] = {}
+        for correction in BIASFIELD:
+            x_vals, y_vals = get_com_xy(results, correction, region)
+            valid = ~(np.isnan(x_vals) | np.isnan(y_vals))
+            com_data[region][correction] = (x_vals[valid], y_vals[valid])
+    return com_data
+
 # ---------------------- Kruskal–Wallis ----------------------
 def kruskal_wallis_com_test(com_data, region="brain", axis="x"):
     if region not in com_data:
@@ -188,27 +186,23 @@ def kruskal_wallis_com_test(com_data, region="brain", axis="x"):
     return {"H": H, "p": p, "posthoc": posthoc}
 
 # ---------------------- Plotting ----------------------
-def plot_coms_for_all_patients(all_com_bb, all_com_hh, all_com_bh, all_com_hb):
+def plot_coms_for_all_patients(results):
     fig, axes = plt.subplots(2, 2, figsize=(14, 12))
     axes = axes.ravel()
     corrections = ['N4BB', 'N4HH', 'N4BH', 'N4HB']
-    all_com_dicts = [all_com_bb, all_com_hh, all_com_bh, all_com_hb]
     colors = {'brain': 'blue', 'tumor': 'red'}
 
-    for i, (correction, com_dict) in enumerate(zip(corrections, all_com_dicts)):
+    for i, correction in enumerate(corrections):
         ax = axes[i]
-        brain_points = [v[0] for v in com_dict.values()]
-        tumor_points = [v[1] for v in com_dict.values()]
+        x_brain, y_brain = get_com_xy(results, correction, "brain")
+        x_tumor, y_tumor = get_com_xy(results, correction, "tumor")
 
-        brain_points = np.array(brain_points)
-        tumor_points = np.array(tumor_points)
-
-        if len(brain_points) == 0 or len(tumor_points) == 0:
+        if len(x_brain) == 0 or len(x_tumor) == 0:
             ax.set_title(f'CoM Scatterplot: {correction} (no valid data)')
             continue
 
-        ax.scatter(brain_points[:, 0], brain_points[:, 1], color=colors['brain'], label='Brain-only', alpha=0.6)
-        ax.scatter(tumor_points[:, 0], tumor_points[:, 1], color=colors['tumor'], label='Tumor-only', alpha=0.6)
+        ax.scatter(x_brain, y_brain, color=colors['brain'], label='Brain-only', alpha=0.6)
+        ax.scatter(x_tumor, y_tumor, color=colors['tumor'], label='Tumor-only', alpha=0.6)
 
         ax.set_title(f'CoM Scatterplot: {correction}')
         ax.set_xlabel('Native MRI intensity')
@@ -227,42 +221,14 @@ if __name__ == '__main__':
     # Ask user which MRI type to analyze
     mri_type = get_user_answer(MRI_TYPE)
 
-    # Collect all patient folders
-    patient_folders = [
-        folder for folder in os.listdir(NEW_DIR)
-        if os.path.isdir(os.path.join(NEW_DIR, folder)) and folder.startswith(CONTROL1)
-    ]
-
-    # Run in parallel using top-level function
-    all_results = []
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = [
-            executor.submit(process_patient, folder, NEW_DIR, mri_type)
-            for folder in patient_folders
-        ]
-        for future in concurrent.futures.as_completed(futures):
-            all_results.append(future.result())
-
-    # Merge results into separate dictionaries for each correction
-    all_com_bb, all_com_hh, all_com_bh, all_com_hb = {}, {}, {}, {}
-    for patient_number, all_com_patient in all_results:
-        if all_com_patient is None:
-            continue
-        for correction in all_com_patient:
-            if 'N4BB' in correction:
-                all_com_bb[patient_number] = all_com_patient[correction]
-            elif 'N4HH' in correction:
-                all_com_hh[patient_number] = all_com_patient[correction]
-            elif 'N4BH' in correction:
-                all_com_bh[patient_number] = all_com_patient[correction]
-            elif 'N4HB' in correction:
-                all_com_hb[patient_number] = all_com_patient[correction]
+    # Run in parallel, every patient adds its rows to the cohort results table
+    results = compute_coms_all_patients(NEW_DIR, mri_type)
 
     # Plot COM scatterplots
-    plot_coms_for_all_patients(all_com_bb, all_com_hh, all_com_bh, all_com_hb)
+    plot_coms_for_all_patients(results)
 
     # Extract x/y values for statistical testing
-    com_data = extract_x_y_all_groups(all_com_bb, all_com_hh, all_com_bh, all_com_hb)
+    com_data = extract_x_y_all_groups(results)
 
     # Run Kruskal–Wallis tests for brain and tumor, x and y axes
     kruskal_wallis_com_test(com_data, region="brain", axis="x")
@@ -2,6 +2,10 @@ import numpy as np
 import os
 import matplotlib.pyplot as plt
 
+from Models.array_bundle import get_array_source, load_patient_array
+from Models.metrics_cache import get_metrics_db_path, get_or_compute_metrics
+from Models.tumor_bbox import get_tumor_bbox, crop_to_bbox
+
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 CONTROL1 = "UCSF-PDGM-"
 MRI_TYPE = ["T1", "T1c", "T2", "FLAIR"]
@@ -11,10 +15,13 @@ N4_VARIANTS = [
     "N4_brain_rescaled",
     "N4_healthy_mask_rescaled"
 ]
+# Name of the median distance in the metrics cache, the tumor median here includes the zero voxels
+MEDIAN_METRIC = "median_distance_all_tumor_voxels"
 
-def compute_median_distance_histograms(array_whole_brain, array_tumor_binary):
+def compute_median_distance_histograms(array_whole_brain, array_tumor_binary, bbox=None):
     median_whole_brain = np.median(array_whole_brain[array_whole_brain > 0])
-    tumor_values = array_whole_brain[array_tumor_binary > 0]
+    # Tumor voxels are looked up in the tumor bounding box only
+    tumor_values = crop_to_bbox(array_whole_brain, bbox)[crop_to_bbox(array_tumor_binary, bbox) > 0]
     median_tumor = np.median(tumor_values)
     median_distance = median_whole_brain - median_tumor
     return median_distance, median_whole_brain, median_tumor
@@ -36,31 +43,40 @@ def compute_medians_all_patients(NEW_DIR):
                 print(f"Array directory missing for patient {patient_number}")
                 continue
 
-            tumor_binary_array = None
-            for file_ in os.listdir(array_dir):
-                if "tumor_binary" in file_:
-                    tumor_binary_array = np.load(os.path.join(array_dir, file_))
-                    break
-
-            if tumor_binary_array is None:
+            prefix = f"{CONTROL1}{patient_number}"
+            tumor_name = f"{prefix}_tumor_binary_array"
+            if not os.path.exists(get_array_source(array_dir, prefix, tumor_name)):
                 print(f"Tumor binary array not found for patient {patient_number}")
                 continue
+            tumor = {}  # mask and bounding box, loaded on the first metrics cache miss only
 
-            for mri_type in MRI_TYPE:
-                native_filename = f"{CONTROL1}{patient_number}_{mri_type}_rescaled.npy"
-                native_path = os.path.join(array_dir, native_filename)
-                if os.path.exists(native_path):
-                    array = np.load(native_path)
-                    median_distance, _, _ = compute_median_distance_histograms(array, tumor_binary_array)
-                    medians_native[mri_type].append(median_distance)
+            def compute_median_distances(names):
+                if not tumor:
+                    tumor["array"] = load_patient_array(array_dir, prefix, tumor_name)
+                    tumor["bbox"] = get_tumor_bbox(array_dir, prefix, tumor["array"])
+                metrics = {}
+                for variant, name in names:
+                    try:
+                        array = load_patient_array(array_dir, prefix, name)
+                    except FileNotFoundError:
+                        continue
+                    median_distance, _, _ = compute_median_distance_histograms(array, tumor["array"], bbox=tumor["bbox"])
+                    metrics[(variant, MEDIAN_METRIC)] = float(median_distance)
+                return metrics
 
-                for variant in N4_VARIANTS:
-                    n4_filename = f"{CONTROL1}{patient_number}_{mri_type}_{variant}.npy"
-                    n4_path = os.path.join(array_dir, n4_filename)
-                    if os.path.exists(n4_path):
-                        array = np.load(n4_path)
-                        median_distance, _, _ = compute_median_distance_histograms(array, tumor_binary_array)
-                        n4_medians[mri_type][variant].append(median_distance)
+            for mri_type in MRI_TYPE:
+                names = [("native", f"{prefix}_{mri_type}_rescaled")]
+                names += [(variant, f"{prefix}_{mri_type}_{variant}") for variant in N4_VARIANTS]
+                metrics = get_or_compute_metrics(get_metrics_db_path(NEW_DIR), array_dir, prefix, mri_type, [MEDIAN_METRIC],
+                                                 [name for _, name in names] + [tumor_name],
+                                                 lambda: compute_median_distances(names))
+                for variant, _ in names:
+                    if (variant, MEDIAN_METRIC) not in metrics:
+                        continue
+                    if variant == "native":
+                        medians_native[mri_type].append(metrics[(variant, MEDIAN_METRIC)])
+                    else:
+                        n4_medians[mri_type][variant].append(metrics[(variant, MEDIAN_METRIC)])
 
         # Create save directory
         save_dir = os.path.join(NEW_DIR, "00_UCSF_PDGM_violin_plot")
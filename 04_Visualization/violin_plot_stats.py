@@ -6,6 +6,11 @@ import scikit_posthocs as sp
 import pandas as pd
 from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from Models.array_bundle import get_array_source, load_patient_array
+from Models.cohort_results import CohortResults, make_rows
+from Models.metrics_cache import get_metrics_db_path, get_or_compute_metrics
+from Models.tumor_bbox import get_tumor_bbox, crop_to_bbox
+
 # === CONFIGURATION ===
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 CONTROL1 = "UCSF-PDGM-"
@@ -23,76 +28,72 @@ VARIANTS = {
     'N4_brain_healthy_mask_rescaled': 'N4 brain healthy mask',
     'N4_healthy_mask_brain_rescaled': 'N4 healthy mask brain'
 }
+# Name of the whole brain - tumor median distance in the metrics cache
+MEDIAN_METRIC = "median_distance"
 
 
 # === MEDIAN COMPUTATION FUNCTIONS ===
-def compute_median_distance_histograms(array_whole_brain, array_tumor_binary):
+def compute_median_distance_histograms(array_whole_brain, array_tumor_binary, bbox=None):
     median_whole_brain = np.median(array_whole_brain[array_whole_brain > 0])
-    array_tumor = array_whole_brain * array_tumor_binary
+    # Tumor voxels are looked up in the tumor bounding box only
+    array_tumor = crop_to_bbox(array_whole_brain, bbox) * crop_to_bbox(array_tumor_binary, bbox)
     median_tumor = np.median(array_tumor[array_tumor > 0])
     median_distance = median_whole_brain - median_tumor
     return median_distance, median_whole_brain, median_tumor
 
 
 def process_patient(folder, base_dir):
-    results_native = {mri_type: [] for mri_type in MRI_TYPE}
-    results_n4 = {mri_type: {variant: [] for variant in N4_VARIANTS} for mri_type in MRI_TYPE}
+    """Rows (Models.cohort_results) of the median distances of one patient, for every MRI type and variant."""
+    rows = []
 
     if not folder.startswith(CONTROL1):
-        return results_native, results_n4
+        return make_rows(rows)
 
     patient_number = folder.split("-")[2].split("_")[0]
     folder_path = os.path.join(base_dir, folder)
     array_dir = os.path.join(folder_path, "array")
     if not os.path.exists(array_dir):
         print(f"Array directory missing for patient {patient_number}")
-        return results_native, results_n4
-
-    tumor_binary_array = None
-    for f in os.listdir(array_dir):
-        if "tumor_binary" in f:
-            tumor_binary_array = np.load(os.path.join(array_dir, f))
-            break
+        return make_rows(rows)
 
-    if tumor_binary_array is None:
+    prefix = f"{CONTROL1}{patient_number}"
+    tumor_name = f"{prefix}_tumor_binary_array"
+    if not os.path.exists(get_array_source(array_dir, prefix, tumor_name)):
         print(f"Tumor binary array not found for patient {patient_number}")
-        return results_native, results_n4
-
+        return make_rows(rows)
+    tumor = {}  # mask and bounding box, loaded on the first metrics cache miss only
+
+    def compute_median_distances(names):
+        if not tumor:
+            tumor["array"] = load_patient_array(array_dir, prefix, tumor_name)
+            tumor["bbox"] = get_tumor_bbox(array_dir, prefix, tumor["array"])
+        metrics = {}
+        for variant, name in names:
+            try:
+                array = load_patient_array(array_dir, prefix, name)
+            except FileNotFoundError:
+                continue
+            median_distance, _, _ = compute_median_distance_histograms(array, tumor["array"], bbox=tumor["bbox"])
+            metrics[(variant, MEDIAN_METRIC)] = float(median_distance)
+        return metrics
+
+    db_path = get_metrics_db_path(base_dir)
     for mri_type in MRI_TYPE:
-        # Native
-        native_path = os.path.join(array_dir, f"{CONTROL1}{patient_number}_{mri_type}_rescaled.npy")
-        if os.path.exists(native_path):
-            array = np.load(native_path)
-            median_distance, _, _ = compute_median_distance_histograms(array, tumor_binary_array)
-            results_native[mri_type].append(median_distance)
-
-        # N4 variants
-        for variant in N4_VARIANTS:
-            n4_path = os.path.join(array_dir, f"{CONTROL1}{patient_number}_{mri_type}_{variant}.npy")
-            if os.path.exists(n4_path):
-                array = np.load(n4_path)
-                median_distance, _, _ = compute_median_distance_histograms(array, tumor_binary_array)
-                results_n4[mri_type][variant].append(median_distance)
-
-    return results_native, results_n4
-
-
-def merge_results(all_results):
-    medians_native = {mri_type: [] for mri_type in MRI_TYPE}
-    n4_medians = {mri_type: {variant: [] for variant in N4_VARIANTS} for mri_type in MRI_TYPE}
-
-    for native_dict, n4_dict in all_results:
-        for mri_type in MRI_TYPE:
-            medians_native[mri_type].extend(native_dict[mri_type])
-            for variant in N4_VARIANTS:
-                n4_medians[mri_type][variant].extend(n4_dict[mri_type][variant])
+        # Native, then the N4 variants; arrays not exported for this patient are skipped
+        names = [("native", f"{prefix}_{mri_type}_rescaled")]
+        names += [(variant, f"{prefix}_{mri_type}_{variant}") for variant in N4_VARIANTS]
+        metrics = get_or_compute_metrics(db_path, array_dir, prefix, mri_type, [MEDIAN_METRIC],
+                                         [name for _, name in names] + [tumor_name],
+                                         lambda: compute_median_distances(names))
+        rows.extend((patient_number, mri_type, variant, "brain-tumor", MEDIAN_METRIC, metrics[(variant, MEDIAN_METRIC)])
+                    for variant, _ in names if (variant, MEDIAN_METRIC) in metrics)
 
-    return medians_native, n4_medians
+    return make_rows(rows)
 
 
 def compute_medians_all_patients(base_dir, max_workers=8):
     folders = [f for f in os.listdir(base_dir) if f.startswith(CONTROL1)]
-    all_results = []
+    results = CohortResults()
 
     print(f"Starting parallel computation on {len(folders)} patients using {max_workers} workers...")
 
@@ -101,13 +102,12 @@ def compute_medians_all_patients(base_dir, max_workers=8):
         for i, future in enumerate(as_completed(futures), 1):
             folder = futures[future]
             try:
-                result = future.result()
-                all_results.append(result)
+                results.extend(future.result())
                 print(f"[{i}/{len(folders)}] Processed {folder}")
             except Exception as e:
                 print(f"Error processing {folder}: {e}")
 
-    return merge_results(all_results)
+    return results
 
 
 # === STATS + PLOTTING ===
@@ -142,12 +142,13 @@ def statistical_test_violin_plot(native, n4bb, n4hh, n4bh, n4hb):
         return None
 
 
-def plot_violin_for_mri_type(mri_type, medians_native, n4_medians):
-    native = medians_native.get(mri_type, [])
-    n4bb = n4_medians[mri_type]["N4_brain_rescaled"]
-    n4hh = n4_medians[mri_type]["N4_healthy_mask_rescaled"]
-    n4bh = n4_medians[mri_type]["N4_brain_healthy_mask_rescaled"]
-    n4hb = n4_medians[mri_type]["N4_healthy_mask_brain_rescaled"]
+def plot_violin_for_mri_type(mri_type, results):
+    # Median distance columns of the cohort results table, one per variant
+    native = results.values(modality=mri_type, variant="native")
+    n4bb = results.values(modality=mri_type, variant="N4_brain_rescaled")
+    n4hh = results.values(modality=mri_type, variant="N4_healthy_mask_rescaled")
+    n4bh = results.values(modality=mri_type, variant="N4_brain_healthy_mask_rescaled")
+    n4hb = results.values(modality=mri_type, variant="N4_healthy_mask_brain_rescaled")
 
     data_to_plot = [native, n4bb, n4hh, n4bh, n4hb]
     labels = [f"{mri_type} {VARIANTS[k]}" for k in VARIANTS.keys()]
@@ -169,7 +170,7 @@ def plot_violin_for_mri_type(mri_type, medians_native, n4_medians):
 
 # === MAIN ===
 if __name__ == "__main__":
-    medians_native, n4_medians = compute_medians_all_patients(NEW_DIR, max_workers=8)
+    results = compute_medians_all_patients(NEW_DIR, max_workers=8)
 
     while True:
         choice = input(f"Enter MRI type to plot ({', '.join(MRI_TYPE)}) or 'no' to exit: ").strip()
@@ -178,7 +179,7 @@ if __name__ == "__main__":
         if choice_lower in [m.lower() for m in MRI_TYPE]:
             # Get the correctly cased version from MRI_TYPE
             true_choice = next(m for m in MRI_TYPE if m.lower() == choice_lower)
-            plot_violin_for_mri_type(true_choice, medians_native, n4_medians)
+            plot_violin_for_mri_type(true_choice, results)
         elif choice_lower == "no":
             print("Exiting.")
             break
@@ -0,0 +1,166 @@
+import os
+import json
+import numpy as np
+from Models.masks import MASK_EXTENSION, get_mask_path, load_mask, unpack_mask
+from Models.array_store import get_store_path, list_store_arrays, read_store_array
+
+# Every volume starts on a page boundary so it can be memory mapped on its own
+BUNDLE_ALIGNMENT = 4096
+
+_indexes = {}
+
+
+def get_bundle_paths(array_dir, prefix):
+    """Bundle file (all volumes back to back) and its JSON index of name -> offset, dtype, shape."""
+    return os.path.join(array_dir, f"{prefix}_arrays.bundle"), os.path.join(array_dir, f"{prefix}_arrays_index.json")
+
+
+def get_source_fingerprint(path):
+    """[file name, size, mtime_ns] of the loose file an array of the bundle was packed from."""
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+
+
+def write_bundle(array_dir, prefix, arrays, masks=(), sources=None):
+    """Write (name, array) pairs into the patient bundle and its index, replacing any previous one.
+
+    ``masks`` are (name, bits, shape) triples of bit-packed masks (Models.masks), stored
+    packed and unpacked to bool by load_patient_array. ``sources`` maps names to the
+    get_source_fingerprint of the files they were read from, kept in the index so that a
+    file written again after the bundle is read instead of its stale copy.
+    """
+    bundle_path, index_path = get_bundle_paths(array_dir, prefix)
+    sources = sources or {}
+    index = {}
+    with open(f"{bundle_path}.tmp", "wb") as f:
+        for name, array in arrays:
+            offset = f.tell() + -f.tell() % BUNDLE_ALIGNMENT
+            f.seek(offset)
+            order = "F" if array.flags.f_contiguous and not array.flags.c_contiguous else "C"
+            f.write(np.asarray(array).tobytes(order=order))
+            index[name] = {"offset": offset, "dtype": np.dtype(array.dtype).str, "shape": list(array.shape), "order": order}
+            if name in sources:
+                index[name]["source"] = sources[name]
+        for name, bits, shape in masks:
+            offset = f.tell() + -f.tell() % BUNDLE_ALIGNMENT
+            f.seek(offset)
+            f.write(bits.tobytes())
+            index[name] = {"offset": offset, "dtype": "|u1", "shape": [len(bits)], "order": "C",
+                           "mask_shape": [int(n) for n in shape]}
+            if name in sources:
+                index[name]["source"] = sources[name]
+    os.replace(f"{bundle_path}.tmp", bundle_path)
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(f"{index_path}.tmp", index_path)
+    print(f"Bundle with {len(index)} arrays saved to {bundle_path}")
+
+
+def _read_packed_mask(path):
+    with np.load(path) as data:
+        return data["bits"], tuple(data["shape"])
+
+
+def write_bundle_from_npy(array_dir, prefix):
+    """Pack every .npy and packed mask of a patient array/ directory into its bundle, one array in memory at a time."""
+    names = sorted(f[:-len(".npy")] for f in os.listdir(array_dir) if f.endswith(".npy"))
+    mask_names = sorted(f[:-len(MASK_EXTENSION)] for f in os.listdir(array_dir) if f.endswith(MASK_EXTENSION))
+    # Fingerprints taken before reading, so a file rewritten while bundling counts as changed
+    sources = {name: get_source_fingerprint(os.path.join(array_dir, f"{name}.npy")) for name in names}
+    sources.update({name: get_source_fingerprint(get_mask_path(array_dir, name)) for name in mask_names})
+    write_bundle(array_dir, prefix,
+                 ((name, np.load(os.path.join(array_dir, f"{name}.npy"), mmap_mode="r")) for name in names),
+                 ((name, *_read_packed_mask(get_mask_path(array_dir, name))) for name in mask_names),
+                 sources)
+
+
+def read_bundle_index(array_dir, prefix):
+    """Index of the patient bundle, None when there is no bundle. Cached until the index file changes."""
+    _, index_path = get_bundle_paths(array_dir, prefix)
+    try:
+        mtime = os.path.getmtime(index_path)
+    except FileNotFoundError:
+        return None
+    if _indexes.get(index_path, (None,))[0] != mtime:
+        with open(index_path) as f:
+            _indexes[index_path] = (mtime, json.load(f))
+    return _indexes[index_path][1]
+
+
+def _is_stale(array_dir, name, entry):
+    """True when the loose file of a bundled array exists and is not the one that was packed.
+
+    Entries without a recorded source (older bundles) cannot be checked and count as stale
+    whenever a loose ``.npy`` or packed mask is there. A removed loose file leaves the bundle
+    as the only copy, which is then used.
+    """
+    if "source" in entry:
+        source_name, size, mtime_ns = entry["source"]
+        try:
+            stat = os.stat(os.path.join(array_dir, source_name))
+        except FileNotFoundError:
+            return False
+        return [stat.st_size, stat.st_mtime_ns] != [size, mtime_ns]
+    return os.path.exists(get_mask_path(array_dir, name)) or os.path.exists(os.path.join(array_dir, f"{name}.npy"))
+
+
+def _in_store(store_path, name):
+    return os.path.exists(store_path) and name in list_store_arrays(store_path)
+
+
+def get_array_source(array_dir, prefix, name):
+    """File load_patient_array reads array ``name`` from: the bundle, the packed mask, the .npy or the
+    HDF5 array store (Models.array_store), the .npy path when there is none of them.
+    """
+    index = read_bundle_index(array_dir, prefix)
+    if index is not None and name in index and not _is_stale(array_dir, name, index[name]):
+        return get_bundle_paths(array_dir, prefix)[0]
+    mask_path = get_mask_path(array_dir, name)
+    if os.path.exists(mask_path):
+        return mask_path
+    npy_path = os.path.join(array_dir, f"{name}.npy")
+    store_path = get_store_path(array_dir, prefix)
+    if not os.path.exists(npy_path) and _in_store(store_path, name):
+        return store_path
+    return npy_path
+
+
+def get_array_fingerprint(array_dir, prefix, name):
+    """[file name, size, mtime_ns] of the file the data of array ``name`` comes from, None when it is missing.
+
+    For a bundled array it is the one recorded for the loose file it was packed from, so it
+    does not change when the patient is bundled again with the same files.
+    """
+    index = read_bundle_index(array_dir, prefix)
+    if index is not None and name in index and "source" in index[name] and not _is_stale(array_dir, name, index[name]):
+        return index[name]["source"]
+    try:
+        return get_source_fingerprint(get_array_source(array_dir, prefix, name))
+    except FileNotFoundError:
+        return None
+
+
+def load_patient_array(array_dir, prefix, name, mmap_mode="r"):
+    """Array ``name`` of a patient: a zero-copy slice of the bundle when it has one, else ``{name}.npy``,
+    else the dataset of the patient's HDF5 array store (read into memory, it is compressed).
+    A bundled array whose loose file changed since the bundle was written is read from that file.
+
+    Bit-packed masks, in the bundle or as ``{name}.npz``, are always unpacked to a bool array.
+    """
+    index = read_bundle_index(array_dir, prefix)
+    if index is None or name not in index or _is_stale(array_dir, name, index[name]):
+        mask_path = get_mask_path(array_dir, name)
+        if os.path.exists(mask_path):
+            return load_mask(mask_path)
+        npy_path = os.path.join(array_dir, f"{name}.npy")
+        store_path = get_store_path(array_dir, prefix)
+        if not os.path.exists(npy_path) and os.path.exists(store_path):
+            return read_store_array(store_path, name)
+        return np.load(npy_path, mmap_mode=mmap_mode)
+    entry = index[name]
+    bundle_path, _ = get_bundle_paths(array_dir, prefix)
+    array = np.memmap(bundle_path, dtype=np.dtype(entry["dtype"]), mode="r", offset=entry["offset"],
+                      shape=tuple(entry["shape"]), order=entry["order"])
+    if "mask_shape" in entry:
+        return unpack_mask(array, tuple(entry["mask_shape"]))
+    return array if mmap_mode is not None else np.array(array)
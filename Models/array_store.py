@@ -0,0 +1,69 @@
+import os
+import h5py
+import nibabel as nib
+import numpy as np
+
+# Voxels along the last (slowest, contiguous in NIfTI) axis read at once
+SLAB_SIZE = 16
+# HDF5 chunk shape and compression of every dataset
+CHUNK_SHAPE = (64, 64, 16)
+COMPRESSION = "gzip"
+COMPRESSION_LEVEL = 4
+
+
+def get_store_path(array_dir, prefix):
+    """Per-patient chunked array store, next to the .npy arrays."""
+    return os.path.join(array_dir, f"{prefix}_arrays.h5")
+
+
+def iter_slabs(img, slab_size=SLAB_SIZE):
+    """Yield (slice, float64 slab) along the last axis of a NIfTI, reading only one slab at a time."""
+    depth = img.shape[-1]
+    for start in range(0, depth, slab_size):
+        index = slice(start, min(start + slab_size, depth))
+        yield index, np.asarray(img.dataobj[..., index], dtype=np.float64)
+
+
+def streaming_min_max(img, slab_size=SLAB_SIZE):
+    old_min, old_max = np.inf, -np.inf
+    for _, slab in iter_slabs(img, slab_size):
+        old_min = min(old_min, slab.min())
+        old_max = max(old_max, slab.max())
+    return old_min, old_max
+
+
+def write_rescaled_nifti(store, name, nii_path, slab_size=SLAB_SIZE, epsilon=1e-6):
+    """Rescale a NIfTI to uint16 like rescale_to_16bit, in two streaming passes, into dataset ``name``.
+
+    The first pass finds min/max, the second writes the rescaled slabs, so only a few
+    slabs are ever in memory instead of the float64 volume and its temporaries.
+    """
+    img = nib.load(nii_path, keep_file_open=True)
+    old_min, old_max = streaming_min_max(img, slab_size)
+
+    if name in store:
+        del store[name]
+    chunks = tuple(min(c, s) for c, s in zip(CHUNK_SHAPE, img.shape))
+    dataset = store.create_dataset(name, shape=img.shape, dtype=np.uint16, chunks=chunks, shuffle=True,
+                                   compression=COMPRESSION, compression_opts=COMPRESSION_LEVEL)
+    if old_max - old_min < epsilon:  # Constant image, set to mid-range instead of zero
+        dataset[...] = 32767
+    else:
+        for index, slab in iter_slabs(img, slab_size):
+            dataset[..., index] = (65535 * (slab - old_min) / (old_max - old_min)).astype(np.uint16)
+    dataset.attrs["source"] = os.path.basename(nii_path)
+    dataset.attrs["min"] = old_min
+    dataset.attrs["max"] = old_max
+
+
+def read_store_array(store_path, name):
+    """Dataset ``name`` of a store, decompressed into memory; FileNotFoundError when it is not there."""
+    with h5py.File(store_path, "r") as store:
+        if name not in store:
+            raise FileNotFoundError(f"No array '{name}' in {store_path}")
+        return store[name][...]
+
+
+def list_store_arrays(store_path):
+    with h5py.File(store_path, "r") as store:
+        return list(store.keys())
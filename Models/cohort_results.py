@@ -0,0 +1,72 @@
+import numpy as np
+
+# One row per patient, modality, variant, region and metric
+RESULT_DTYPE = np.dtype([
+    ("patient", "U16"),
+    ("modality", "U8"),
+    ("variant", "U40"),
+    ("region", "U16"),
+    ("metric", "U32"),
+    ("value", "f8"),
+])
+
+
+def make_rows(records):
+    """Structured array of (patient, modality, variant, region, metric, value) tuples, what workers return."""
+    return np.array(list(records), dtype=RESULT_DTYPE)
+
+
+class CohortResults():
+    """Columnar table of the results of a whole cohort, backed by one structured NumPy array.
+
+    Rows are appended in place (the buffer doubles when full, so appending is amortized
+    O(1)); ``table`` and ``select`` give structured arrays whose columns (``["value"]``...)
+    are views, ready for the statistics and plots.
+    """
+    def __init__(self, capacity=1024):
+        self._rows = np.empty(capacity, dtype=RESULT_DTYPE)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, count):
+        if self._size + count > len(self._rows):
+            rows = np.empty(max(2 * len(self._rows), self._size + count), dtype=RESULT_DTYPE)
+            rows[:self._size] = self._rows[:self._size]
+            self._rows = rows
+
+    def append(self, patient, modality, variant, region, metric, value):
+        self._reserve(1)
+        self._rows[self._size] = (patient, modality, variant, region, metric, value)
+        self._size += 1
+
+    def extend(self, rows):
+        """Append a structured array of rows (see make_rows)."""
+        self._reserve(len(rows))
+        self._rows[self._size:self._size + len(rows)] = rows
+        self._size += len(rows)
+
+    @property
+    def table(self):
+        return self._rows[:self._size]
+
+    def select(self, **filters):
+        """Rows whose columns equal the given values, in insertion order, e.g. select(modality="T1", metric="com_x")."""
+        table = self.table
+        keep = np.ones(len(table), dtype=bool)
+        for column, value in filters.items():
+            keep &= table[column] == value
+        return table[keep]
+
+    def values(self, **filters):
+        return self.select(**filters)["value"]
+
+    def save(self, path):
+        np.save(path, self.table)
+
+    @classmethod
+    def load(cls, path):
+        results = cls(capacity=1)
+        results.extend(np.load(path))
+        return results
@@ -0,0 +1,111 @@
+import math
+import numpy as np
+
+
+def _nonsingular(vmin, vmax, expander=0.1, tiny=1e-15):
+    """Same range expansion as matplotlib's transforms.nonsingular, used by hexbin on singular data."""
+    if not np.isfinite(vmin) or not np.isfinite(vmax):
+        return -expander, expander
+    vmin, vmax = sorted((float(vmin), float(vmax)))
+    maxabsvalue = max(abs(vmin), abs(vmax))
+    if maxabsvalue < (1e6 / tiny) * np.finfo(float).tiny:
+        return -expander, expander
+    if vmax - vmin <= maxabsvalue * tiny:
+        if vmax == 0 and vmin == 0:
+            return -expander, expander
+        return vmin - expander * abs(vmin), vmax + expander * abs(vmax)
+    return vmin, vmax
+
+
+def _hexbin_grid(gridsize):
+    nx = gridsize
+    ny = int(nx / math.sqrt(3))
+    return nx, ny
+
+
+def _hexbin_index(x, y, gridsize):
+    """Flat hexagon index of every point (-1 when out of range) and the scaled bin centers."""
+    nx, ny = _hexbin_grid(gridsize)
+    nx1, ny1 = nx + 1, ny + 1
+    x = np.asarray(x, float)
+    y = np.asarray(y, float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    if not finite.all():
+        x, y = x[finite], y[finite]
+
+    xmin, xmax = (x.min(), x.max()) if len(x) else (0, 1)
+    ymin, ymax = (y.min(), y.max()) if len(y) else (0, 1)
+    xmin, xmax = _nonsingular(xmin, xmax)
+    ymin, ymax = _nonsingular(ymin, ymax)
+
+    # In the x-direction the hexagons exactly cover [xmin, xmax], pad against roundoff
+    padding = 1.e-9 * (xmax - xmin)
+    xmin -= padding
+    xmax += padding
+    sx = (xmax - xmin) / nx
+    sy = (ymax - ymin) / ny
+
+    # Positions in hexagon index coordinates, on the two interleaved lattices
+    ix = (x - xmin) / sx
+    iy = (y - ymin) / sy
+    ix1 = np.round(ix).astype(int)
+    iy1 = np.round(iy).astype(int)
+    ix2 = np.floor(ix).astype(int)
+    iy2 = np.floor(iy).astype(int)
+    i1 = np.where((0 <= ix1) & (ix1 < nx1) & (0 <= iy1) & (iy1 < ny1), ix1 * ny1 + iy1, -1)
+    i2 = np.where((0 <= ix2) & (ix2 < nx) & (0 <= iy2) & (iy2 < ny), nx1 * ny1 + ix2 * ny + iy2, -1)
+
+    d1 = (ix - ix1) ** 2 + 3.0 * (iy - iy1) ** 2
+    d2 = (ix - ix2 - 0.5) ** 2 + 3.0 * (iy - iy2 - 0.5) ** 2
+    index = np.where(d1 < d2, i1, i2)
+
+    offsets = np.zeros((nx1 * ny1 + nx * ny, 2), float)
+    offsets[:nx1 * ny1, 0] = np.repeat(np.arange(nx1), ny1)
+    offsets[:nx1 * ny1, 1] = np.tile(np.arange(ny1), nx1)
+    offsets[nx1 * ny1:, 0] = np.repeat(np.arange(nx) + 0.5, ny)
+    offsets[nx1 * ny1:, 1] = np.tile(np.arange(ny), nx) + 0.5
+    offsets[:, 0] = offsets[:, 0] * sx + xmin
+    offsets[:, 1] = offsets[:, 1] * sy + ymin
+    return index, offsets
+
+
+def hexbin_counts_batch(pairs, gridsize=50, mincnt=1):
+    """Hexagonal binning of several (x, y) pairs, without any plotting backend.
+
+    Every pair gets its own extent, like a separate ``ax.hexbin(x, y, gridsize=gridsize,
+    mincnt=mincnt)`` call, but all the counting is done by a single np.bincount.
+    Returns one (counts, offsets) tuple per pair, equal to ``hb.get_array()`` and
+    ``hb.get_offsets()`` of the matplotlib PolyCollection.
+    """
+    nx, ny = _hexbin_grid(gridsize)
+    n_bins = (nx + 1) * (ny + 1) + nx * ny
+
+    all_offsets = []
+    all_index = []
+    for i, (x, y) in enumerate(pairs):
+        index, offsets = _hexbin_index(x, y, gridsize)
+        all_index.append(index[index >= 0] + i * n_bins)
+        all_offsets.append(offsets)
+
+    counts = np.bincount(np.concatenate(all_index) if all_index else np.zeros(0, int),
+                         minlength=len(all_offsets) * n_bins).reshape(len(all_offsets), n_bins).astype(float)
+    results = []
+    for pair_counts, offsets in zip(counts, all_offsets):
+        good = pair_counts >= (mincnt if mincnt is not None else 0)
+        results.append((pair_counts[good], offsets[good]))
+    return results
+
+
+def hexbin_counts(x, y, gridsize=50, mincnt=1):
+    """Counts and centers of the hexagons of ``ax.hexbin(x, y, gridsize=gridsize, mincnt=mincnt)``."""
+    return hexbin_counts_batch([(x, y)], gridsize=gridsize, mincnt=mincnt)[0]
+
+
+def hexbin_center_of_mass(counts, offsets):
+    """Count-weighted average of the hexagon centers, (None, None) when there is no bin."""
+    if len(counts) == 0:
+        return (None, None)
+    return (
+        np.average(offsets[:, 0], weights=counts),
+        np.average(offsets[:, 1], weights=counts)
+    )
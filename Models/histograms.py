@@ -0,0 +1,166 @@
+import json
+import numpy as np
+from Models.masks import INDEX_ORDER
+
+# Same binning as np.histogram(array, bins=655, range=(0, 65536)) on the rescaled uint16 arrays
+HIST_BINS = 655
+HIST_RANGE_BITS = 16
+# Voxels binned at once, bounds the temporary bin index arrays
+CHUNK_SIZE = 1 << 22
+
+
+def bin_edges(bins=HIST_BINS):
+    return np.linspace(0, 1 << HIST_RANGE_BITS, bins + 1)
+
+
+def bin_indices(values, bins=HIST_BINS):
+    """Histogram bin of every integer value in [0, 65536): (value * bins) >> 16, exactly np.histogram's bin.
+
+    No bin edge but the first and last falls on an integer, so the integer product and
+    shift gives the same bins as np.histogram's float edges. Float arrays holding integer
+    values (the .astype(np.float32) copies of the rescaled arrays) are binned the same way.
+    """
+    return (np.asarray(values).astype(np.uint32, copy=False) * np.uint32(bins)) >> np.uint32(HIST_RANGE_BITS)
+
+
+def _bincount(values, bins):
+    counts = np.zeros(bins, dtype=np.int64)
+    for start in range(0, len(values), CHUNK_SIZE):
+        # Values outside the range land past the last bin and are dropped, like np.histogram
+        counts += np.bincount(bin_indices(values[start:start + CHUNK_SIZE], bins), minlength=bins)[:bins]
+    return counts
+
+
+def volume_histograms(volume, tumor_index=None, bins=HIST_BINS):
+    """Histogram of a volume and, given the flat (INDEX_ORDER) tumor indices, of ``volume * tumor_mask``, in one pass.
+
+    The tumor histogram only bins the tumor voxels; every other voxel of the product volume
+    is a zero, added to the first bin. Raveled in INDEX_ORDER, a Fortran ordered (memory
+    mapped) volume is read in place.
+    """
+    values = np.asarray(volume).ravel(order=INDEX_ORDER)
+    volume_counts = _bincount(values, bins)
+    if tumor_index is None:
+        return volume_counts, None
+    tumor_counts = _bincount(np.take(values, tumor_index), bins)
+    tumor_counts[0] += values.size - len(tumor_index)
+    return volume_counts, tumor_counts
+
+
+class CohortHistograms():
+    """Histograms summed over patients, one (volume, tumor) pair of int64 counts per key (modality, variant...).
+
+    Patients are added one at a time, so a whole cohort is accumulated with only the
+    volumes of one patient in memory.
+    """
+    def __init__(self, bins=HIST_BINS):
+        self.bins = bins
+        self.edges = bin_edges(bins)
+        self.counts = {}
+        self.patients = 0
+
+    def add(self, key, volume, tumor_index=None):
+        volume_counts, tumor_counts = volume_histograms(volume, tumor_index, self.bins)
+        if key not in self.counts:
+            self.counts[key] = [np.zeros(self.bins, dtype=np.int64), np.zeros(self.bins, dtype=np.int64)]
+        self.counts[key][0] += volume_counts
+        if tumor_counts is not None:
+            self.counts[key][1] += tumor_counts
+
+    def add_patient(self, volumes, tumor_index=None):
+        """Add the {key: volume} of one patient, all sharing its tumor indices."""
+        for key, volume in volumes.items():
+            self.add(key, volume, tumor_index)
+        self.patients += 1
+
+
+# Joint histograms: 256 x 256 bins, i.e. the top 8 bits of each uint16 value
+JOINT_BINS = 256
+
+
+def joint_histogram(x_values, y_values, bins=JOINT_BINS):
+    """(bins, bins) int64 counts of the (x, y) value pairs, x along the first axis.
+
+    Both values are binned like bin_indices and combined into one index
+    ``x_bin * bins + y_bin``, counted with a single np.bincount per chunk. Volumes are
+    raveled in INDEX_ORDER, in place for the Fortran ordered arrays, and both the same way
+    so their voxels stay paired.
+    """
+    x_values = np.asarray(x_values).ravel(order=INDEX_ORDER)
+    y_values = np.asarray(y_values).ravel(order=INDEX_ORDER)
+    counts = np.zeros(bins * bins, dtype=np.int64)
+    for start in range(0, len(x_values), CHUNK_SIZE):
+        x_bins = bin_indices(x_values[start:start + CHUNK_SIZE], bins)
+        y_bins = bin_indices(y_values[start:start + CHUNK_SIZE], bins)
+        if len(x_bins) and max(x_bins.max(), y_bins.max()) >= bins:
+            # Pairs with a value outside the range are dropped, like np.histogram2d
+            inside = (x_bins < bins) & (y_bins < bins)
+            x_bins, y_bins = x_bins[inside], y_bins[inside]
+        counts += np.bincount(x_bins * np.uint32(bins) + y_bins, minlength=bins * bins)
+    return counts.reshape(bins, bins)
+
+
+def joint_com(counts, bins=JOINT_BINS):
+    """(x, y) center of mass, in intensity units, of the pairs counted in a joint histogram, NaN when it is empty."""
+    total = counts.sum()
+    if total == 0:
+        return np.nan, np.nan
+    edges = bin_edges(bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    return float(counts.sum(axis=1) @ centers / total), float(counts.sum(axis=0) @ centers / total)
+
+
+class CohortJointHistograms():
+    """Joint histograms summed over patients, one (bins, bins) int64 array per key (modality, variant, region).
+
+    Each patient is added and released before the next one is loaded; the totals,
+    with the names of the patients they hold and the fingerprints of the arrays each one
+    was read from (``sources``), are saved to and loaded from one .npz.
+    """
+    def __init__(self, bins=JOINT_BINS):
+        self.bins = bins
+        self.edges = bin_edges(bins)
+        self.counts = {}
+        self.patients = []
+        self.sources = {}
+
+    def add(self, key, x_values, y_values):
+        if key not in self.counts:
+            self.counts[key] = np.zeros((self.bins, self.bins), dtype=np.int64)
+        self.counts[key] += joint_histogram(x_values, y_values, self.bins)
+
+    def merge(self, other):
+        """Add the counts, patients and sources of another CohortJointHistograms with the same bins."""
+        if other.bins != self.bins:
+            raise ValueError(f"Cannot merge histograms with {other.bins} bins into {self.bins} bins.")
+        for key, counts in other.counts.items():
+            if key not in self.counts:
+                self.counts[key] = np.zeros((self.bins, self.bins), dtype=np.int64)
+            self.counts[key] += counts
+        self.patients.extend(other.patients)
+        self.sources.update(other.sources)
+
+    def density(self, key):
+        """Counts of a key normalized to sum to 1."""
+        counts = self.counts[key]
+        return counts / max(counts.sum(), 1)
+
+    def com(self, key):
+        return joint_com(self.counts[key], self.bins)
+
+    def save(self, path):
+        arrays = {"/".join(key): counts for key, counts in self.counts.items()}
+        np.savez(path, bins=self.bins, patients=np.array(self.patients, dtype=str),
+                 sources=json.dumps(self.sources), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            histograms = cls(bins=int(data["bins"]))
+            histograms.patients = [str(patient) for patient in data["patients"]]
+            if "sources" in data.files:
+                histograms.sources = json.loads(str(data["sources"]))
+            for name in data.files:
+                if name not in ("bins", "patients", "sources"):
+                    histograms.counts[tuple(name.split("/"))] = data[name]
+        return histograms
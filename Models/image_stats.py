@@ -0,0 +1,80 @@
+import nibabel as nib
+import numpy as np
+
+from Models.array_store import SLAB_SIZE
+
+# Integer types whose values are counted in one bincount histogram (65536 bins at most)
+HISTOGRAM_DTYPES = (np.uint8, np.int8, np.uint16, np.int16)
+
+
+def iter_raw_slabs(img, slab_size=SLAB_SIZE):
+    """Slabs along the last axis of a NIfTI in their stored type (scaled to float only if the header has a scaling)."""
+    depth = img.shape[-1]
+    for start in range(0, depth, slab_size):
+        yield np.asanyarray(img.dataobj[..., start:min(start + slab_size, depth)])
+
+
+def _percentile_index(p, count):
+    # fslstats -P: the value at position int(p/100 * n) of the sorted non-zero voxels
+    return min(int(p / 100 * count), count - 1)
+
+
+def image_stats(path, percentiles=(95,), slab_size=SLAB_SIZE):
+    """fslstats -R -m -s -P ... -V of a NIfTI, in one streaming pass over its slabs.
+
+    Min, max, mean and (n - 1) standard deviation are over all voxels, percentiles and
+    the voxel count over the non-zero ones, like fslstats. For 8 and 16 bit integer data
+    the non-zero values are counted in an exact histogram, other data keeps its non-zero
+    values for the percentiles. Returns a dict with "min", "max", "mean", "std",
+    "nonzero", "volume" (nonzero * voxel volume, mm3) and "p{n}" per percentile.
+    """
+    img = nib.load(path, keep_file_open=True)
+    count, mean, m2 = 0, 0.0, 0.0
+    min_val, max_val = np.inf, -np.inf
+    nonzero = 0
+    histogram, offset, values = None, 0, []
+
+    for slab in iter_raw_slabs(img, slab_size):
+        slab = slab.ravel()
+        # Running mean and sum of squared deviations, merged slab by slab (Chan et al.)
+        slab_count = slab.size
+        slab_mean = slab.mean(dtype=np.float64)
+        slab_m2 = np.square(slab - slab_mean, dtype=np.float64).sum()
+        delta = slab_mean - mean
+        total = count + slab_count
+        mean += delta * slab_count / total
+        m2 += slab_m2 + delta * delta * count * slab_count / total
+        count = total
+        min_val = min(min_val, slab.min())
+        max_val = max(max_val, slab.max())
+
+        slab_nonzero = slab[slab != 0]
+        nonzero += slab_nonzero.size
+        if slab.dtype in HISTOGRAM_DTYPES:
+            if histogram is None:
+                offset = -int(np.iinfo(slab.dtype).min)
+                histogram = np.zeros(int(np.iinfo(slab.dtype).max) + offset + 1, dtype=np.int64)
+            histogram += np.bincount(slab_nonzero.astype(np.int64) + offset, minlength=len(histogram))
+        elif percentiles:
+            values.append(slab_nonzero)
+
+    stats = {
+        "min": float(min_val),
+        "max": float(max_val),
+        "mean": mean,
+        "std": float(np.sqrt(m2 / (count - 1))) if count > 1 else 0.0,
+        "nonzero": nonzero,
+        "volume": nonzero * float(np.prod(img.header.get_zooms()[:3])),
+    }
+    if nonzero == 0:
+        stats.update({f"p{p}": 0.0 for p in percentiles})
+    elif histogram is not None:
+        cumulative = np.cumsum(histogram)
+        for p in percentiles:
+            stats[f"p{p}"] = float(np.searchsorted(cumulative, _percentile_index(p, nonzero), side="right") - offset)
+    elif percentiles:
+        indices = [_percentile_index(p, nonzero) for p in percentiles]
+        values = np.partition(np.concatenate(values), indices)
+        for p, index in zip(percentiles, indices):
+            stats[f"p{p}"] = float(values[index])
+    return stats
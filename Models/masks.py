@@ -0,0 +1,45 @@
+import os
+import numpy as np
+
+# Packed masks are saved next to the arrays as {name}.npz instead of {name}.npy
+MASK_EXTENSION = ".npz"
+# Flat voxel indices address the volumes in Fortran order, the memory order of the exported
+# arrays (nibabel get_fdata then np.save), so gathering reads the volume in place
+INDEX_ORDER = "F"
+
+
+def pack_mask(array):
+    """Bits (np.packbits, C order) and shape of a binary mask, raising ValueError if it is not 0/1."""
+    array = np.asarray(array)
+    if array.dtype != bool:
+        if not np.isin(np.unique(array), (0, 1)).all():
+            raise ValueError(f"Mask values must be 0 or 1, got {np.unique(array)[:10]}.")
+        array = array != 0
+    return np.packbits(array, axis=None), array.shape
+
+
+def unpack_mask(bits, shape):
+    """Bool mask of the given shape from its packed bits."""
+    count = int(np.prod(shape))
+    return np.unpackbits(bits, count=count).view(bool).reshape(shape)
+
+
+def save_mask(path, array):
+    """Save a binary mask bit-packed, 1 bit per voxel instead of the 64 of a get_fdata() array."""
+    bits, shape = pack_mask(array)
+    np.savez(path, bits=bits, shape=np.asarray(shape, dtype=np.int64))
+
+
+def load_mask(path):
+    """Bool mask saved by save_mask."""
+    with np.load(path) as data:
+        return unpack_mask(data["bits"], tuple(data["shape"]))
+
+
+def get_mask_path(array_dir, name):
+    return os.path.join(array_dir, f"{name}{MASK_EXTENSION}")
+
+
+def mask_indices(mask):
+    """Flat (INDEX_ORDER) indices of the voxels inside a mask."""
+    return np.flatnonzero(np.asarray(mask).ravel(order=INDEX_ORDER))
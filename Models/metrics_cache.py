@@ -0,0 +1,91 @@
+import os
+import json
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+from Models.array_bundle import get_array_fingerprint
+
+METRICS_DB_NAME = "metrics_cache.sqlite"
+# Local disk: SQLite's WAL needs shared memory, which network mounts (the cohort on /mnt/external) do not provide
+METRICS_DB_DIR = os.path.join(os.path.expanduser("~"), ".cache", "brain_imaging")
+
+
+def get_metrics_db_path(base_dir):
+    """One metrics database per cohort, on local disk, named after the cohort directory."""
+    base_dir = os.path.abspath(base_dir)
+    cohort_id = hashlib.sha256(base_dir.encode()).hexdigest()[:8]
+    return os.path.join(METRICS_DB_DIR, f"{os.path.basename(base_dir)}_{cohort_id}_{METRICS_DB_NAME}")
+
+
+def source_fingerprint(array_dir, prefix, names, version=None):
+    """Hash of the get_array_fingerprint of the given arrays (None for the missing ones), and of the
+    ``version`` of the metrics when there is one.
+
+    A bundled array is fingerprinted by the loose file it was packed from, not by the bundle,
+    so bundling a patient again only invalidates the metrics of the arrays that changed.
+    """
+    description = [] if version is None else [["version", version]]
+    for name in names:
+        description.append([name, get_array_fingerprint(array_dir, prefix, name)])
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+
+@contextmanager
+def _connect(db_path):
+    """Connection committing on success, always closed; the timeout lets parallel workers wait for each other."""
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=60)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("""CREATE TABLE IF NOT EXISTS metrics (
+        patient TEXT, modality TEXT, variant TEXT, metric TEXT, value REAL,
+        PRIMARY KEY (patient, modality, variant, metric))""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS fingerprints (
+        patient TEXT, modality TEXT, metric TEXT, fingerprint TEXT,
+        PRIMARY KEY (patient, modality, metric))""")
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def load_metrics(db_path, patient, modality, metric_names, fingerprint):
+    """{(variant, metric): value} stored for a patient and modality, None unless every metric has this fingerprint."""
+    with _connect(db_path) as connection:
+        stored = dict(connection.execute(
+            f"SELECT metric, fingerprint FROM fingerprints WHERE patient = ? AND modality = ? "
+            f"AND metric IN ({','.join('?' * len(metric_names))})", (patient, modality, *metric_names)))
+        if any(stored.get(metric) != fingerprint for metric in metric_names):
+            return None
+        rows = connection.execute(
+            f"SELECT variant, metric, value FROM metrics WHERE patient = ? AND modality = ? "
+            f"AND metric IN ({','.join('?' * len(metric_names))})", (patient, modality, *metric_names))
+        # NaN is stored as NULL by sqlite
+        return {(variant, metric): float("nan") if value is None else value for variant, metric, value in rows}
+
+
+def store_metrics(db_path, patient, modality, metric_names, fingerprint, metrics):
+    """Replace the ``metric_names`` of a patient and modality with ``metrics`` ({(variant, metric): value})."""
+    placeholders = ','.join('?' * len(metric_names))
+    with _connect(db_path) as connection:
+        connection.execute(f"DELETE FROM metrics WHERE patient = ? AND modality = ? AND metric IN ({placeholders})",
+                           (patient, modality, *metric_names))
+        connection.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?)",
+                               [(patient, modality, variant, metric, value) for (variant, metric), value in metrics.items()])
+        connection.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                               [(patient, modality, metric, fingerprint) for metric in metric_names])
+
+
+def get_or_compute_metrics(db_path, array_dir, prefix, modality, metric_names, sources, compute, version=None):
+    """Cached metrics of one patient and modality, ``compute()`` is only called when a source array changed.
+
+    ``sources`` are the names of the arrays the metrics are computed from and ``compute``
+    returns {(variant, metric): value} for the metrics in ``metric_names``. Changing
+    ``version`` invalidates the rows stored with another one.
+    """
+    fingerprint = source_fingerprint(array_dir, prefix, sources, version)
+    metrics = load_metrics(db_path, prefix, modality, metric_names, fingerprint)
+    if metrics is None:
+        metrics = compute()
+        store_metrics(db_path, prefix, modality, metric_names, fingerprint, metrics)
+    return metrics
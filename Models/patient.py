@@ -2,281 +2,267 @@ import os.path
 import numpy as np
 import pandas as pd
 from scipy.ndimage import map_coordinates
-import matplotlib.pyplot as plt
+from Models.hexbin import hexbin_counts_batch, hexbin_center_of_mass
+from Models.array_bundle import load_patient_array
+from Models.tumor_bbox import get_tumor_bbox
 
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 REMOTE = r"C:\Users\Anna\PycharmProjects\Brain_Imaging\bias_field_correction_samples"
 INPUT_MRI = "T1", "T1c", "T2", "FLAIR"
 
+N4_VARIANTS = "n4bb", "n4hh", "n4bh", "n4hb"
+VARIANTS = ("native",) + N4_VARIANTS
+# File name suffix of every correction variant in the array/ directory
+VARIANT_SUFFIXES = {
+    "native": "",
+    "n4hh": "_N4_healthy_mask",
+    "n4bb": "_N4_brain",
+    "n4bh": "_N4_brain_healthy_mask",
+    "n4hb": "_N4_healthy_mask_brain",
+}
+# Column of every variant in the median distance table
+VARIANT_COLUMNS = {
+    "native": "Native",
+    "n4bb": "N4_Brain",
+    "n4hh": "N4_Healthy",
+    "n4bh": "N4_Brain_Healthy",
+    "n4hb": "N4_Healthy_Brain",
+}
+
+def _positive_medians(rows):
+    """Median of the strictly positive values of each 1-D array in ``rows``, NaN when there are none.
+
+    Rows are processed one at a time, so at most one row's worth of temporaries is alive.
+    Unsigned 8/16-bit data (the rescaled arrays) is ranked exactly from a bincount histogram
+    without sorting the voxels; other dtypes select the two middle ranks of the positive
+    values with a single np.partition.
+    """
+    medians = np.full(len(rows), np.nan)
+    for i, row in enumerate(rows):
+        if row.dtype.kind == "u" and row.dtype.itemsize <= 2:
+            histogram = np.bincount(row, minlength=np.iinfo(row.dtype).max + 1)
+            histogram[0] = 0
+            cumulative = np.cumsum(histogram)
+            count = cumulative[-1]
+            if count > 0:
+                lower, upper = np.searchsorted(cumulative, [(count - 1) // 2, count // 2], side="right")
+                medians[i] = (lower + upper) / 2
+            continue
+
+        positive = row[row > 0]
+        count = len(positive)
+        if count > 0:
+            lower, upper = (count - 1) // 2, count // 2
+            positive.partition([lower, upper])
+            medians[i] = (positive[lower].astype(np.float64) + positive[upper]) / 2
+    return medians
+
+def _interpolate_at(volume, coords, mask=None):
+    """map_coordinates(volume * mask, coords, order=1) for a single point, read from its 2x2x2 neighbourhood."""
+    lower = [min(max(int(np.floor(c[0])), 0), n - 1) for c, n in zip(coords, volume.shape)]
+    neighbourhood = tuple(slice(l, l + 2) for l in lower)
+    block = volume[neighbourhood]
+    if mask is not None:
+        block = np.multiply(block, mask[neighbourhood], dtype=np.float64)
+    return map_coordinates(block, [[c[0] - l] for c, l in zip(coords, lower)], order=1)[0]
+
 class Patient():
-    def __init__(self, id_, local=False, mmap=False):
+    """Arrays of one patient, loaded lazily on first attribute access.
+
+    Attributes keep the names of the original eager loader
+    (``n4bb_t1_array``, ``biasfield_n4hh_flair_array``, ``tumor_binary_array``...).
+    Only the given ``modalities`` and ``variants`` can be accessed; with ``mmap=True``
+    every array is opened with ``mmap_mode='r'`` instead of being read into memory. Arrays come
+    from the patient bundle (Models.array_bundle) when there is one, else from the ``.npy`` files
+    or the HDF5 array store (Models.array_store);
+    bit-packed masks (Models.masks) are unpacked to bool.
+    """
+    def __init__(self, id_, local=False, mmap=False, modalities=INPUT_MRI, variants=VARIANTS):
         self.id = id_
         self.prefix = f"UCSF-PDGM-{self.id}"
-        path = r"C:\Users\Anna\PycharmProjects\Brain_Imaging\bias_field_correction_samples" if local else "/mnt/external/reorg_patients_UCSF"
+        path = REMOTE if local else NEW_DIR
         self.dir = f"{path}/{self.prefix}_nifti"
-        #T1
-        self.native_t1_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T1_rescaled.npy"))
-        self.n4hh_t1_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T1_N4_healthy_mask_rescaled.npy"))
-        self.n4bb_t1_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T1_N4_brain_rescaled.npy"))
-        self.n4bh_t1_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T1_N4_brain_healthy_mask_rescaled.npy"))
-        self.n4hb_t1_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T1_N4_healthy_mask_brain_rescaled.npy"))
-        #Biasfield T1
-        self.biasfield_n4hh_t1_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T1_N4_healthy_mask_rescaled.npy"))
-        self.biasfield_n4bb_t1_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T1_N4_brain_rescaled.npy"))
-        self.biasfield_n4bh_t1_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T1_N4_brain_healthy_mask_rescaled.npy"))
-        self.biasfield_n4hb_t1_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T1_N4_healthy_mask_brain_rescaled.npy"))
-
-        #T2
-        self.native_t2_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T2_rescaled.npy"))
-        self.n4hh_t2_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T2_N4_healthy_mask_rescaled.npy"))
-        self.n4bb_t2_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T2_N4_brain_rescaled.npy"))
-        self.n4bh_t2_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T2_N4_brain_healthy_mask_rescaled.npy"))
-        self.n4hb_t2_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T2_N4_healthy_mask_brain_rescaled.npy"))
-        #Biasfield T2
-        self.biasfield_n4hh_t2_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T2_N4_healthy_mask_rescaled.npy"))
-        self.biasfield_n4bb_t2_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T2_N4_brain_rescaled.npy"))
-        self.biasfield_n4bh_t2_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T2_N4_brain_healthy_mask_rescaled.npy"))
-        self.biasfield_n4hb_t2_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T2_N4_healthy_mask_brain_rescaled.npy"))
-
-        #T1c
-        self.native_t1c_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T1c_rescaled.npy"))
-        self.n4hh_t1c_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T1c_N4_healthy_mask_rescaled.npy"))
-        self.n4bb_t1c_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T1c_N4_brain_rescaled.npy"))
-        self.n4bh_t1c_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T1c_N4_brain_healthy_mask_rescaled.npy"))
-        self.n4hb_t1c_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_T1c_N4_healthy_mask_brain_rescaled.npy"))
-        #Biasfield T1c
-        self.biasfield_n4hh_t1c_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T1c_N4_healthy_mask_rescaled.npy"))
-        self.biasfield_n4bb_t1c_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T1c_N4_brain_rescaled.npy"))
-        self.biasfield_n4bh_t1c_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T1c_N4_brain_healthy_mask_rescaled.npy"))
-        self.biasfield_n4hb_t1c_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_T1c_N4_healthy_mask_brain_rescaled.npy"))
-        #FLAIR
-        self.native_flair_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_FLAIR_rescaled.npy"))
-        self.n4hh_flair_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_FLAIR_N4_healthy_mask_rescaled.npy"))
-        self.n4bb_flair_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_FLAIR_N4_brain_rescaled.npy"))
-        self.n4bh_flair_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_FLAIR_N4_brain_healthy_mask_rescaled.npy"))
-        self.n4hb_flair_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_FLAIR_N4_healthy_mask_brain_rescaled.npy"))
-        #Biasfield flair
-        self.biasfield_n4hh_flair_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_FLAIR_N4_healthy_mask_rescaled.npy"))
-        self.biasfield_n4bb_flair_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_FLAIR_N4_brain_rescaled.npy"))
-        self.biasfield_n4bh_flair_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_FLAIR_N4_brain_healthy_mask_rescaled.npy"))
-        self.biasfield_n4hb_flair_array = np.load(os.path.join(self.dir, f"array/biasfield_{self.prefix}_FLAIR_N4_healthy_mask_brain_rescaled.npy"))
-        #TUMOR BINARY
-        self.tumor_binary_array = np.load(os.path.join(self.dir, f"array/{self.prefix}_tumor_binary_array.npy"))
-
-    def _calculate_median_distances(self, native, n4bb, n4hh, n4bh, n4hb):
-
-        tumor_binary_array = self.tumor_binary_array
-        native_tumor_array = native * tumor_binary_array
-        n4hh_tumor_array = n4hh * tumor_binary_array
-        n4bb_tumor_array = n4bb * tumor_binary_array
-        n4hb_tumor_array = n4hb * tumor_binary_array
-        n4bh_tumor_array = n4bh * tumor_binary_array
-
-        median_whole_brain_native = np.median(native[native > 0])
-        median_whole_brain_n4bb = np.median(n4bb[n4bb > 0])
-        median_whole_brain_n4hh = np.median(n4hh[n4hh > 0])
-        median_whole_brain_n4bh = np.median(n4bh[n4bh > 0])
-        median_whole_brain_n4hb = np.median(n4hb[n4hb > 0])
-
-        median_tumor_native = np.median(native_tumor_array[native_tumor_array > 0])
-        median_tumor_n4bb = np.median(n4bb_tumor_array[n4bb_tumor_array > 0])
-        median_tumor_n4hh = np.median(n4hh_tumor_array[n4hh_tumor_array > 0])
-        median_tumor_n4bh = np.median(n4bh_tumor_array[n4bh_tumor_array > 0])
-        median_tumor_n4hb = np.median(n4hb_tumor_array[n4hb_tumor_array > 0])
-
-        median_distance_native = median_whole_brain_native - median_tumor_native
-        median_distance_n4bb = median_whole_brain_n4bb - median_tumor_n4bb
-        median_distance_n4hh = median_whole_brain_n4hh - median_tumor_n4hh
-        median_distance_n4bh = median_whole_brain_n4bh - median_tumor_n4bh
-        median_distance_n4hb = median_whole_brain_n4hb - median_tumor_n4hb
-
-        return [
-            float(median_distance_native),
-            float(median_distance_n4bb),
-            float(median_distance_n4hh),
-            float(median_distance_n4bh),
-            float(median_distance_n4hb)
-        ]
+        self.mmap_mode = "r" if mmap else None
+        self.modalities = tuple(modalities)
+        self.variants = tuple(variants)
+        self._array_files = self._get_array_files()
+        self._arrays = {}
+        self._tumor_bbox = None
+        self._tumor_coords = None
+        self.median_distances = None
+
+    def _get_array_files(self):
+        array_files = {}
+        for modality in self.modalities:
+            for variant in self.variants:
+                name = f"{self.prefix}_{modality}{VARIANT_SUFFIXES[variant]}_rescaled"
+                array_files[f"{variant}_{modality.lower()}_array"] = name
+                if variant != "native":
+                    array_files[f"biasfield_{variant}_{modality.lower()}_array"] = f"biasfield_{name}"
+        array_files["tumor_binary_array"] = f"{self.prefix}_tumor_binary_array"
+        return array_files
+
+    def __getattr__(self, name):
+        # Only called when normal lookup fails, i.e. for the lazily loaded arrays
+        arrays = self.__dict__.get("_arrays", {})
+        if name in arrays:
+            return arrays[name]
+        array_files = self.__dict__.get("_array_files", {})
+        if name not in array_files:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}' "
+                                 f"(selected modalities: {self.__dict__.get('modalities')}, "
+                                 f"variants: {self.__dict__.get('variants')})")
+        array = load_patient_array(os.path.join(self.dir, "array"), self.prefix, array_files[name], mmap_mode=self.mmap_mode)
+        self._arrays[name] = array
+        return array
+
+    def get_array(self, modality, variant, biasfield=False):
+        prefix = "biasfield_" if biasfield else ""
+        return getattr(self, f"{prefix}{variant}_{modality.lower()}_array")
+
+    def release(self):
+        """Drop every loaded array (closes the memory maps)."""
+        self._arrays.clear()
+
+    def get_tumor_bbox(self):
+        """Slices of the tumor bounding box (Models.tumor_bbox), read or computed once per patient."""
+        if self._tumor_bbox is None:
+            self._tumor_bbox = get_tumor_bbox(os.path.join(self.dir, "array"), self.prefix)
+        return self._tumor_bbox
+
+    def crop_to_tumor(self, volume):
+        """View of a volume inside the tumor bounding box."""
+        return np.asarray(volume)[self.get_tumor_bbox()]
+
+    def get_tumor_coords(self):
+        """Coordinates of the tumor voxels inside the bounding box, in C order, computed once per patient."""
+        if self._tumor_coords is None:
+            self._tumor_coords = np.nonzero(self.crop_to_tumor(self.tumor_binary_array) > 0)
+        return self._tumor_coords
+
+    def get_tumor_values(self, volume):
+        """Values of a volume at the tumor voxels, read from the bounding box only."""
+        return self.crop_to_tumor(volume)[self.get_tumor_coords()]
+
+    def compute_median_distances(self):
+        """Whole-brain minus tumor median for every modality and variant in one batched pass.
+
+        Returns a dict modality -> median distances of the selected variants, in ``self.variants``
+        order ([native, n4bb, n4hh, n4bh, n4hb] by default).
+        """
+        if self.median_distances is not None:
+            return self.median_distances
+        volumes = [self.get_array(modality, variant) for modality in self.modalities for variant in self.variants]
+
+        # The arrays are Fortran ordered (nibabel), ravel in memory order so the rows are views
+        # on the (memory mapped) volumes; a median does not depend on the voxel order
+        brain_rows = [np.asarray(volume).ravel(order="K") for volume in volumes]
+        tumor_stack = np.stack([self.get_tumor_values(volume) for volume in volumes])
+        medians_whole_brain = _positive_medians(brain_rows)
+        medians_tumor = _positive_medians(tumor_stack)
+
+        distances = (medians_whole_brain - medians_tumor).reshape(len(self.modalities), len(self.variants))
+        self.median_distances = {modality: [float(d) for d in row] for modality, row in zip(self.modalities, distances)}
+        return self.median_distances
 
     def get_median_distance_T1(self):
-        t1_medians = []
-        for i in self._calculate_median_distances(self.native_t1_array, self.n4bb_t1_array, self.n4hh_t1_array, self.n4bh_t1_array, self.n4hb_t1_array):
-            t1_medians.append(i)
-        return t1_medians
+        return self.compute_median_distances()["T1"]
     def get_median_distance_T2(self):
-        t2_medians = []
-        for i in self._calculate_median_distances(self.native_t2_array, self.n4bb_t2_array, self.n4hh_t2_array, self.n4bh_t2_array, self.n4hb_t2_array):
-            t2_medians.append(i)
-        return t2_medians
+        return self.compute_median_distances()["T2"]
     def get_median_distance_T1c(self):
-        t1c_medians = []
-        for i in self._calculate_median_distances(self.native_t1c_array, self.n4bb_t1c_array, self.n4hh_t1c_array, self.n4bh_t1c_array, self.n4hb_t1c_array):
-            t1c_medians.append(i)
-        return t1c_medians
+        return self.compute_median_distances()["T1c"]
     def get_median_distance_FLAIR(self):
-        flair_medians = []
-        for i in self._calculate_median_distances(self.native_flair_array, self.n4bb_flair_array, self.n4hh_flair_array, self.n4bh_flair_array,
-                                                  self.n4hb_flair_array):
-            flair_medians.append(i)
-        return flair_medians
+        return self.compute_median_distances()["FLAIR"]
     def get_patient_df(self):
-        self.t1 = self.get_median_distance_T1()
-        self.t2 = self.get_median_distance_T2()
-        self.t1c = self.get_median_distance_T1c()
-        self.flair = self.get_median_distance_FLAIR()
-        df = pd.DataFrame()
+        """Median distance table, one row per selected modality and one column per selected variant."""
         data = []
-        for modality, values in zip(["T1", "T2", "T1c", "FLAIR"],[self.t1, self.t2, self.t1c, self.flair]):
+        for modality, values in self.compute_median_distances().items():
             data.append({"Patient":self.id,
                          "Modality":modality,
-                         'Native': values[0],
-                         'N4_Brain': values[1],
-                         'N4_Healthy': values[2],
-                         'N4_Brain_Healthy': values[3],
-                         'N4_Healthy_Brain': values[4]
+                         **{VARIANT_COLUMNS[variant]: value for variant, value in zip(self.variants, values)}
              })
         df = pd.DataFrame(data)
         return df
     def _center_and_intensity(self, volume):
-        # Computations for full volume
-        total_mass_volume = np.sum(volume)
-        z, y, x = np.indices(volume.shape)
-        if total_mass_volume == 0:
-            coords_full = None
-            intensity_at_com_full = np.nan
-        else:
-            z_com_full = np.sum(z * volume) / total_mass_volume
-            y_com_full = np.sum(y * volume) / total_mass_volume
-            x_com_full = np.sum(x * volume) / total_mass_volume
-            coords_full = [[z_com_full], [y_com_full], [x_com_full]]
-            intensity_at_com_full = map_coordinates(volume, coords_full, order=1)[0]
-
-        # Computations for masked volume
-        mask = self.tumor_binary_array
-        volume_masked = volume * mask
-        total_mass_masked = np.sum(volume_masked)
-        if total_mass_masked == 0:
-            coords_masked = None
-            intensity_at_com_masked = np.nan
-        else:
-            z_com_masked = np.sum(z * volume_masked) / total_mass_masked
-            y_com_masked = np.sum(y * volume_masked) / total_mass_masked
-            x_com_masked = np.sum(x * volume_masked) / total_mass_masked
-            coords_masked = [[z_com_masked], [y_com_masked], [x_com_masked]]
-            intensity_at_com_masked = map_coordinates(volume_masked, coords_masked, order=1)[0]
-
-        return {
-            "full": {"coords": coords_full, "intensity": intensity_at_com_full},
-            "masked": {"coords": coords_masked, "intensity": intensity_at_com_masked},
-            }
-    def compute_center_of_mass(self):
+        return self._center_and_intensity_batch([volume])[0]
+
+    def _center_and_intensity_batch(self, volumes):
+        """Full and tumor-masked center of mass, and the intensity there, of several volumes.
+
+        The full COM comes from the 1-D marginal profiles of each volume dotted with coordinate
+        ramps, the masked one from the tumor voxel values dotted with their coordinates, so no
+        coordinate or masked volume is ever allocated.
+        """
+        tumor_weights = self.get_tumor_values(self.tumor_binary_array).astype(np.float64)
+        tumor_coords = [axis_coords + bounds.start for axis_coords, bounds in zip(self.get_tumor_coords(), self.get_tumor_bbox())]
+        results = []
+        for volume in volumes:
+            volume = np.asarray(volume)
+
+            # Computations for full volume
+            plane_yx = volume.sum(axis=0, dtype=np.float64)
+            profiles = (volume.sum(axis=(1, 2), dtype=np.float64), plane_yx.sum(axis=1), plane_yx.sum(axis=0))
+            total_mass_volume = profiles[0].sum()
+            if total_mass_volume == 0:
+                coords_full = None
+                intensity_at_com_full = np.nan
+            else:
+                coords_full = [[profile @ np.arange(len(profile)) / total_mass_volume] for profile in profiles]
+                intensity_at_com_full = _interpolate_at(volume, coords_full)
+
+            # Computations for masked volume
+            values_masked = self.get_tumor_values(volume) * tumor_weights
+            total_mass_masked = values_masked.sum()
+            if total_mass_masked == 0:
+                coords_masked = None
+                intensity_at_com_masked = np.nan
+            else:
+                coords_masked = [[values_masked @ axis_coords / total_mass_masked] for axis_coords in tumor_coords]
+                intensity_at_com_masked = _interpolate_at(volume, coords_masked, mask=self.tumor_binary_array)
+
+            results.append({
+                "full": {"coords": coords_full, "intensity": intensity_at_com_full},
+                "masked": {"coords": coords_masked, "intensity": intensity_at_com_masked},
+            })
+        return results
+
+    def compute_center_of_mass(self, modalities=None):
+            variants = [variant for variant in N4_VARIANTS if variant in self.variants]
             self.com_data = {
-                "T1": {
-                    "n4bb": self._center_and_intensity(self.n4bb_t1_array),
-                    "n4hh": self._center_and_intensity(self.n4hh_t1_array),
-                    "n4bh": self._center_and_intensity(self.n4bh_t1_array),
-                    "n4hb": self._center_and_intensity(self.n4hb_t1_array),
-                },
-                "T1c": {
-                    "n4bb": self._center_and_intensity(self.n4bb_t1c_array),
-                    "n4hh": self._center_and_intensity(self.n4hh_t1c_array),
-                    "n4bh": self._center_and_intensity(self.n4bh_t1c_array),
-                    "n4hb": self._center_and_intensity(self.n4hb_t1c_array),
-                },
-                "T2": {
-                    "n4bb": self._center_and_intensity(self.n4bb_t2_array),
-                    "n4hh": self._center_and_intensity(self.n4hh_t2_array),
-                    "n4bh": self._center_and_intensity(self.n4bh_t2_array),
-                    "n4hb": self._center_and_intensity(self.n4hb_t2_array),
-                },
-                "FLAIR": {
-                    "n4bb": self._center_and_intensity(self.n4bb_flair_array),
-                    "n4hh": self._center_and_intensity(self.n4hh_flair_array),
-                    "n4bh": self._center_and_intensity(self.n4bh_flair_array),
-                    "n4hb": self._center_and_intensity(self.n4hb_flair_array),
-                },
+                modality: dict(zip(variants, self._center_and_intensity_batch(
+                    [self.get_array(modality, variant) for variant in variants])))
+                for modality in (self.modalities if modalities is None else modalities)
             }
             return self.com_data
 
     def _com_hexbin(self, volume, biasfield_volume):
-        mask = volume > 0
-        tumor_mask_array = self.tumor_binary_array
-
-        if tumor_mask_array is not None:
-            tumor_mask = (tumor_mask_array > 0) & mask
-        else:
-            tumor_mask = np.zeros_like(volume, dtype=bool)
-
-        x_vals_full = volume[mask]
-        y_vals_full = biasfield_volume[mask]
-
-        x_vals_tumor = volume[tumor_mask]
-        y_vals_tumor = biasfield_volume[tumor_mask]
-
-        # Center of mass for full image (weighted by hexbin)
-        fig1, ax1 = plt.subplots()
-        hb_full = ax1.hexbin(x_vals_full, y_vals_full, gridsize=50, cmap='Blues', mincnt=1)
-        counts_full = hb_full.get_array() #bin counts (weights): how many point in the bin?
-        offsets_full = hb_full.get_offsets() #bin centers
-
-        plt.close(fig1)
-
-        if len(counts_full) > 0:
-            com_full = (
-                np.average(offsets_full[:, 0], weights=counts_full),
-                np.average(offsets_full[:, 1], weights=counts_full)
-            )
-        else:
-            com_full = (None, None)
-
-        # Center of mass for tumor region (weighted by hexbin)
-        if len(x_vals_tumor) > 0:
-            fig2, ax2 = plt.subplots()
-            hb_tumor = ax2.hexbin(x_vals_tumor, y_vals_tumor, gridsize=50, cmap='Reds', mincnt=1)
-            counts_tumor = hb_tumor.get_array()
-            offsets_tumor = hb_tumor.get_offsets()
-            plt.close(fig2)
-
-            if len(counts_tumor) > 0:
-                com_tumor = (
-                    np.average(offsets_tumor[:, 0], weights=counts_tumor),
-                    np.average(offsets_tumor[:, 1], weights=counts_tumor)
-                )
-            else:
-                com_tumor = (None, None)
-        else:
-            com_tumor = (None, None)
+        return self._com_hexbin_batch([(volume, biasfield_volume)])[0]
 
-        return {
-            "com_full": com_full,
-            "com_tumor": com_tumor
-        }
+    def _com_hexbin_batch(self, pairs):
+        """Hexbin-weighted COM (gridsize=50, mincnt=1) of the full and tumor voxels of several (volume, biasfield) pairs."""
+        hexbin_pairs = []
+        for volume, biasfield_volume in pairs:
+            # Memory order ravels, views on the (memory mapped, Fortran ordered) volumes;
+            # both volumes share a layout, so their voxels stay paired
+            x_vals = np.asarray(volume).ravel(order="K")
+            y_vals = np.asarray(biasfield_volume).ravel(order="K")
+            mask = x_vals > 0
+            hexbin_pairs.append((x_vals[mask], y_vals[mask]))
+
+            x_vals_tumor = self.get_tumor_values(volume)
+            tumor_mask = x_vals_tumor > 0
+            hexbin_pairs.append((x_vals_tumor[tumor_mask], self.get_tumor_values(biasfield_volume)[tumor_mask]))
+
+        coms = [hexbin_center_of_mass(counts, offsets)
+                for counts, offsets in hexbin_counts_batch(hexbin_pairs, gridsize=50, mincnt=1)]
+        return [{"com_full": com_full, "com_tumor": com_tumor} for com_full, com_tumor in zip(coms[::2], coms[1::2])]
 
     def compute_com_scatterplot(self):
+        variants = [variant for variant in N4_VARIANTS if variant in self.variants]
         self.com_data = {
-            "T1": {
-                "n4bb": self._com_hexbin(self.n4bb_t1_array, self.biasfield_n4bb_t1_array),
-                "n4hh": self._com_hexbin(self.n4hh_t1_array, self.biasfield_n4hh_t1_array),
-                "n4bh": self._com_hexbin(self.n4bh_t1_array, self.biasfield_n4bh_t1_array),
-                "n4hb": self._com_hexbin(self.n4hb_t1_array, self.biasfield_n4hb_t1_array),
-            },
-            "T1c": {
-                "n4bb": self._com_hexbin(self.n4bb_t1c_array, self.biasfield_n4bb_t1c_array),
-                "n4hh": self._com_hexbin(self.n4hh_t1c_array, self.biasfield_n4hh_t1c_array),
-                "n4bh": self._com_hexbin(self.n4bh_t1c_array, self.biasfield_n4bh_t1c_array ),
-                "n4hb": self._com_hexbin(self.n4hb_t1c_array, self.biasfield_n4hb_t1c_array),
-            },
-            "T2": {
-                "n4bb": self._com_hexbin(self.n4bb_t2_array, self.biasfield_n4bb_t2_array),
-                "n4hh": self._com_hexbin(self.n4hh_t2_array, self.biasfield_n4hh_t2_array),
-                "n4bh": self._com_hexbin(self.n4bh_t2_array, self.biasfield_n4bh_t2_array),
-                "n4hb": self._com_hexbin(self.n4hb_t2_array, self.biasfield_n4hb_t2_array),
-            },
-            "FLAIR": {
-                "n4bb": self._com_hexbin(self.n4bb_flair_array, self.biasfield_n4bb_flair_array),
-                "n4hh": self._com_hexbin(self.n4hh_flair_array, self.biasfield_n4hh_flair_array),
-                "n4bh": self._com_hexbin(self.n4bh_flair_array, self.biasfield_n4bh_flair_array),
-                "n4hb": self._com_hexbin(self.n4hb_flair_array, self.biasfield_n4hb_flair_array),
-            },
+            modality: dict(zip(variants, self._com_hexbin_batch(
+                [(self.get_array(modality, variant), self.get_array(modality, variant, biasfield=True))
+                 for variant in variants])))
+            for modality in self.modalities
         }
-        return self.com_data
\ No newline at end of file
+        return self.com_data
@@ -0,0 +1,81 @@
+import os
+import json
+import numpy as np
+from Models.array_bundle import get_array_fingerprint, load_patient_array
+from Models.masks import INDEX_ORDER
+
+# Brain segmentation, brain without the tumor, tumor
+REGIONS = ("brain", "healthy", "tumor")
+
+
+def get_region_index_name(prefix, region):
+    return f"{prefix}_{region}_index"
+
+
+def get_region_index_info_path(array_dir, prefix):
+    """Index order and fingerprints of the masks the region indices of a patient were computed from."""
+    return os.path.join(array_dir, f"{prefix}_region_index.json")
+
+
+def get_mask_fingerprints(array_dir, prefix):
+    return {
+        "brain": get_array_fingerprint(array_dir, prefix, f"{prefix}_brain_segmentation_array"),
+        "tumor": get_array_fingerprint(array_dir, prefix, f"{prefix}_tumor_binary_array"),
+    }
+
+
+def compute_region_indices(brain_seg_array, tumor_mask_array):
+    """Flat (INDEX_ORDER) int32 indices of the brain, healthy brain and tumor voxels, in one pass over each mask."""
+    brain = np.asarray(brain_seg_array).ravel(order=INDEX_ORDER) > 0
+    tumor = np.asarray(tumor_mask_array).ravel(order=INDEX_ORDER) > 0
+    return {
+        "brain": np.flatnonzero(brain).astype(np.int32),
+        "healthy": np.flatnonzero(brain & ~tumor).astype(np.int32),
+        "tumor": np.flatnonzero(tumor).astype(np.int32),
+    }
+
+
+def save_region_indices(array_dir, prefix, brain_seg_array, tumor_mask_array, masks=None):
+    """Compute the region indices of a patient and save them as .npy next to the arrays (bundled with them).
+
+    ``masks`` are the get_mask_fingerprints of the two masks, taken before they were read.
+    """
+    if masks is None:
+        masks = get_mask_fingerprints(array_dir, prefix)
+    indices = compute_region_indices(brain_seg_array, tumor_mask_array)
+    for region, index in indices.items():
+        np.save(os.path.join(array_dir, f"{get_region_index_name(prefix, region)}.npy"), index)
+    with open(get_region_index_info_path(array_dir, prefix), "w") as f:
+        json.dump({"order": INDEX_ORDER, "masks": masks}, f)
+    return indices
+
+
+def get_region_indices(array_dir, prefix):
+    """Region indices of a patient, read from disk or computed from its masks and saved.
+
+    They are computed again when the brain segmentation or the tumor mask changed (size or
+    mtime of their file) since the indices were saved.
+    """
+    masks = get_mask_fingerprints(array_dir, prefix)
+    info_path = get_region_index_info_path(array_dir, prefix)
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            info = json.load(f)
+        if info == {"order": INDEX_ORDER, "masks": masks}:
+            try:
+                return {region: load_patient_array(array_dir, prefix, get_region_index_name(prefix, region))
+                        for region in REGIONS}
+            except FileNotFoundError:
+                pass
+    brain_seg_array = load_patient_array(array_dir, prefix, f"{prefix}_brain_segmentation_array")
+    tumor_mask_array = load_patient_array(array_dir, prefix, f"{prefix}_tumor_binary_array")
+    return save_region_indices(array_dir, prefix, brain_seg_array, tumor_mask_array, masks)
+
+
+def gather(array, index):
+    """Values of a volume at flat (INDEX_ORDER) indices.
+
+    Raveling a Fortran ordered (memory mapped) volume in Fortran order is a view, so only
+    the gathered values are copied; a C ordered volume is copied once by the ravel.
+    """
+    return np.take(np.asarray(array).ravel(order=INDEX_ORDER), index)
@@ -0,0 +1,59 @@
+import importlib
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+# Modules every worker imports once when it starts, instead of once per task
+WORKER_IMPORTS = ("numpy", "Models.patient")
+
+_worker = {}
+
+
+def _init_worker(shm_name, shape, dtype, imports):
+    for module in imports:
+        importlib.import_module(module)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker["shm"] = shm  # keep the mapping alive as long as the worker
+    _worker["results"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _run_task(args):
+    function, index, item = args
+    try:
+        row = function(item)
+    except Exception as e:
+        print(f"Error processing {item}: {e}")
+        return index, False
+    if row is None:
+        return index, False
+    _worker["results"][index] = row
+    return index, True
+
+
+def run_cohort(function, items, row_shape, max_workers=None, imports=WORKER_IMPORTS, dtype=np.float64, chunksize=1):
+    """Map ``function`` over ``items`` on a pool of long-lived workers writing into one shared array.
+
+    ``function`` (a module-level function) returns a fixed-layout array of ``row_shape``
+    for one item, or None. Workers write it straight into row ``i`` of a cohort array in
+    shared memory, so only the item and the row index go through pickling. Returns the
+    (len(items), *row_shape) results, NaN where the function returned None or failed,
+    and a bool array of the items that succeeded.
+    """
+    items = list(items)
+    shape = (len(items), *row_shape)
+    nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    try:
+        results = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        results.fill(np.nan)
+        done = np.zeros(len(items), dtype=bool)
+        with multiprocessing.Pool(processes=max_workers, initializer=_init_worker,
+                                  initargs=(shm.name, shape, np.dtype(dtype).str, imports)) as pool:
+            tasks = ((function, index, item) for index, item in enumerate(items))
+            for index, ok in pool.imap_unordered(_run_task, tasks, chunksize=chunksize):
+                done[index] = ok
+        results = results.copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return results, done
@@ -0,0 +1,72 @@
+import os
+import json
+import numpy as np
+from Models.array_bundle import get_array_fingerprint, load_patient_array
+
+# Voxels added on every side of the tumor bounding box by default
+TUMOR_BBOX_MARGIN = 0
+
+
+def get_bbox_path(array_dir, prefix):
+    return os.path.join(array_dir, f"{prefix}_tumor_bbox.json")
+
+
+def compute_bbox(mask):
+    """Lower (inclusive) and upper (exclusive) corners of the nonzero voxels of a mask, all zero when it is empty."""
+    mask = np.asarray(mask) > 0
+    lower, upper = [], []
+    for axis in range(mask.ndim):
+        profile = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        if len(profile) == 0:
+            return [0] * mask.ndim, [0] * mask.ndim
+        lower.append(int(profile[0]))
+        upper.append(int(profile[-1]) + 1)
+    return lower, upper
+
+
+def get_mask_fingerprint(array_dir, prefix):
+    """get_array_fingerprint of the tumor mask, None when there is no mask."""
+    return get_array_fingerprint(array_dir, prefix, f"{prefix}_tumor_binary_array")
+
+
+def save_bbox(array_dir, prefix, mask):
+    """Compute the tumor bounding box of a patient from its mask and store it next to the arrays.
+
+    Call it once the mask itself is saved: the size and mtime of the mask file are stored with
+    the box, so get_tumor_bbox recomputes it when the mask is written again.
+    """
+    lower, upper = compute_bbox(mask)
+    bbox = {"lower": lower, "upper": upper, "shape": [int(n) for n in np.shape(mask)],
+            "source": get_mask_fingerprint(array_dir, prefix)}
+    with open(get_bbox_path(array_dir, prefix), "w") as f:
+        json.dump(bbox, f)
+    return bbox
+
+
+def get_tumor_bbox(array_dir, prefix, mask=None, margin=TUMOR_BBOX_MARGIN):
+    """Tuple of slices cropping the patient arrays to the tumor, grown by ``margin`` voxels.
+
+    The box is read from ``{prefix}_tumor_bbox.json``; the first time, or when the mask file
+    changed since the box was saved, it is computed from ``mask`` (or the stored tumor mask)
+    and saved there.
+    """
+    bbox_path = get_bbox_path(array_dir, prefix)
+    bbox = None
+    if os.path.exists(bbox_path):
+        with open(bbox_path) as f:
+            bbox = json.load(f)
+        if bbox.get("source") != get_mask_fingerprint(array_dir, prefix):
+            bbox = None
+    if bbox is None:
+        if mask is None:
+            mask = load_patient_array(array_dir, prefix, f"{prefix}_tumor_binary_array")
+        bbox = save_bbox(array_dir, prefix, mask)
+    if bbox["lower"] == bbox["upper"]:  # no tumor voxel, empty crop
+        return tuple(slice(0, 0) for _ in bbox["shape"])
+    return tuple(slice(max(l - margin, 0), min(u + margin, n))
+                 for l, u, n in zip(bbox["lower"], bbox["upper"], bbox["shape"]))
+
+
+def crop_to_bbox(array, bbox):
+    """View of ``array`` inside ``bbox``, ``array`` itself when there is no box."""
+    return array if bbox is None else array[bbox]
@@ -1,16 +1,25 @@
 import os
-import subprocess
 from save_files import CONTROL1, CONTROL_anat, NEW_DIR
+from n4_cache import get_cached_n4_jobs, run_cached_n4_jobs
+from n4_scheduler import N4_BACKEND, N4_OUTPUTS
+from cohort_manifest import get_patient_folders, run_incremental_jobs
 
+# Name of this step in the cohort manifest
+STAGE = "n4_brain"
+# Backend, outputs and n4_sitk keyword arguments (shrink_factor, iterations, ...) of every
+# N4 run, recorded in the manifest so that changing them reruns the stage. Lists, not
+# tuples, as they are compared with their JSON round trip
+N4_PARAMS = {"backend": N4_BACKEND, "outputs": list(N4_OUTPUTS), "n4_params": {}}
 
 
-for folder in os.listdir(NEW_DIR):
+def get_patient_jobs(folder):
+    jobs = []
     folder_path = os.path.join(NEW_DIR, folder)
     folder_name = folder.split('_')[0]
 
     # Check if it's a subject folder
     if os.path.isdir(folder_path) and folder.startswith(CONTROL1):
-        print(f"Processing folder: {folder}")
+        print(f"Collecting jobs for folder: {folder}")
 
         anat_dir = os.path.join(folder_path, "anat")
         seg_dir = os.path.join(folder_path, "seg")
@@ -53,21 +62,22 @@ for folder in os.listdir(NEW_DIR):
                     }
                 ]
 
-                for command in commands:
-                    output_corrected = os.path.join(reg_dir, f"{command['output_name']}.nii.gz")
-                    output_biasfield = os.path.join(reg_dir, f"biasfield_{command['output_name']}.nii.gz")
+                # Identical (image, weight, mask) runs are computed once and linked
+                jobs.extend(get_cached_n4_jobs(input_path, commands, reg_dir, **N4_PARAMS))
+    return jobs
 
-                    n4_command = (
-                        f"N4BiasFieldCorrection -d 3 "
-                        f"-i {input_path} "
-                        f"-w {command['weight']} "
-                        f"-x {command['mask']} "
-                        f"-o [ {output_corrected}, {output_biasfield} ]"
-                    )
-                    print(f"Executing: {n4_command}")
-                    subprocess.run(n4_command, shell=True)
-                    # Denoising step
-                    denoised_output = os.path.join(reg_dir, f"{command['output_name']}_dn.nii.gz")
-                    denoise_command = f"DenoiseImage -d 3 -i {output_corrected} -o {denoised_output}"
-                    print(f"Executing: {denoise_command}")
-                    subprocess.run(denoise_command, shell=True)
+
+def get_patient_inputs(folder):
+    folder_name = folder.split('_')[0]
+    anat_dir = os.path.join(NEW_DIR, folder, "anat")
+    seg_dir = os.path.join(NEW_DIR, folder, "seg")
+    return [os.path.join(anat_dir, f"{folder_name}_{anat}") for anat in CONTROL_anat] + [
+        os.path.join(seg_dir, f"{folder_name}_brain_segmentation.nii.gz"),
+        os.path.join(seg_dir, f"{folder_name}_brain_parenchyma_segmentation.nii.gz"),
+    ]
+
+
+if __name__ == "__main__":
+    # Jobs are collected (and images fingerprinted) only for the patients whose inputs changed
+    run_incremental_jobs(STAGE, NEW_DIR, get_patient_folders(NEW_DIR, CONTROL1), get_patient_jobs,
+                         get_patient_inputs, run_cached_n4_jobs, params=N4_PARAMS)
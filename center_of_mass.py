@@ -2,15 +2,38 @@ import os
 import re
 import numpy as np
 import matplotlib.pyplot as plt
-from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Adjust this import path as needed
-from Models.patient import Patient
+from Models.patient import Patient, N4_VARIANTS, VARIANT_SUFFIXES
+from Models.metrics_cache import get_metrics_db_path, get_or_compute_metrics
+from Models.shared_pool import run_cohort
 
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 INPUT_MRI = ["T1", "T1c", "T2", "FLAIR"]
-
-def plot_com_intensities(patient_data_list, modality="T1"):
+# Axes of the Patient.compute_center_of_mass coordinates, in array order
+COM_AXES = ("z", "y", "x")
+# Names of the COM coordinates and intensities in the metrics cache
+COM_METRICS = tuple(f"com_{region}_{name}" for region in ("full", "masked") for name in (*COM_AXES, "intensity"))
+# Version of the cached COM metrics, bumped when their meaning changes (2: axes named in array order)
+COM_METRICS_VERSION = 2
+# Fixed layout of the results of one patient: modality x N4 variant x COM metric
+COM_ROW_SHAPE = (len(INPUT_MRI), len(N4_VARIANTS), len(COM_METRICS))
+
+
+def com_to_metrics(com_modality):
+    """{(variant, metric): value} of the Patient.compute_center_of_mass results of one modality, NaN coords when there is no COM."""
+    metrics = {}
+    for variant, com in com_modality.items():
+        for region in ("full", "masked"):
+            coords = com[region]["coords"]
+            for axis, name in enumerate(COM_AXES):
+                metrics[(variant, f"com_{region}_{name}")] = np.nan if coords is None else float(coords[axis][0])
+            metrics[(variant, f"com_{region}_intensity")] = float(com[region]["intensity"])
+    return metrics
+
+
+def plot_com_intensities(com_results, modality="T1"):
+    """Full vs masked COM intensity of every patient, ``com_results`` being the (patients, *COM_ROW_SHAPE) array."""
     corrections = ["n4bb", "n4hh", "n4bh", "n4hb"]
     colors = {"n4bb": "blue", "n4hh": "green", "n4bh": "red", "n4hb": "purple"}
 
@@ -18,18 +41,11 @@ def plot_com_intensities(patient_data_list, modality="T1"):
     axes = axes.flatten()
 
     for idx, correction in enumerate(corrections):
-        x_vals, y_vals = [], []
-        for pdata in patient_data_list:
-            com_data = pdata.get("com_data", {})
-            if modality not in com_data or correction not in com_data[modality]:
-                continue
-
-            com = com_data[modality][correction]
-            x, y = com["full"]["intensity"], com["masked"]["intensity"]
-
-            if not (np.isnan(x) or np.isnan(y)):
-                x_vals.append(x)
-                y_vals.append(y)
+        com = com_results[:, INPUT_MRI.index(modality), N4_VARIANTS.index(correction)]
+        x_vals = com[:, COM_METRICS.index("com_full_intensity")]
+        y_vals = com[:, COM_METRICS.index("com_masked_intensity")]
+        valid = ~(np.isnan(x_vals) | np.isnan(y_vals))
+        x_vals, y_vals = x_vals[valid], y_vals[valid]
 
         ax = axes[idx]
         ax.scatter(x_vals, y_vals, alpha=0.7, color=colors[correction])
@@ -54,30 +70,30 @@ def process_patient(folder):
 
     numeric_id = match.group()
     try:
-        p = Patient(numeric_id, local=False, mmap=True)  # Custom `mmap` arg if supported
-        p.compute_center_of_mass()
-        data = {"id": numeric_id, "com_data": p.com_data}
+        p = Patient(numeric_id, local=False, mmap=True, variants=N4_VARIANTS)
+        array_dir = os.path.join(p.dir, "array")
+        row = np.full(COM_ROW_SHAPE, np.nan)
+        for m, modality in enumerate(INPUT_MRI):
+            # Recomputed only when one of the N4 arrays or the tumor mask changed
+            sources = [f"{p.prefix}_{modality}{VARIANT_SUFFIXES[variant]}_rescaled" for variant in N4_VARIANTS]
+            sources.append(f"{p.prefix}_tumor_binary_array")
+            metrics = get_or_compute_metrics(get_metrics_db_path(NEW_DIR), array_dir, p.prefix, modality, COM_METRICS, sources,
+                                             lambda: com_to_metrics(p.compute_center_of_mass([modality])[modality]),
+                                             version=COM_METRICS_VERSION)
+            for v, variant in enumerate(N4_VARIANTS):
+                row[m, v] = [metrics[(variant, metric)] for metric in COM_METRICS]
         del p  # Explicitly free memory
         print(f"Processed patient: {numeric_id}")
-        return data
+        return row
     except Exception as e:
         print(f"Error processing {numeric_id}: {e}")
         return None
 
 
 def parallel_process_patients(folders, max_workers=4):
-    patient_data_list = []
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(process_patient, folder): folder for folder in folders}
-        for future in as_completed(futures):
-            try:
-                result = future.result()
-                if result is not None:
-                    patient_data_list.append(result)
-            except Exception as e:
-                folder = futures[future]
-                print(f"Exception processing folder {folder}: {e}")
-    return patient_data_list
+    """COM results of every patient folder as one (patients, *COM_ROW_SHAPE) array, written by the workers in shared memory."""
+    com_results, done = run_cohort(process_patient, folders, COM_ROW_SHAPE, max_workers=max_workers)
+    return com_results[done]
 
 
 # MAIN
@@ -86,7 +102,7 @@ if __name__ == "__main__":
     folders = [f for f in folders if os.path.isdir(os.path.join(NEW_DIR, f))]
 
     print("Starting parallel processing...")
-    patient_data_list = parallel_process_patients(folders, max_workers=4)  # Adjust as needed
+    com_results = parallel_process_patients(folders, max_workers=4)  # Adjust as needed
 
     for modality in INPUT_MRI:
-        plot_com_intensities(patient_data_list, modality=modality)
+        plot_com_intensities(com_results, modality=modality)
@@ -1,28 +1,32 @@
 import os
-import subprocess
+import multiprocessing
 from save_files import NEW_DIR
+from Models.image_stats import image_stats
 
-empty_tumor_patients = []
 
-for folder in os.listdir(NEW_DIR):
+def count_tumor_voxels(folder):
+    """Non-zero voxels of the tumor binary mask of a folder (fslstats -V), None when there is no mask."""
     folder_path = os.path.join(NEW_DIR, folder)
     folder_name = folder.split('_')[0]
+    tumor_binary = os.path.join(folder_path, "seg", f"{folder_name}_tumor_binary.nii.gz")
+    if not os.path.exists(tumor_binary):
+        return None
+    try:
+        return image_stats(tumor_binary, percentiles=())["nonzero"]
+    except Exception as e:
+        print(f"Error reading stats for {tumor_binary}: {e}")
+        return None
 
-    if os.path.isdir(folder_path):
-        seg_dir = os.path.join(folder_path, "seg")
-        tumor_binary = os.path.join(seg_dir, f"{folder_name}_tumor_binary.nii.gz")
 
-        if os.path.exists(tumor_binary):
-            try:
-                result = subprocess.run(["fslstats", tumor_binary, "-V"], capture_output=True, text=True, check=True)
-                voxel_count = int(result.stdout.strip().split()[0])
-                if voxel_count == 0:
-                    empty_tumor_patients.append(folder)
-            except subprocess.CalledProcessError as e:
-                print(f"Error reading stats for {tumor_binary}: {e}")
+if __name__ == "__main__":
+    folders = [folder for folder in os.listdir(NEW_DIR) if os.path.isdir(os.path.join(NEW_DIR, folder))]
 
-print(f"\nTotal patients with empty tumor masks: {len(empty_tumor_patients)}")
-if empty_tumor_patients:
-    print("Patients with empty tumor masks:")
-    for patient in empty_tumor_patients:
-        print(patient)
+    with multiprocessing.Pool() as pool:
+        voxel_counts = pool.map(count_tumor_voxels, folders)
+    empty_tumor_patients = [folder for folder, voxel_count in zip(folders, voxel_counts) if voxel_count == 0]
+
+    print(f"\nTotal patients with empty tumor masks: {len(empty_tumor_patients)}")
+    if empty_tumor_patients:
+        print("Patients with empty tumor masks:")
+        for patient in empty_tumor_patients:
+            print(patient)
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import multiprocessing
+from contextlib import contextmanager
+
+# Record, in the cohort directory, of what every stage last did for every patient
+MANIFEST_NAME = "cohort_manifest.json"
+# Seconds after which a manifest lock file is taken as left behind by a crashed run
+MANIFEST_LOCK_TIMEOUT = 60
+
+
+# ------------------------------------------------------------
+# Manifest
+# ------------------------------------------------------------
+def get_manifest_path(base_dir):
+    return os.path.join(base_dir, MANIFEST_NAME)
+
+
+def load_manifest(base_dir):
+    """{stage: {patient folder: {"inputs": {path: [size, mtime_ns]}, "params": ..., "outputs": [paths]}}}"""
+    manifest_path = get_manifest_path(base_dir)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+@contextmanager
+def _manifest_lock(base_dir):
+    """Lock file held while the manifest is read, merged and written again.
+
+    Created with O_EXCL rather than flock, which network mounts do not all support.
+    """
+    lock_path = f"{get_manifest_path(base_dir)}.lock"
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > MANIFEST_LOCK_TIMEOUT:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+def save_manifest(base_dir, manifest, stage):
+    """Merge the records of ``stage`` into the manifest on disk, under a lock.
+
+    The other stages, and the patients of ``stage`` recorded by another run, are kept as
+    they are on disk, so stages running at the same time do not overwrite each other's
+    records with their stale copy. ``manifest`` is refreshed with the merged result.
+    """
+    manifest_path = get_manifest_path(base_dir)
+    with _manifest_lock(base_dir):
+        merged = load_manifest(base_dir)
+        merged.setdefault(stage, {}).update(manifest.get(stage, {}))
+        # Written next to the manifest then renamed, so an interrupted run never leaves it truncated
+        with open(f"{manifest_path}.tmp", "w") as f:
+            json.dump(merged, f, indent=1, sort_keys=True)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+    manifest.update(merged)
+
+
+def get_patient_folders(base_dir, prefix):
+    """Patient folders (names starting with ``prefix``) of a cohort directory, sorted."""
+    return sorted(folder for folder in os.listdir(base_dir)
+                  if folder.startswith(prefix) and os.path.isdir(os.path.join(base_dir, folder)))
+
+
+def fingerprint_files(paths):
+    """{path: [size, mtime_ns]} of the input files of a stage, None for the missing ones."""
+    fingerprint = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            fingerprint[path] = [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError:
+            fingerprint[path] = None
+    return fingerprint
+
+
+def needs_run(manifest, stage, folder, inputs, params=None):
+    """True when a stage never ran for a patient, its inputs or parameters changed, or one of its outputs is missing."""
+    entry = manifest.get(stage, {}).get(folder)
+    if entry is None:
+        return True
+    if entry["inputs"] != fingerprint_files(inputs) or entry.get("params") != params:
+        return True
+    return not all(os.path.exists(path) for path in entry["outputs"])
+
+
+def record_run(manifest, stage, folder, inputs, outputs, params=None):
+    manifest.setdefault(stage, {})[folder] = {
+        "inputs": fingerprint_files(inputs),
+        "params": params,
+        "outputs": [path for path in outputs if os.path.exists(path)],
+    }
+
+
+# ------------------------------------------------------------
+# Incremental runner
+# ------------------------------------------------------------
+def _run_folder(args):
+    process, folder = args
+    try:
+        return folder, process(folder) is not False
+    except Exception as e:
+        print(f"Error processing {folder}: {e}")
+        return folder, False
+
+
+def run_incremental(stage, base_dir, folders, process, get_inputs, get_outputs, params=None, processes=1):
+    """Run ``process(folder)`` only for the patients whose ``stage`` is out of date, recording each success.
+
+    ``get_inputs(folder)`` and ``get_outputs(folder)`` give the files a stage reads and
+    writes for a patient. A patient is processed again only when the size or mtime of one
+    of its inputs changed, ``params`` changed or a recorded output disappeared. A failed
+    patient (exception or ``False`` returned) is not recorded, so the next run retries it.
+    The manifest is saved after every patient, so an interrupted run keeps its progress;
+    only the records of ``stage`` are merged into it, so other stages may run at the same time.
+    Returns the folders that were processed successfully.
+    """
+    manifest = load_manifest(base_dir)
+    pending = [folder for folder in folders if needs_run(manifest, stage, folder, get_inputs(folder), params)]
+    print(f"{stage}: {len(pending)} of {len(folders)} patients to process")
+
+    processed = []
+    with multiprocessing.Pool(processes=processes) as pool:
+        for folder, ok in pool.imap_unordered(_run_folder, [(process, folder) for folder in pending]):
+            if not ok:
+                continue
+            # Inputs fingerprinted as the outputs were written (a stage may add inputs of its own, e.g. region indices)
+            record_run(manifest, stage, folder, get_inputs(folder), get_outputs(folder), params)
+            save_manifest(base_dir, manifest, stage)
+            processed.append(folder)
+    return processed
+
+
+def run_incremental_jobs(stage, base_dir, folders, get_jobs, get_inputs, run_jobs, params=None):
+    """run_incremental for stages run as one job graph (n4_scheduler): ``get_jobs(folder)`` is only
+    called for the out of date patients, and a patient is recorded once all its jobs are done or skipped.
+    """
+    manifest = load_manifest(base_dir)
+    pending = [folder for folder in folders if needs_run(manifest, stage, folder, get_inputs(folder), params)]
+    print(f"{stage}: {len(pending)} of {len(folders)} patients to process")
+
+    jobs = {folder: get_jobs(folder) for folder in pending}
+    status = run_jobs([job for folder_jobs in jobs.values() for job in folder_jobs])
+
+    processed = []
+    for folder, folder_jobs in jobs.items():
+        if all(status.get(job["name"]) in ("done", "skipped") for job in folder_jobs):
+            outputs = [path for job in folder_jobs for path in job["outputs"]]
+            record_run(manifest, stage, folder, get_inputs(folder), outputs, params)
+            processed.append(folder)
+    save_manifest(base_dir, manifest, stage)
+    return processed
@@ -2,16 +2,20 @@ import os
 import re
 import numpy as np
 import matplotlib.pyplot as plt
-from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Adjust this import path as needed
-from Models.patient import Patient
+from Models.patient import Patient, N4_VARIANTS
+from Models.shared_pool import run_cohort
 
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 INPUT_MRI = ["T1", "T1c", "T2", "FLAIR"]
+# Fixed layout of the results of one patient: modality x N4 variant x (full, tumor) x (image, biasfield) CoM
+COM_REGIONS = ("com_full", "com_tumor")
+COM_ROW_SHAPE = (len(INPUT_MRI), len(N4_VARIANTS), len(COM_REGIONS), 2)
 
 
-def plot_com_from_hexbins_with_tumor(patient_data_list, modality="T1"):
+def plot_com_from_hexbins_with_tumor(com_results, modality="T1"):
+    """Hexbin CoMs of every patient, ``com_results`` being the (patients, *COM_ROW_SHAPE) array."""
     corrections = ["n4bb", "n4hh", "n4bh", "n4hb"]
     colors = {"n4bb": "blue", "n4hh": "green", "n4bh": "red", "n4hb": "purple"}
 
@@ -19,25 +23,11 @@ def plot_com_from_hexbins_with_tumor(patient_data_list, modality="T1"):
     axes = axes.flatten()
 
     for idx, correction in enumerate(corrections):
-        x_full, y_full = [], []
-        x_tumor, y_tumor = [], []
-
-        for pdata in patient_data_list:
-            com_data = pdata.get("com_data", {})
-            if modality not in com_data or correction not in com_data[modality]:
-                continue
-
-            com = com_data[modality][correction]
-            com_full = com.get("com_full", None)
-            com_tumor = com.get("com_tumor", None)
-
-            if com_full is not None and not (np.isnan(com_full[0]) or np.isnan(com_full[1])):
-                x_full.append(com_full[0])
-                y_full.append(com_full[1])
-
-            if com_tumor is not None and not (np.isnan(com_tumor[0]) or np.isnan(com_tumor[1])):
-                x_tumor.append(com_tumor[0])
-                y_tumor.append(com_tumor[1])
+        com = com_results[:, INPUT_MRI.index(modality), N4_VARIANTS.index(correction)]
+        com_full = com[:, COM_REGIONS.index("com_full")]
+        com_tumor = com[:, COM_REGIONS.index("com_tumor")]
+        x_full, y_full = com_full[~np.isnan(com_full).any(axis=1)].T
+        x_tumor, y_tumor = com_tumor[~np.isnan(com_tumor).any(axis=1)].T
 
         ax = axes[idx]
         ax.scatter(x_full, y_full, alpha=0.7, color='red', label="Full Volume", marker='o')
@@ -65,30 +55,26 @@ def process_patient(folder):
 
     numeric_id = match.group()
     try:
-        p = Patient(numeric_id, local=False, mmap=True)  # Custom `mmap` arg if supported
+        p = Patient(numeric_id, local=False, mmap=True, variants=N4_VARIANTS)
         p.compute_com_scatterplot()
-        data = {"id": numeric_id, "com_data": p.com_data}
+        row = np.full(COM_ROW_SHAPE, np.nan)
+        for m, modality in enumerate(INPUT_MRI):
+            for v, variant in enumerate(N4_VARIANTS):
+                for r, region in enumerate(COM_REGIONS):
+                    # (None, None) when no hexbin had mincnt voxels
+                    row[m, v, r] = np.array(p.com_data[modality][variant][region], dtype=np.float64)
         del p  # Explicitly free memory
         print(f"Processed patient: {numeric_id}")
-        return data
+        return row
     except Exception as e:
         print(f"Error processing {numeric_id}: {e}")
         return None
 
 
 def parallel_process_patients(folders, max_workers=4):
-    patient_data_list = []
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(process_patient, folder): folder for folder in folders}
-        for future in as_completed(futures):
-            try:
-                result = future.result()
-                if result is not None:
-                    patient_data_list.append(result)
-            except Exception as e:
-                folder = futures[future]
-                print(f"Exception processing folder {folder}: {e}")
-    return patient_data_list
+    """Hexbin CoMs of every patient folder as one (patients, *COM_ROW_SHAPE) array, written by the workers in shared memory."""
+    com_results, done = run_cohort(process_patient, folders, COM_ROW_SHAPE, max_workers=max_workers)
+    return com_results[done]
 
 
 # MAIN
@@ -97,7 +83,7 @@ if __name__ == "__main__":
     folders = [f for f in folders if os.path.isdir(os.path.join(NEW_DIR, f))]
 
     print("Starting parallel processing...")
-    patient_data_list = parallel_process_patients(folders, max_workers=4)  # Adjust as needed
+    com_results = parallel_process_patients(folders, max_workers=4)  # Adjust as needed
 
     for modality in INPUT_MRI:
-        plot_com_from_hexbins_with_tumor(patient_data_list, modality=modality)
+        plot_com_from_hexbins_with_tumor(com_results, modality=modality)
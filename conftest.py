@@ -0,0 +1,2 @@
+# test_folder_creator.py is a script writing test_dataset/, not a test module
+collect_ignore = ["test_folder_creator.py"]
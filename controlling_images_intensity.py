@@ -1,9 +1,11 @@
 import os
-import subprocess
+import multiprocessing
 from pathlib import Path
 import pandas as pd
 import numpy as np
 
+from Models.image_stats import image_stats
+
 # ============================================================
 #                     CONFIGURATION CONSTANTS
 # ============================================================
@@ -65,16 +67,14 @@ def should_process_image(image_modality, image_variant, image_name):
     return True
 
 # ============================================================
-#                     FSL UTILS
+#                     STATS UTILS
 # ============================================================
 
 def fslstats(image_path: Path):
-    """Return min, max, mean, std, p95."""
+    """Return min, max, mean, std, p95, as fslstats -R -m -s -P 95 (computed in-process, no FSL needed)."""
     try:
-        cmd = ["fslstats", str(image_path), "-R", "-m", "-s", "-P", "95"]
-        result = subprocess.check_output(cmd, text=True).strip().split()
-        min_val, max_val, mean_val, std_val, p95 = map(float, result)
-        return min_val, max_val, mean_val, std_val, p95
+        stats = image_stats(image_path, percentiles=(95,))
+        return stats["min"], stats["max"], stats["mean"], stats["std"], stats["p95"]
     except Exception as e:
         print(f"⚠ Error reading {image_path}: {e}")
         return None, None, None, None, None
@@ -103,8 +103,8 @@ def detect_outliers(series: pd.Series, method="iqr"):
 #                     MAIN EXTRACTION
 # ============================================================
 
-def collect_intensity_stats():
-    data = []
+def collect_intensity_stats(processes=None):
+    images = []
 
     for patient_dir in os.listdir(MAIN_FOLDER):
         print("DEBUG patient_dir:", patient_dir)
@@ -125,30 +125,28 @@ def collect_intensity_stats():
             image_modality, image_variant = get_image_modality_and_variant(image_name)
             print(image_modality, image_variant)
             if should_process_image(image_modality, image_variant, image_name):
+                label = f"{image_modality}_{image_variant}"
+                image_path = Path(f"{MAIN_FOLDER}/{patient_dir}/{REG_FOLDER_NAME}/{image_name}")
+                images.append((patient_number, image_name, label, image_path))
 
+    # Statistics of all the images of all the patients in parallel
+    with multiprocessing.Pool(processes=processes) as pool:
+        all_stats = pool.map(fslstats, [image_path for _, _, _, image_path in images])
 
-                label = f"{image_modality}_{image_variant}"
+    data = []
+    for (patient_number, image_name, label, image_path), (minv, maxv, meanv, stdv, p95) in zip(images, all_stats):
+        print(image_path)
+        row = {
+            "patient": patient_number,
+            "image": image_name,
+            f"min_{label}": minv,
+            f"max_{label}": maxv,
+            f"mean_{label}": meanv,
+            f"std_{label}": stdv,
+            f"p95_{label}": p95
+        }
 
-                image_path = Path(f"{MAIN_FOLDER}/{patient_dir}/{REG_FOLDER_NAME}/{image_name}")
-                print(image_path)
-                #minv, maxv, meanv, stdv, p95 = fslstats(image_path)
-                try:
-                    minv, maxv, meanv, stdv, p95 = fslstats(image_path)
-                except Exception as e:
-                    print(f"      ❌ fslstats FAILED on {image_path}: {e}")
-                    continue
-
-                row = {
-                    "patient": patient_number,
-                    "image": image_name,
-                    f"min_{label}": minv,
-                    f"max_{label}": maxv,
-                    f"mean_{label}": meanv,
-                    f"std_{label}": stdv,
-                    f"p95_{label}": p95
-                }
-
-                data.append(row)
+        data.append(row)
 
     # Build DataFrame
     df = pd.DataFrame(data)
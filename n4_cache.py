@@ -0,0 +1,204 @@
+import os
+import json
+import shutil
+import hashlib
+import nibabel as nib
+import numpy as np
+from n4_scheduler import get_n4_jobs, get_n4_output_paths, run_jobs, N4_OUTPUTS, N4_BACKEND
+from cohort_manifest import fingerprint_files
+
+# Index of the N4 runs completed in a reg/ directory:
+# cache key -> {"output_name": ..., "outputs": {path: [size, mtime_ns]}}
+CACHE_INDEX_NAME = ".n4_cache.json"
+# Voxel fingerprints of the NIfTIs of a directory: file name -> [size, mtime_ns, sha256]
+FINGERPRINTS_NAME = ".n4_fingerprints.json"
+
+_fingerprints = {}  # directory -> its fingerprints file, loaded once per process
+
+
+# ------------------------------------------------------------
+# Content addressing
+# ------------------------------------------------------------
+def _write_json(path, data):
+    # Written next to the file then renamed, so an interrupted run never leaves it truncated
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def _load_fingerprints(directory):
+    if directory not in _fingerprints:
+        fingerprints_path = os.path.join(directory, FINGERPRINTS_NAME)
+        if os.path.exists(fingerprints_path):
+            with open(fingerprints_path) as f:
+                _fingerprints[directory] = json.load(f)
+        else:
+            _fingerprints[directory] = {}
+    return _fingerprints[directory]
+
+
+def fingerprint_image(path):
+    """SHA-256 of the voxel data, shape and affine of a NIfTI, kept on disk keyed by (path, size, mtime).
+
+    The decoded voxels are hashed rather than the file bytes, so identical masks written
+    at different times (different gzip headers) get the same fingerprint. Each digest is
+    stored in the FINGERPRINTS_NAME file of the image's directory, so an image is only
+    decompressed again after it changed.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    stat = os.stat(path)
+    fingerprints = _load_fingerprints(directory)
+    entry = fingerprints.get(name)
+    if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry[2]
+
+    img = nib.load(path)
+    digest = hashlib.sha256()
+    digest.update(str(img.shape).encode())
+    digest.update(np.asarray(img.affine, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(np.asanyarray(img.dataobj)).tobytes())
+    fingerprints[name] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    _write_json(os.path.join(directory, FINGERPRINTS_NAME), fingerprints)
+    return digest.hexdigest()
+
+
+def n4_cache_key(input_path, weight, mask, backend=N4_BACKEND, n4_params=None):
+    """Key of one N4 run: fingerprints of the image, weight and mask plus the N4 backend and parameters."""
+    description = {
+        "input": fingerprint_image(input_path),
+        "weight": fingerprint_image(weight),
+        "mask": fingerprint_image(mask),
+        "backend": backend,
+        "params": n4_params or {},
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_cache_index(reg_dir):
+    index_path = os.path.join(reg_dir, CACHE_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        # Entries without their output fingerprints (older indexes) are not trusted
+        return {key: entry for key, entry in json.load(f).items() if isinstance(entry, dict)}
+
+
+def save_cache_index(reg_dir, index):
+    _write_json(os.path.join(reg_dir, CACHE_INDEX_NAME), index)
+
+
+def get_cached_outputs(index, key, reg_dir, outputs=N4_OUTPUTS):
+    """Output name of a completed run recorded under ``key``, None when there is none or its outputs
+    are missing or changed (size or mtime) since the run was recorded.
+    """
+    entry = index.get(key)
+    if entry is None:
+        return None
+    paths = [get_n4_output_paths(entry["output_name"], reg_dir)[output] for output in outputs]
+    recorded = entry["outputs"]
+    if any(path not in recorded for path in paths) or fingerprint_files(paths) != {path: recorded[path] for path in paths}:
+        return None
+    return entry["output_name"]
+
+
+def record_cached_runs(jobs, status):
+    """Record in their reg/ cache index the N4 runs of ``jobs`` whose jobs all finished (done or skipped)."""
+    runs = {}
+    for job in jobs:
+        if "cache" in job:
+            reg_dir, key, output_name = job["cache"]
+            runs.setdefault((reg_dir, key), (output_name, []))[1].append(job)
+    indexes = {}
+    for (reg_dir, key), (output_name, cached_jobs) in runs.items():
+        if not all(status.get(job["name"]) in ("done", "skipped") for job in cached_jobs):
+            continue
+        index = indexes.setdefault(reg_dir, load_cache_index(reg_dir))
+        outputs = [path for job in cached_jobs for path in job["outputs"]]
+        index[key] = {"output_name": output_name, "outputs": fingerprint_files(outputs)}
+    for reg_dir, index in indexes.items():
+        save_cache_index(reg_dir, index)
+
+
+def run_cached_n4_jobs(jobs, **kwargs):
+    """n4_scheduler.run_jobs, then record the N4 runs that completed in their reg/ cache index."""
+    status = run_jobs(jobs, **kwargs)
+    record_cached_runs(jobs, status)
+    return status
+
+
+# ------------------------------------------------------------
+# Materialization
+# ------------------------------------------------------------
+def link_or_copy(sources, targets, threads=None):
+    """Hard link every source to its target, copying when linking is not possible (other filesystem)."""
+    for source, target in zip(sources, targets):
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+        print(f"Reused {os.path.basename(source)} -> {os.path.basename(target)}")
+
+
+def links_up_to_date(job):
+    """True when every target is a link to, or a copy at least as recent as, its source."""
+    for source, target in zip(job["inputs"], job["outputs"]):
+        if not os.path.exists(target):
+            return False
+        if not os.path.samefile(source, target) and os.path.getmtime(target) < os.path.getmtime(source):
+            return False
+    return True
+
+
+def get_cached_n4_jobs(input_path, commands, reg_dir, outputs=N4_OUTPUTS, backend=N4_BACKEND, n4_params=None):
+    """get_n4_jobs for all the commands of one image, running N4 once per distinct cache key.
+
+    A command with the same image, weight, mask and parameters as an earlier command, or
+    as a completed run recorded in the reg/ cache index, becomes a job linking the existing
+    outputs. The N4 jobs carry their cache key, and the runs are only recorded once all
+    their jobs finished (run_cached_n4_jobs), so the index never points at unfinished outputs.
+    """
+    index = load_cache_index(reg_dir)
+    command_names = {command["output_name"] for command in commands}
+    jobs = []
+    scheduled = {}  # cache key -> (output name, job names) of the runs scheduled here
+    for command in commands:
+        output_name = command["output_name"]
+        try:
+            key = n4_cache_key(input_path, command["weight"], command["mask"], backend, n4_params)
+        except FileNotFoundError:
+            # Let the scheduler report the missing input
+            jobs.extend(get_n4_jobs(input_path, command["weight"], command["mask"], output_name, reg_dir,
+                                    outputs=outputs, backend=backend, n4_params=n4_params))
+            continue
+
+        if key in scheduled:
+            source_name, deps = scheduled[key]
+        elif (index.get(key) or {}).get("output_name") not in command_names:
+            # Outputs of another script's run, usable only if they are unchanged since it completed
+            source_name, deps = get_cached_outputs(index, key, reg_dir, outputs), []
+        else:
+            source_name = None
+
+        if source_name is not None:
+            sources = [get_n4_output_paths(source_name, reg_dir)[output] for output in outputs]
+            targets = [get_n4_output_paths(output_name, reg_dir)[output] for output in outputs]
+            jobs.append({
+                "name": output_name,
+                "function": link_or_copy,
+                "kwargs": dict(sources=sources, targets=targets),
+                "inputs": sources,
+                "outputs": targets,
+                "deps": deps,
+                "is_up_to_date": links_up_to_date,
+            })
+            continue
+
+        command_jobs = get_n4_jobs(input_path, command["weight"], command["mask"], output_name, reg_dir,
+                                   outputs=outputs, backend=backend, n4_params=n4_params)
+        for job in command_jobs:
+            job["cache"] = (reg_dir, key, output_name)
+        jobs.extend(command_jobs)
+        scheduled[key] = (output_name, [job["name"] for job in command_jobs])
+    return jobs
@@ -0,0 +1,168 @@
+import os
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Threads given to every N4BiasFieldCorrection / DenoiseImage process
+THREADS_PER_JOB = 2
+# Concurrent jobs, so that the pool uses every core once
+MAX_WORKERS = max(1, (os.cpu_count() or 1) // THREADS_PER_JOB)
+# "ants" runs the N4BiasFieldCorrection binary, "sitk" the in-process SimpleITK filter of n4_sitk
+N4_BACKEND = "ants"
+# Files written for every N4 command
+N4_OUTPUTS = ("corrected", "biasfield", "denoised")
+
+
+# ------------------------------------------------------------
+# Job graph
+# ------------------------------------------------------------
+def get_n4_output_paths(output_name, reg_dir):
+    return {
+        "corrected": os.path.join(reg_dir, f"{output_name}.nii.gz"),
+        "biasfield": os.path.join(reg_dir, f"biasfield_{output_name}.nii.gz"),
+        "denoised": os.path.join(reg_dir, f"{output_name}_dn.nii.gz"),
+    }
+
+
+def get_n4_jobs(input_path, weight, mask, output_name, reg_dir, outputs=N4_OUTPUTS, backend=N4_BACKEND, n4_params=None):
+    """Jobs producing the requested ``outputs`` ("corrected", "biasfield", "denoised") of one N4 command.
+
+    A job is a dict with the command (or the function and keyword arguments) to run, its
+    input and output files and the names of the jobs it depends on. The "ants" backend runs
+    N4BiasFieldCorrection, which always writes the corrected image and biasfield, then a
+    DenoiseImage job reading the corrected image back. The "sitk" backend is a single fused
+    job (n4_sitk.correct_denoise_and_write) that keeps the corrected image in memory and
+    writes only the requested outputs; ``n4_params`` (shrink_factor, iterations,
+    convergence_threshold, denoise_backend) are passed to it. SimpleITK's filter has no
+    weight image, so a command whose weight is not its mask always runs on the ANTs binary.
+    """
+    output_paths = get_n4_output_paths(output_name, reg_dir)
+    unknown = set(outputs) - set(output_paths)
+    if unknown:
+        raise ValueError(f"Unknown N4 outputs {sorted(unknown)}, must be in {list(output_paths)}.")
+
+    if backend == "sitk" and weight == mask:
+        from n4_sitk import correct_denoise_and_write
+        return [{
+            "name": output_name,
+            "function": correct_denoise_and_write,
+            "kwargs": dict(input_path=input_path, weight=weight, mask=mask,
+                           **{f"output_{output}": output_paths[output] for output in outputs},
+                           **(n4_params or {})),
+            "inputs": [input_path, weight, mask],
+            "outputs": [output_paths[output] for output in outputs],
+            "deps": [],
+        }]
+    if backend not in ("ants", "sitk"):
+        raise ValueError(f"Unknown N4 backend '{backend}', must be 'ants' or 'sitk'.")
+
+    output_corrected = output_paths["corrected"]
+    output_biasfield = output_paths["biasfield"]
+    jobs = [{
+        "name": output_name,
+        "command": ["N4BiasFieldCorrection", "-d", "3",
+                    "-i", input_path,
+                    "-w", weight,
+                    "-x", mask,
+                    "-o", f"[{output_corrected},{output_biasfield}]"],
+        "inputs": [input_path, weight, mask],
+        "outputs": [output_corrected, output_biasfield],
+        "deps": [],
+    }]
+    if "denoised" in outputs:
+        denoised_output = output_paths["denoised"]
+        jobs.append({
+            "name": f"{output_name}_dn",
+            "command": ["DenoiseImage", "-d", "3", "-i", output_corrected, "-o", denoised_output],
+            "inputs": [output_corrected],
+            "outputs": [denoised_output],
+            "deps": [output_name],
+        })
+    return jobs
+
+
+def is_up_to_date(job):
+    """True when every output exists and is newer than every input."""
+    try:
+        oldest_output = min(os.path.getmtime(path) for path in job["outputs"])
+        newest_input = max(os.path.getmtime(path) for path in job["inputs"])
+    except (FileNotFoundError, ValueError):
+        return False
+    return oldest_output >= newest_input
+
+
+# ------------------------------------------------------------
+# Execution
+# ------------------------------------------------------------
+def run_job(job, threads=THREADS_PER_JOB):
+    if "function" in job:
+        job["function"](**job["kwargs"], threads=threads)
+        return job["name"]
+    env = dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(threads))
+    print(f"Executing: {' '.join(job['command'])}")
+    subprocess.run(job["command"], env=env, check=True)
+    return job["name"]
+
+
+def run_jobs(jobs, max_workers=MAX_WORKERS, threads=THREADS_PER_JOB):
+    """Run a job graph over a bounded thread pool.
+
+    The workers only wait on the ANTs processes or on SimpleITK filters (which release the
+    GIL), so threads are enough. A job starts once all its dependencies succeeded. Jobs whose
+    outputs are newer than their inputs (or that pass their own "is_up_to_date" check) are
+    skipped, so an interrupted run resumes where it stopped; jobs with missing inputs or
+    failed dependencies are not run. Returns a dict job name -> "done", "skipped" or "failed".
+    """
+    jobs = {job["name"]: job for job in jobs}
+    waiting_for = {name: {dep for dep in job["deps"] if dep in jobs} for name, job in jobs.items()}
+    dependents = {name: [] for name in jobs}
+    for name, deps in waiting_for.items():
+        for dep in deps:
+            dependents[dep].append(name)
+
+    status = {}
+    ready = deque(name for name, deps in waiting_for.items() if not deps)
+    running = {}
+
+    def finish(name, result):
+        status[name] = result
+        for dependent in dependents[name]:
+            if result == "failed":
+                if dependent not in status:
+                    print(f"Not running {dependent}: {name} failed")
+                    finish(dependent, "failed")
+                continue
+            waiting_for[dependent].discard(name)
+            if not waiting_for[dependent]:
+                ready.append(dependent)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while ready or running:
+            while ready:
+                name = ready.popleft()
+                missing = [path for path in jobs[name]["inputs"] if not os.path.exists(path)]
+                if missing:
+                    print(f"Not running {name}: missing inputs {missing}")
+                    finish(name, "failed")
+                elif jobs[name].get("is_up_to_date", is_up_to_date)(jobs[name]):
+                    print(f"Skipping {name}: outputs are up to date")
+                    finish(name, "skipped")
+                else:
+                    running[executor.submit(run_job, jobs[name], threads)] = name
+
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    finish(name, "done")
+                except Exception as e:
+                    print(f"Error running {name}: {e}")
+                    finish(name, "failed")
+
+    print(f"Jobs done: {sum(s == 'done' for s in status.values())}, "
+          f"skipped: {sum(s == 'skipped' for s in status.values())}, "
+          f"failed: {sum(s == 'failed' for s in status.values())}")
+    return status
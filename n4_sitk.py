@@ -0,0 +1,86 @@
+import os
+import subprocess
+import tempfile
+import SimpleITK as sitk
+
+# N4 parameters, same defaults as the ANTs binary (-c [50x50x50x50,0.0]) except the shrink factor
+SHRINK_FACTOR = 4
+ITERATIONS = (50, 50, 50, 50)  # one entry per resolution level
+CONVERGENCE_THRESHOLD = 0.0
+# "ants" hands the corrected image to the DenoiseImage binary, "sitk" uses PatchBasedDenoising in memory
+DENOISE_BACKEND = "ants"
+
+
+def read_mask(mask):
+    """Binary mask of the voxels the bias field is fitted on (ANTs -x)."""
+    return sitk.ReadImage(mask, sitk.sitkFloat32) > 0
+
+
+def n4_correct(image, mask, shrink_factor=SHRINK_FACTOR, iterations=ITERATIONS,
+               convergence_threshold=CONVERGENCE_THRESHOLD, threads=None):
+    """In-process N4 correction of a SimpleITK image.
+
+    The bias field is fitted on the image shrunk by ``shrink_factor`` and evaluated back at
+    full resolution. Returns the corrected image and the bias field.
+    """
+    shrunk_image = sitk.Shrink(image, [shrink_factor] * image.GetDimension())
+    shrunk_mask = sitk.Shrink(mask, [shrink_factor] * image.GetDimension())
+
+    corrector = sitk.N4BiasFieldCorrectionImageFilter()
+    corrector.SetMaximumNumberOfIterations([int(i) for i in iterations])
+    corrector.SetConvergenceThreshold(convergence_threshold)
+    if threads is not None:
+        corrector.SetNumberOfThreads(threads)
+    corrector.Execute(shrunk_image, shrunk_mask)
+
+    # Back to original resolution
+    log_bias_field = corrector.GetLogBiasFieldAsImage(image)
+    bias_field = sitk.Exp(log_bias_field)
+    return image / bias_field, bias_field
+
+
+def denoise_ants(image, output_path, threads=None):
+    """DenoiseImage on an in-memory image, passed through an uncompressed scratch file on local disk."""
+    env = dict(os.environ)
+    if threads is not None:
+        env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(threads)
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        scratch_path = os.path.join(scratch_dir, "corrected.nii")
+        sitk.WriteImage(image, scratch_path, useCompression=False)
+        subprocess.run(["DenoiseImage", "-d", "3", "-i", scratch_path, "-o", output_path], env=env, check=True)
+
+
+def denoise_sitk(image, output_path, threads=None):
+    """Patch-based denoising of an in-memory image with SimpleITK (not the same algorithm as DenoiseImage)."""
+    denoiser = sitk.PatchBasedDenoisingImageFilter()
+    if threads is not None:
+        denoiser.SetNumberOfThreads(threads)
+    sitk.WriteImage(denoiser.Execute(image), output_path)
+
+
+def correct_denoise_and_write(input_path, weight, mask, output_corrected=None, output_biasfield=None,
+                              output_denoised=None, denoise_backend=DENOISE_BACKEND, threads=None, **n4_params):
+    """Fused N4 correction and denoising of one command, writing only the outputs given a path.
+
+    The corrected image stays in memory between the two steps, so no gzip NIfTI of it is
+    written and read back when only the biasfield and denoised outputs are wanted.
+    SimpleITK's N4 filter has no weight image, so the weight must be the mask itself;
+    get_n4_jobs runs the weighted commands with the ANTs binary (-w).
+    """
+    if weight != mask:
+        raise ValueError(f"Weight {weight} differs from mask {mask}, weighted N4 runs need the 'ants' backend.")
+    image = sitk.ReadImage(input_path, sitk.sitkFloat32)
+    corrected, bias_field = n4_correct(image, read_mask(mask), threads=threads, **n4_params)
+    if output_corrected is not None:
+        sitk.WriteImage(corrected, output_corrected)
+    if output_biasfield is not None:
+        sitk.WriteImage(bias_field, output_biasfield)
+    if output_denoised is not None:
+        if denoise_backend == "ants":
+            denoise_ants(corrected, output_denoised, threads=threads)
+        elif denoise_backend == "sitk":
+            denoise_sitk(corrected, output_denoised, threads=threads)
+        else:
+            raise ValueError(f"Unknown denoise backend '{denoise_backend}', must be 'ants' or 'sitk'.")
+    print(f"Processed {os.path.basename(input_path)} -> "
+          f"{[os.path.basename(p) for p in (output_corrected, output_biasfield, output_denoised) if p is not None]}")
@@ -1,27 +1,64 @@
 import os
-import subprocess
+import multiprocessing
+
+import numpy as np
+import nibabel as nib
+from nibabel.orientations import axcodes2ornt, io_orientation, ornt_transform
 
 CONTROL1 = "UCSF-PDGM-"
 
 MAIN_DIR = r"/mnt/external/patients_UCSF/UCSF-PDGM-v3"
 
-for folder in os.listdir(MAIN_DIR):
-    folder_path = os.path.join(MAIN_DIR, folder)
 
-    # Check if it's a subject folder
-    if os.path.isdir(folder_path) and folder.startswith(CONTROL1):
-        print(f"Processing folder: {folder}")
+def get_standard_orientation(affine):
+    """Orientation fslreorient2std brings an image to: the MNI152 axes order, keeping its handedness (LAS or RAS)."""
+    first_axis = "L" if np.linalg.det(affine[:3, :3]) < 0 else "R"
+    return axcodes2ornt((first_axis, "A", "S"))
+
+
+def reorient_file(file_path):
+    """Reorient a NIfTI to the standard orientation in place, with 90/180 degree axis permutations and flips only.
+
+    Only the header is read for the images already in the standard orientation; those are
+    left untouched. Returns the path and whether its data had to be permuted.
+    """
+    img = nib.load(file_path)
+    current = io_orientation(img.affine)
+    target = get_standard_orientation(img.affine)
+    if np.array_equal(current, target):
+        return file_path, False
+
+    reoriented = img.as_reoriented(ornt_transform(current, target))
+    # Written next to the original then renamed, the original being read lazily until then
+    tmp_path = os.path.join(os.path.dirname(file_path), f".tmp_{os.path.basename(file_path)}")
+    nib.save(reoriented, tmp_path)
+    os.replace(tmp_path, file_path)
+    return file_path, True
+
 
-        for file_ in os.listdir(folder_path):
-            if file_.endswith(".nii.gz"):
-                file_path = os.path.join(folder_path, file_)
-                print(f"Reorienting: {file_path}")
+def get_nifti_files(folder_path):
+    return [os.path.join(folder_path, file_) for file_ in sorted(os.listdir(folder_path)) if file_.endswith(".nii.gz")]
 
-                # Apply fslreorient2std and overwrite the file
-                subprocess.run(["fslreorient2std", file_path, file_path], check=True)
-                print(f"Updated: {file_path}")
 
+def reorient_files(file_paths, processes=None):
+    """Reorient every file on a process pool, returning the files whose data was permuted."""
+    permuted = []
+    with multiprocessing.Pool(processes=processes) as pool:
+        for file_path, changed in pool.imap_unordered(reorient_file, file_paths):
+            if changed:
+                print(f"Reoriented: {file_path}")
+                permuted.append(file_path)
+    print(f"{len(permuted)} of {len(file_paths)} files needed reorienting")
+    return permuted
 
 
+if __name__ == "__main__":
+    file_paths = []
+    for folder in os.listdir(MAIN_DIR):
+        folder_path = os.path.join(MAIN_DIR, folder)
 
+        # Check if it's a subject folder
+        if os.path.isdir(folder_path) and folder.startswith(CONTROL1):
+            file_paths.extend(get_nifti_files(folder_path))
 
+    reorient_files(file_paths)
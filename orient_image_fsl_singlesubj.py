@@ -1,15 +1,8 @@
-import os
-import subprocess
+from orient_image_fsl import get_nifti_files, reorient_files
 
 # Define the folder path
 folder_path = "/mnt/external/patients_UCSF/UCSF-PDGM-v3/UCSF-PDGM-0004_nifti"
 
-# Loop through files in the directory
-for file_ in os.listdir(folder_path):
-    if file_.endswith(".nii.gz"):
-        file_path = os.path.join(folder_path, file_)
-        print(f"Reorienting: {file_path}")
-
-        # Apply fslreorient2std and overwrite the file
-        subprocess.run(["fslreorient2std", file_path, file_path], check=True)
-        print(f"Updated: {file_path}")
\ No newline at end of file
+if __name__ == "__main__":
+    # Reorient every .nii.gz of the subject in place
+    reorient_files(get_nifti_files(folder_path))
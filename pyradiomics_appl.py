@@ -1,7 +1,13 @@
 from pathlib import Path
 import pandas as pd
 import os
-from radiomics import featureextractor
+import csv
+import json
+import multiprocessing
+import SimpleITK as sitk
+from radiomics import featureextractor, imageoperations
+
+from cohort_manifest import fingerprint_files, load_manifest, needs_run, record_run, save_manifest
 
 # ============================================================
 #                     CONFIGURATION CONSTANTS
@@ -10,6 +16,7 @@ from radiomics import featureextractor
 # --- Paths ---
 MAIN_FOLDER = "/mnt/external/reorg_patients_UCSF"         # Root directory containing patient folders
 OUTPUT_CSV = "/mnt/external/radiomics_features.csv"        # Output CSV file path
+PARTIAL_CSV = "/mnt/external/radiomics_features.partial.csv"  # Features of the finished jobs, kept until OUTPUT_CSV is written
 
 # --- MRI Modalities and N4 Variants ---
 MODALITIES = ["FLAIR", "T1c"]                       # Modalities to process
@@ -39,100 +46,301 @@ PYRADIOMICS_PARAMS = {
 # --- Output Control ---
 PATIENT_PREFIX = "UCSF-PDGM-"                         # Pattern prefix for patient folders
 ID_COLUMN = "patient_id"                            # Name of ID column in CSV
+STAGE = "radiomics"                                 # Name of this step in the cohort manifest
+END_OF_IMAGE = "__end_of_image__"                   # Feature name of the PARTIAL_CSV row closing the rows of an image
+
+# --- Parallelism ---
+MAX_WORKERS = os.cpu_count()                        # Worker processes, one extractor and one ITK thread each
+
+# --- In-memory Extraction ---
+IN_MEMORY = True                                    # Images cropped to the mask bounding box, mask read once per worker and patient
+PAD_DISTANCE = 5                                    # Voxels kept around the mask bounding box (PyRadiomics padDistance)
 
 # ============================================================
 #                     FEATURE EXTRACTION
 # ============================================================
 
-# Initialize the feature extractor
-extractor = featureextractor.RadiomicsFeatureExtractor(**PYRADIOMICS_PARAMS)
-extractor.enableAllFeatures()  # Enable all feature classes (customizable)
+# One extractor per worker process, configured once when the worker starts
+_extractor = None
+# (mask path, cropped mask, region) of the last mask a worker read, in IN_MEMORY mode
+_cropped_mask = None
+
+
+def create_extractor():
+    params = dict(PYRADIOMICS_PARAMS)
+    if IN_MEMORY:
+        params['normalize'] = False  # done by prepare_image on the whole image, before cropping
+    extractor = featureextractor.RadiomicsFeatureExtractor(**params)
+    extractor.enableAllFeatures()  # Enable all feature classes (customizable)
+    return extractor
+
 
-print("✅ PyRadiomics feature classes enabled:")
-for feature_class, features in extractor.enabledFeatures.items():
-    print(f"  - {feature_class}: {features}")
+def _init_worker():
+    global _extractor
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)  # parallel across jobs, not inside them
+    _extractor = create_extractor()
 
 # ------------------------------------------------------------
 # Helper Functions
 # ------------------------------------------------------------
-def extract_features(image_path: Path, mask_path: Path) -> dict:
-    """Extract PyRadiomics features for a given image–mask pair."""
+def extract_features(image, mask, name=None) -> dict:
+    """Extract PyRadiomics features for a given image–mask pair (file paths or SimpleITK images)."""
+    if not isinstance(image, sitk.Image):
+        image, mask, name = str(image), str(mask), Path(image).name
     try:
-        result = extractor.execute(str(image_path), str(mask_path))
+        result = _extractor.execute(image, mask)
         # Remove diagnostic keys (metadata)
-        return {k: v for k, v in result.items() if not k.startswith("diagnostics")}
+        return {k: float(v) for k, v in result.items() if not k.startswith("diagnostics")}
     except Exception as e:
-        print(f"Error processing {image_path.name}: {e}")
+        print(f"Error processing {name}: {e}")
         return {}
 
+def load_cropped_mask(mask_path):
+    """Tumor mask cropped to its bounding box padded by PAD_DISTANCE, and that (index, size) region.
+
+    The region is None (mask not cropped) when the mask has no tumor voxel, the extractor reports it.
+    """
+    mask = sitk.Cast(sitk.ReadImage(str(mask_path)), sitk.sitkUInt8)
+    shape_stats = sitk.LabelShapeStatisticsImageFilter()
+    shape_stats.Execute(mask)
+    if 1 not in shape_stats.GetLabels():
+        return mask, None
+    bbox = shape_stats.GetBoundingBox(1)  # (x, y, z, size_x, size_y, size_z)
+    dimension = mask.GetDimension()
+    index = [max(bbox[i] - PAD_DISTANCE, 0) for i in range(dimension)]
+    end = [min(bbox[i] + bbox[dimension + i] + PAD_DISTANCE, mask.GetSize()[i]) for i in range(dimension)]
+    size = [end[i] - index[i] for i in range(dimension)]
+    return sitk.RegionOfInterest(mask, size, index), (index, size)
+
+def prepare_image(img_path, region):
+    """Image normalized as PYRADIOMICS_PARAMS asks (over all its voxels) and cropped to the mask region."""
+    image = sitk.ReadImage(str(img_path))
+    if PYRADIOMICS_PARAMS.get('normalize', False):
+        image = imageoperations.normalizeImage(image, **PYRADIOMICS_PARAMS)
+    if region is None:
+        return image
+    index, size = region
+    return sitk.RegionOfInterest(image, size, index)
+
 def rename_features(features: dict, modality: str, variant: str) -> dict:
     """Append modality and correction variant suffix to each feature name."""
     return {f"{feat}_{modality}_{variant}": val for feat, val in features.items()}
 
-# ------------------------------------------------------------
-# Main Loop
-# ------------------------------------------------------------
-def process_all_patients(main_folder: Path) -> pd.DataFrame:
-    """Iterate through all patients and collect radiomics features."""
-    all_data = []
+def get_patient_inputs(patient_dir: str) -> list:
+    """Mask and images the features of a patient are extracted from."""
+    patient_number = patient_dir.split("_")[0]
+    inputs = [os.path.join(MAIN_FOLDER, patient_dir, SEG_FOLDER_NAME, f"{patient_number}_tumor_binary.nii.gz")]
+    for modality in MODALITIES:
+        inputs.append(os.path.join(MAIN_FOLDER, patient_dir, ANAT_FOLDER_NAME, f"{patient_number}_{modality}.nii.gz"))
+        for variant in N4_VARIANTS:
+            inputs.append(os.path.join(MAIN_FOLDER, patient_dir, REG_FOLDER_NAME, f"{patient_number}_{modality}_N4_{variant}.nii.gz"))
+    return inputs
 
-    for patient_dir in os.listdir(MAIN_FOLDER):
-        patient_number = patient_dir.split("_")[0]
-        print(f"\n📂 Processing {patient_number}")
+def get_patient_jobs(patient_dir: str) -> list:
+    """Jobs of one patient, (patient number, mask path, [(modality, variant, image path)]),
+    native images first then the N4 variants, as the columns of the feature table.
+    """
+    patient_number = patient_dir.split("_")[0]
 
-        anat_path = os.path.join(MAIN_FOLDER, patient_dir, ANAT_FOLDER_NAME)
-        if not os.path.isdir(anat_path):
-            print(f"Missing anat in {patient_number}, skipping.")
-            continue
+    anat_path = os.path.join(MAIN_FOLDER, patient_dir, ANAT_FOLDER_NAME)
+    if not os.path.isdir(anat_path):
+        print(f"Missing anat in {patient_number}, skipping.")
+        return None
+
+    seg_path = os.path.join(MAIN_FOLDER, patient_dir, SEG_FOLDER_NAME)
+    if not os.path.isdir(seg_path):
+        print(f"Missing seg in {patient_number}, skipping.")
+        return None
+
+    reg_path = os.path.join(MAIN_FOLDER, patient_dir, REG_FOLDER_NAME)
+    if not os.path.isdir(reg_path):
+        print(f"Missing reg in {patient_number}, skipping.")
+        return None
+
+    tumor_mask_binary_path = os.path.join(seg_path, f"{patient_number}_tumor_binary.nii.gz")
+    if not os.path.isfile(tumor_mask_binary_path):
+        print(f"Missing segmentation mask {tumor_mask_binary_path}, skipping")
+        return None
 
-        seg_path = os.path.join(MAIN_FOLDER, patient_dir, SEG_FOLDER_NAME)
-        if not os.path.isdir(seg_path):
-            print(f"Missing seg in {patient_number}, skipping.")
+    images = []
+    # Native images
+    for modality in MODALITIES:
+        img_path_native = os.path.join(anat_path, f"{patient_number}_{modality}.nii.gz")
+        if not os.path.isfile(img_path_native):
+            print(f"Missing {modality} for {patient_number}, skipping.")
             continue
-        print("Find the tumor binary mask")
+        images.append((modality, "nat", img_path_native))
 
-        reg_path = os.path.join(MAIN_FOLDER, patient_dir, REG_FOLDER_NAME)
-        if not os.path.isdir(reg_path):
-            print(f"Missing reg in {patient_number}, skipping.")
+    # Iterate through modalities and correction variants
+    for modality in MODALITIES:
+        img_path_native = os.path.join(anat_path, f"{patient_number}_{modality}.nii.gz")
+        if not os.path.isfile(img_path_native):
             continue
+        for variant in N4_VARIANTS:
+            # N4 images
+            img_path = os.path.join(reg_path, f"{patient_number}_{modality}_N4_{variant}.nii.gz")
+            if not os.path.isfile(img_path):
+                print(f"Missing {modality} and {variant} for {patient_number}, skipping.")
+                continue
+            images.append((modality, variant, img_path))
+
+    # One job per image, so the pool balances the long and short extractions
+    return [(patient_number, tumor_mask_binary_path, [image]) for image in images]
+
+
+def get_cropped_mask(mask_path):
+    """load_cropped_mask, kept for the next jobs of the worker: the images of a patient are queued
+    one after the other, so a worker reads each mask once for all the images of it that it runs.
+    """
+    global _cropped_mask
+    if _cropped_mask is None or _cropped_mask[0] != mask_path:
+        _cropped_mask = (mask_path, *load_cropped_mask(mask_path))
+    return _cropped_mask[1:]
+
+
+def run_job(job) -> list:
+    """(patient number, modality, variant, features) of every image of a job, in the worker's extractor."""
+    patient_number, mask_path, images = job
+    if not IN_MEMORY:
+        return [(patient_number, modality, variant, extract_features(img_path, mask_path))
+                for modality, variant, img_path in images]
 
-        patient_features = {ID_COLUMN: patient_number}
-        tumor_mask_binary_path = os.path.join(seg_path, f"{patient_number}_tumor_binary.nii.gz")
-        print(tumor_mask_binary_path)
-        if not os.path.isfile(tumor_mask_binary_path):
-            print("Missing segmentation mask, skipping")
+    try:
+        mask, region = get_cropped_mask(mask_path)
+    except Exception as e:
+        print(f"Error reading {Path(mask_path).name}: {e}")
+        return [(patient_number, modality, variant, {}) for modality, variant, _ in images]
+    results = []
+    for modality, variant, img_path in images:
+        try:
+            image = prepare_image(img_path, region)
+        except Exception as e:
+            print(f"Error reading {Path(img_path).name}: {e}")
+            results.append((patient_number, modality, variant, {}))
             continue
-        # Native images
-        for modality in MODALITIES:
-            variant = "nat"
-            img_path_native = os.path.join(anat_path, f"{patient_number}_{modality}.nii.gz")
-            if not os.path.isfile(img_path_native):
-                print(f"Missing {modality} for {patient_number}, skipping.")
+        results.append((patient_number, modality, variant, extract_features(image, mask, Path(img_path).name)))
+    return results
+
+
+def get_image_fingerprint(mask_path, img_path, params) -> dict:
+    """Mask and image fingerprints and parameters the features of one image are extracted with."""
+    return {"inputs": fingerprint_files([mask_path, img_path]), "params": params}
+
+
+def load_partial(partial_path) -> dict:
+    """{(patient, modality, variant): (features, fingerprint)} of the images finished by an earlier, interrupted run.
+
+    An image counts as finished only once its END_OF_IMAGE row (holding the fingerprint it
+    was extracted with) was written, so the rows of an image cut short by a crash are
+    ignored. Malformed rows, like a last line truncated mid-write, are skipped.
+    """
+    done = {}
+    if not os.path.exists(partial_path):
+        return done
+    features = {}
+    with open(partial_path, newline="") as f:
+        for row in csv.reader(f):
+            if len(row) != 5:
                 continue
-            feats = extract_features(img_path_native, tumor_mask_binary_path)
-            renamed_feats = rename_features(feats, modality, variant)
-            patient_features.update(renamed_feats)
-
-        # Iterate through modalities and correction variants
-        for modality in MODALITIES:
-            img_path_native = os.path.join(anat_path, f"{patient_number}_{modality}.nii.gz")
-            if not os.path.isfile(img_path_native):
-                print(f"Missing {modality} for {patient_number}, skipping.")
+            patient_number, modality, variant, feature, value = row
+            key = (patient_number, modality, variant)
+            try:
+                if feature == END_OF_IMAGE:
+                    done[key] = (features.pop(key, {}), json.loads(value))
+                else:
+                    features.setdefault(key, {})[feature] = float(value)
+            except ValueError:
                 continue
-            for variant in N4_VARIANTS:
-                # N4 images
-                img_path = os.path.join(reg_path, f"{patient_number}_{modality}_N4_{variant}.nii.gz")
-                if not os.path.isfile(img_path):
-                    print(f"Missing {modality} and {variant} for {patient_number}, skipping.")
-                    continue
+    return done
+
 
-                feats = extract_features(img_path, tumor_mask_binary_path)
-                renamed_feats = rename_features(feats, modality, variant)
-                patient_features.update(renamed_feats)
+def _end_last_row(partial_path):
+    """Terminate a last row truncated by a crash, so that the appended rows start on a line of their own."""
+    if not os.path.exists(partial_path) or os.path.getsize(partial_path) == 0:
+        return
+    with open(partial_path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
 
-        all_data.append(patient_features)
+# ------------------------------------------------------------
+# Main Loop
+# ------------------------------------------------------------
+def process_all_patients(main_folder: Path, previous: pd.DataFrame = None, manifest: dict = None,
+                         processes: int = MAX_WORKERS, partial_path=PARTIAL_CSV) -> pd.DataFrame:
+    """Collect the radiomics features of all patients, on a pool of workers with one extractor each.
 
-    df = pd.DataFrame(all_data)
+    With the ``previous`` results and the cohort ``manifest``, patients whose mask, images
+    and parameters did not change since their row was computed keep that row; only new or
+    changed patients are extracted again (and recorded in the manifest). The features of
+    every finished (patient, modality, variant) are appended to ``partial_path`` as they
+    come, closed by an END_OF_IMAGE row, so a rerun after a crash only extracts the images
+    that are missing or whose mask, image or parameters changed since.
+    """
+    all_data = {}
+    params = {"params": PYRADIOMICS_PARAMS, "modalities": MODALITIES, "variants": N4_VARIANTS}
+    done = load_partial(partial_path)
+
+    patient_jobs = {}
+    for patient_dir in os.listdir(MAIN_FOLDER):
+        patient_number = patient_dir.split("_")[0]
+        if (manifest is not None and previous is not None and patient_number in previous.index
+                and not needs_run(manifest, STAGE, patient_dir, get_patient_inputs(patient_dir), params)):
+            all_data[patient_number] = previous.loc[patient_number].to_dict()
+            continue
+        jobs = get_patient_jobs(patient_dir)
+        if jobs is not None:
+            patient_jobs[patient_dir] = jobs
+
+    # Only the images not finished by an earlier run with the same inputs, in each job
+    pending = []
+    fingerprints = {}
+    for jobs in patient_jobs.values():
+        for patient_number, mask_path, images in jobs:
+            todo = []
+            for modality, variant, img_path in images:
+                key = (patient_number, modality, variant)
+                fingerprints[key] = get_image_fingerprint(mask_path, img_path, params)
+                if key not in done or done[key][1] != fingerprints[key]:
+                    done.pop(key, None)
+                    todo.append((modality, variant, img_path))
+            if todo:
+                pending.append((patient_number, mask_path, todo))
+    done = {key: features for key, (features, _) in done.items()}
+    print(f"\n📂 {len(patient_jobs)} patients to process, {len(pending)} jobs to run")
+
+    _end_last_row(partial_path)
+    with open(partial_path, "a", newline="") as f, \
+            multiprocessing.Pool(processes=processes, initializer=_init_worker) as pool:
+        writer = csv.writer(f)
+        for results in pool.imap_unordered(run_job, pending):
+            for patient_number, modality, variant, features in results:
+                if not features:
+                    continue  # failed, extracted again on the next run
+                print(f"Extracted {patient_number} {modality} {variant}")
+                key = (patient_number, modality, variant)
+                done[key] = features
+                writer.writerows([patient_number, modality, variant, feature, value]
+                                 for feature, value in features.items())
+                writer.writerow([patient_number, modality, variant, END_OF_IMAGE, json.dumps(fingerprints[key])])
+            f.flush()
+
+    for patient_dir, jobs in patient_jobs.items():
+        patient_number = patient_dir.split("_")[0]
+        patient_features = {}
+        complete = True
+        for _, _, images in jobs:
+            for modality, variant, _ in images:
+                features = done.get((patient_number, modality, variant))
+                if features is None:
+                    complete = False
+                    continue
+                patient_features.update(rename_features(features, modality, variant))
+        all_data[patient_number] = patient_features
+        if manifest is not None and complete:
+            record_run(manifest, STAGE, patient_dir, get_patient_inputs(patient_dir), [OUTPUT_CSV], params)
+
+    df = pd.DataFrame([{ID_COLUMN: patient_number, **features} for patient_number, features in all_data.items()])
     if ID_COLUMN in df.columns:
         df.set_index(ID_COLUMN, inplace=True)
     return df
@@ -141,8 +349,17 @@ def process_all_patients(main_folder: Path) -> pd.DataFrame:
 # Run and Save
 # ------------------------------------------------------------
 if __name__ == "__main__":
-    df = process_all_patients(MAIN_FOLDER)
+    print("✅ PyRadiomics feature classes enabled:")
+    for feature_class, features in create_extractor().enabledFeatures.items():
+        print(f"  - {feature_class}: {features}")
+
+    # Rows of the last run are reused for the patients whose inputs did not change
+    manifest = load_manifest(MAIN_FOLDER)
+    previous = pd.read_csv(OUTPUT_CSV, index_col=ID_COLUMN, dtype={ID_COLUMN: str}) if os.path.exists(OUTPUT_CSV) else None
+    df = process_all_patients(MAIN_FOLDER, previous, manifest)
     df.sort_index(inplace=True)
     df.to_csv(OUTPUT_CSV)
+    save_manifest(MAIN_FOLDER, manifest, STAGE)
+    os.remove(PARTIAL_CSV)  # every feature is in OUTPUT_CSV now
     print(f"\n✅ Radiomics feature extraction complete.")
     print(f"📄 Results saved to: {OUTPUT_CSV.resolve()}")
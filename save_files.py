@@ -1,5 +1,10 @@
 import os
+import fcntl
 import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cohort_manifest import get_patient_folders, load_manifest, needs_run, record_run, save_manifest
 
 # Constants
 CONTROL1 = "UCSF-PDGM-"
@@ -12,38 +17,141 @@ CONTROL_seg = ("brain_parenchyma_segmentation.nii.gz", "brain_segmentation.nii.g
 MAIN_DIR = "/mnt/external/patients_UCSF/UCSF-PDGM-v3"
 NEW_DIR = "/mnt/external/reorg_patients_UCSF"
 
-def main():
-    # Iterate over each subject folder
-    for folder in os.listdir(MAIN_DIR):
-        folder_path = os.path.join(MAIN_DIR, folder)
-
-        # Check if it's a subject folder
-        if os.path.isdir(folder_path) and folder.startswith(CONTROL1):
-            print(f"Processing folder: {folder}")
-
-            # Create new subject directory structure
-            subject_new_path = os.path.join(NEW_DIR, folder)
-            anat_dir = os.path.join(subject_new_path, "anat")
-            seg_dir = os.path.join(subject_new_path, "seg")
-            reg_dir = os.path.join(subject_new_path, "reg")
-
-            os.makedirs(anat_dir, exist_ok=True)
-            os.makedirs(seg_dir, exist_ok=True)
-            os.makedirs(reg_dir, exist_ok=True)  # This remains empty
-
-            # Move files into appropriate directories by copying them
-            for file_ in os.listdir(folder_path):
-                file_path = os.path.join(folder_path, file_)
-                if file_.startswith(CONTROL1):
-                    if file_.endswith(CONTROL_anat):
-                        shutil.copy2(file_path, os.path.join(anat_dir, file_))
-                        print(f"Copied {file_} to {anat_dir}")
-
-                    elif file_.endswith(CONTROL_seg):
-                        shutil.copy2(file_path, os.path.join(seg_dir, file_))
-                        print(f"Copied {file_} to {seg_dir}")
+# Name of this step in the cohort manifest
+STAGE = "reorganize"
+# "copy", "hardlink" (same filesystem, no data written) or "reflink" (copy-on-write clone, e.g. btrfs or XFS)
+LINK_MODE = "copy"
+# Copies are I/O bound, so threads rather than processes
+COPY_THREADS = 16
+# Compare the SHA-256 of every file written with the one of its source
+VERIFY_HASH = False
+
+# Largest mtime difference of an up to date copy: FAT/exFAT store 2 s timestamps and
+# NTFS 100 ns ones, so copy2 cannot always keep the source's nanosecond mtime
+MTIME_TOLERANCE_NS = 2_000_000_000
+
+# ioctl cloning a whole file (linux/fs.h)
+FICLONE = 0x40049409
+
+
+def get_file_targets(folder):
+    """(source, target) paths of the anatomical and segmentation files of a subject folder.
+
+    The file names are known (``{patient}_{suffix}``), so the folder is not listed.
+    """
+    folder_name = folder.split('_')[0]
+    folder_path = os.path.join(MAIN_DIR, folder)
+    subject_new_path = os.path.join(NEW_DIR, folder)
+    targets = []
+    for subdir, suffixes in (("anat", CONTROL_anat), ("seg", CONTROL_seg)):
+        for suffix in suffixes:
+            file_ = f"{folder_name}_{suffix}"
+            targets.append((os.path.join(folder_path, file_), os.path.join(subject_new_path, subdir, file_)))
+    return targets
+
+
+def is_up_to_date(source, target):
+    """True when the target has the size and, within MTIME_TOLERANCE_NS, the mtime of the source
+    (copy2, links and reflinks keep both, up to the timestamp resolution of the target filesystem).
+    """
+    try:
+        source_stat = os.stat(source)
+        target_stat = os.stat(target)
+    except FileNotFoundError:
+        return False
+    return (source_stat.st_size == target_stat.st_size
+            and abs(source_stat.st_mtime_ns - target_stat.st_mtime_ns) <= MTIME_TOLERANCE_NS)
+
+
+def sha256_file(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def reflink(source, target):
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, target)
+
+
+def place_file(source, target, mode=LINK_MODE, verify=VERIFY_HASH):
+    """Copy, hard link or reflink one file unless the target is already up to date.
+
+    Links and reflinks fall back to a copy when the trees are on different filesystems
+    (or the filesystem cannot clone). Returns what was done.
+    """
+    if mode not in ("copy", "hardlink", "reflink"):
+        raise ValueError(f"Unknown mode '{mode}', must be 'copy', 'hardlink' or 'reflink'.")
+    if not os.path.exists(source):
+        return "missing"
+    if is_up_to_date(source, target):
+        return "skipped"
+
+    if os.path.exists(target):
+        os.remove(target)  # never write through an old hard link into the source tree
+    result = "copied"
+    try:
+        if mode == "hardlink":
+            os.link(source, target)
+            result = "linked"
+        elif mode == "reflink":
+            reflink(source, target)
+            result = "reflinked"
+    except OSError:
+        if os.path.exists(target):
+            os.remove(target)
+    if result == "copied":
+        shutil.copy2(source, target)
+
+    if verify and sha256_file(source) != sha256_file(target):
+        raise IOError(f"SHA-256 of {target} does not match {source}")
+    return result
+
+
+def main(mode=LINK_MODE, threads=COPY_THREADS, verify=VERIFY_HASH):
+    os.makedirs(NEW_DIR, exist_ok=True)
+    # Only the subject folders that are new, changed or incomplete since the last run
+    manifest = load_manifest(NEW_DIR)
+    folders = get_patient_folders(MAIN_DIR, CONTROL1)
+    targets = {folder: get_file_targets(folder) for folder in folders}
+    pending = [folder for folder in folders
+               if needs_run(manifest, STAGE, folder, [source for source, _ in targets[folder]])]
+    print(f"{STAGE}: {len(pending)} of {len(folders)} patients to process")
+
+    # Create new subject directory structure
+    for folder in pending:
+        subject_new_path = os.path.join(NEW_DIR, folder)
+        for subdir in ("anat", "seg", "reg"):  # reg remains empty
+            os.makedirs(os.path.join(subject_new_path, subdir), exist_ok=True)
+
+    # Every file of every pending subject on one thread pool
+    failed = set()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(place_file, source, target, mode, verify): (folder, source, target)
+                   for folder in pending for source, target in targets[folder]}
+        for future in as_completed(futures):
+            folder, source, target = futures[future]
+            try:
+                result = future.result()
+            except OSError as e:
+                print(f"Error placing {source}: {e}")
+                failed.add(folder)
+                continue
+            if result == "missing":
+                print(f"Missing {source}")
+            else:
+                print(f"{result.capitalize()} {os.path.basename(source)} to {os.path.dirname(target)}")
+
+    for folder in pending:
+        if folder not in failed:
+            record_run(manifest, STAGE, folder, [source for source, _ in targets[folder]],
+                       [target for _, target in targets[folder]])
+    save_manifest(NEW_DIR, manifest, STAGE)
 
     print("Processing complete.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,81 @@
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from n4_scheduler import get_n4_jobs, run_jobs
+from n4_sitk import correct_denoise_and_write
+
+needs_ants = pytest.mark.skipif(shutil.which("N4BiasFieldCorrection") is None,
+                                reason="ANTs N4BiasFieldCorrection not on PATH")
+
+
+def write_phantom(tmp_path):
+    """32^3 sphere under a smooth multiplicative bias, a brain mask and a smaller "healthy" weight."""
+    z, y, x = np.mgrid[:32, :32, :32].astype(np.float32)
+    radius = np.sqrt((x - 15.5) ** 2 + (y - 15.5) ** 2 + (z - 15.5) ** 2)
+    rng = np.random.default_rng(0)
+    tissue = np.where(radius < 14, 100 + 5 * rng.standard_normal(radius.shape), 0)
+    bias = np.exp(0.3 * (x - 15.5) / 16 - 0.2 * (z - 15.5) / 16)
+    paths = {name: str(tmp_path / f"{name}.nii.gz") for name in ("image", "mask", "weight")}
+    for name, array in (("image", tissue * bias), ("mask", radius < 14), ("weight", (radius < 14) & (x < 20))):
+        image = sitk.GetImageFromArray(array.astype(np.float32))
+        sitk.WriteImage(image, paths[name])
+    return paths
+
+
+def run_ants(paths, weight, tmp_path):
+    """Log bias field of N4BiasFieldCorrection with the shrink factor and iterations of n4_sitk."""
+    corrected, biasfield = str(tmp_path / "ants.nii.gz"), str(tmp_path / "ants_biasfield.nii.gz")
+    subprocess.run(["N4BiasFieldCorrection", "-d", "3", "-i", paths["image"], "-w", weight, "-x", paths["mask"],
+                    "-s", "4", "-c", "[50x50x50x50,0.0]", "-o", f"[{corrected},{biasfield}]"], check=True)
+    return np.log(sitk.GetArrayFromImage(sitk.ReadImage(biasfield)))
+
+
+def centered(log_field, mask):
+    """Log bias field inside the mask, up to the constant N4 leaves free."""
+    values = log_field[mask]
+    return values - values.mean()
+
+
+def test_weighted_commands_run_on_ants(tmp_path):
+    paths = write_phantom(tmp_path)
+    jobs = get_n4_jobs(paths["image"], paths["weight"], paths["mask"], "out", str(tmp_path), backend="sitk")
+    command = jobs[0]["command"]
+    assert command[0] == "N4BiasFieldCorrection"
+    assert command[command.index("-w") + 1] == paths["weight"]
+    assert command[command.index("-x") + 1] == paths["mask"]
+
+
+def test_sitk_refuses_weight_other_than_mask(tmp_path):
+    paths = write_phantom(tmp_path)
+    with pytest.raises(ValueError):
+        correct_denoise_and_write(paths["image"], paths["weight"], paths["mask"],
+                                  output_biasfield=str(tmp_path / "biasfield.nii.gz"))
+
+
+@needs_ants
+def test_sitk_backend_matches_ants(tmp_path):
+    paths = write_phantom(tmp_path)
+    biasfield = str(tmp_path / "biasfield.nii.gz")
+    correct_denoise_and_write(paths["image"], paths["mask"], paths["mask"], output_biasfield=biasfield)
+    mask = sitk.GetArrayFromImage(sitk.ReadImage(paths["mask"])) > 0
+    sitk_log = np.log(sitk.GetArrayFromImage(sitk.ReadImage(biasfield)))
+    ants_log = run_ants(paths, paths["mask"], tmp_path)
+    np.testing.assert_allclose(centered(sitk_log, mask), centered(ants_log, mask), atol=1e-2)
+
+
+@needs_ants
+def test_weighted_sitk_jobs_match_ants(tmp_path):
+    paths = write_phantom(tmp_path)
+    jobs = get_n4_jobs(paths["image"], paths["weight"], paths["mask"], "out", str(tmp_path),
+                       outputs=("corrected", "biasfield"), backend="sitk")
+    for job in jobs:
+        job["command"][3:3] = ["-s", "4", "-c", "[50x50x50x50,0.0]"]
+    assert set(run_jobs(jobs, max_workers=1).values()) == {"done"}
+    mask = sitk.GetArrayFromImage(sitk.ReadImage(paths["mask"])) > 0
+    job_log = np.log(sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / "biasfield_out.nii.gz"))))
+    ants_log = run_ants(paths, paths["weight"], tmp_path)
+    np.testing.assert_allclose(centered(job_log, mask), centered(ants_log, mask), atol=1e-6)
@@ -1,44 +1,86 @@
 import os
-import subprocess
+import multiprocessing
+
+import numpy as np
+import nibabel as nib
+
 from save_files import CONTROL1, CONTROL_anat, NEW_DIR
+from cohort_manifest import get_patient_folders, run_incremental
+from Models.masks import get_mask_path, save_mask
+from Models.tumor_bbox import get_bbox_path, save_bbox
+
+# Name of this step in the cohort manifest
+STAGE = "seg_masks"
 
 
+def get_seg_paths(folder):
+    """Input segmentations and derived masks of a subject folder."""
+    folder_name = folder.split('_')[0]
+    seg_dir = os.path.join(NEW_DIR, folder, "seg")
+    return {
+        # Preexisting files paths
+        "brain_segmentation": os.path.join(seg_dir, f"{folder_name}_brain_segmentation.nii.gz"),
+        "tumor_segmentation": os.path.join(seg_dir, f"{folder_name}_tumor_segmentation.nii.gz"),
+        # New files paths
+        "tumor_binary": os.path.join(seg_dir, f"{folder_name}_tumor_binary.nii.gz"),
+        "brain_healthy_segmentation": os.path.join(seg_dir, f"{folder_name}_brain_healthy_segmentation.nii.gz"),
+    }
+
 
-for folder in os.listdir(NEW_DIR):
-    folder_path = os.path.join(NEW_DIR, folder)
+def get_array_paths(folder):
+    """Bit-packed arrays (and tumor bounding box) written next to the derived masks."""
     folder_name = folder.split('_')[0]
+    array_dir = os.path.join(NEW_DIR, folder, "array")
+    return [get_mask_path(array_dir, f"{folder_name}_tumor_binary_array"),
+            get_mask_path(array_dir, f"{folder_name}_brain_healthy_segmentation_array"),
+            get_bbox_path(array_dir, folder_name)]
 
-    # Check if it's a subject folder
-    if os.path.isdir(folder_path) and folder.startswith(CONTROL1):
-        print(f"Processing folder: {folder}")
 
-        seg_dir = os.path.join(folder_path, "seg")
-        # Ensure 'reg' directory exists
-        os.makedirs(seg_dir, exist_ok=True)
+def derive_masks(brain_seg_array, tumor_seg_array):
+    """Tumor binary and healthy brain masks, as ``fslmaths tumor -bin -nan`` and ``fslmaths brain -sub tumor_binary -bin -nan``.
 
-        # Preexisting files paths
-        brain_segmentation = os.path.join(seg_dir, f"{folder_name}_brain_segmentation.nii.gz")
-        tumor_segmentation = os.path.join(seg_dir, f"{folder_name}_tumor_segmentation.nii.gz")
+    ``-bin`` keeps the voxels > 0, so NaN voxels are left out of both masks.
+    """
+    tumor_binary = np.asarray(tumor_seg_array) > 0
+    brain_healthy = (np.asarray(brain_seg_array, dtype=np.float32) - tumor_binary) > 0
+    return tumor_binary, brain_healthy
 
-        # New files paths
-        tumor_binary = os.path.join(seg_dir, f"{folder_name}_tumor_binary.nii.gz")
-        brain_healthy_segmentation = os.path.join(seg_dir, f"{folder_name}_brain_healthy_segmentation.nii.gz")
-
-        command_tumor = f"fslmaths {tumor_segmentation} -bin -nan {tumor_binary}"
-        command_brain_healthy = f"fslmaths {brain_segmentation} -sub {tumor_binary} -bin -nan {brain_healthy_segmentation}"
-
-        # Run commands and handle errors
-        try:
-            print(f"Running command: {command_tumor}")
-            subprocess.run(command_tumor, shell=True, check=True)
-            print(f"Successfully created tumor binary: {tumor_binary}")
-        except subprocess.CalledProcessError as e:
-            print(f"Error while creating tumor binary for {folder}: {e}")
-            continue
-
-        try:
-            print(f"Running command: {command_brain_healthy}")
-            subprocess.run(command_brain_healthy, shell=True, check=True)
-            print(f"Successfully created brain healthy segmentation: {brain_healthy_segmentation}")
-        except subprocess.CalledProcessError as e:
-            print(f"Error while creating brain healthy segmentation for {folder}: {e}")
+
+def save_mask_nifti(mask, reference_img, path):
+    """Save a mask with the affine, header and data type of the segmentation it was derived from, like fslmaths."""
+    dtype = reference_img.get_data_dtype()
+    nib.save(nib.Nifti1Image(mask.astype(dtype), reference_img.affine, reference_img.header), path)
+
+
+def process_folder(folder):
+    print(f"Processing folder: {folder}")
+
+    folder_name = folder.split('_')[0]
+    array_dir = os.path.join(NEW_DIR, folder, "array")
+    os.makedirs(array_dir, exist_ok=True)
+
+    # Both segmentations decompressed once, both masks derived in memory
+    paths = get_seg_paths(folder)
+    brain_img = nib.load(paths["brain_segmentation"])
+    tumor_img = nib.load(paths["tumor_segmentation"])
+    tumor_binary, brain_healthy = derive_masks(np.asanyarray(brain_img.dataobj), np.asanyarray(tumor_img.dataobj))
+
+    save_mask_nifti(tumor_binary, tumor_img, paths["tumor_binary"])
+    print(f"Successfully created tumor binary: {paths['tumor_binary']}")
+    save_mask_nifti(brain_healthy, brain_img, paths["brain_healthy_segmentation"])
+    print(f"Successfully created brain healthy segmentation: {paths['brain_healthy_segmentation']}")
+
+    # Array forms of the same masks, without reading the NIfTIs back
+    tumor_array_path, healthy_array_path, _ = get_array_paths(folder)
+    save_mask(tumor_array_path, tumor_binary)
+    save_mask(healthy_array_path, brain_healthy)
+    save_bbox(array_dir, folder_name, tumor_binary)
+
+
+if __name__ == "__main__":
+    # Only the subject folders whose segmentations changed or whose masks are missing, in parallel
+    run_incremental(STAGE, NEW_DIR, get_patient_folders(NEW_DIR, CONTROL1), process_folder,
+                    get_inputs=lambda folder: [get_seg_paths(folder)[name] for name in ("brain_segmentation", "tumor_segmentation")],
+                    get_outputs=lambda folder: [get_seg_paths(folder)[name] for name in ("tumor_binary", "brain_healthy_segmentation")]
+                                               + get_array_paths(folder),
+                    processes=multiprocessing.cpu_count())